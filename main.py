@@ -1,14 +1,38 @@
 import sys
 import os
+import re
+import subprocess
 import shutil
 import time
 import logging
+import json
+import csv
 import threading
+import asyncio
+import itertools
+import queue
+import sqlite3
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+from contextlib import contextmanager, nullcontext
+import hashlib
+import cProfile
+import pstats
+import tracemalloc
+import lzma
+import struct
+import secrets
+from array import array
+from collections import OrderedDict, deque
+from urllib.parse import urljoin, urlparse, parse_qs
 import requests  # For downloading files
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout,
                             QWidget, QLabel, QTextEdit, QFileDialog, QMessageBox, QMenuBar,
-                            QMenu, QAction, QDialog, QTextBrowser, QComboBox, QGroupBox)
-from PyQt5.QtCore import Qt, QTimer, QUrl, pyqtSignal, QObject
+                            QMenu, QAction, QDialog, QTextBrowser, QComboBox, QGroupBox,
+                            QInputDialog, QLineEdit, QTableView, QHeaderView, QAbstractItemView)
+from PyQt5.QtCore import (Qt, QTimer, QUrl, pyqtSignal, QObject, QFileSystemWatcher, QAbstractTableModel,
+                          QModelIndex)
 from PyQt5.QtGui import QFont, QPalette, QColor, QDesktopServices, QIcon
 
 # Attempt to import for RAR extraction (if installed)
@@ -18,6 +42,30 @@ try:
 except ImportError:
     rarfile = None
 
+# Direct USB access to boards in BOOTSEL mode (if installed)
+# You may need `pip install pyusb` (and libusb)
+try:
+    import usb.core
+    import usb.util
+except ImportError:
+    usb = None
+
+# Faster decompression for the compressed firmware store (if installed, lzma is used otherwise)
+# You may need `pip install zstandard`
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Serial access to boards running MicroPython/CircuitPython/Arduino (if installed)
+# You may need `pip install pyserial`
+try:
+    import serial
+    from serial.tools import list_ports
+except ImportError:
+    serial = None
+    list_ports = None
+
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
@@ -327,6 +375,7 @@ class TutorialDialog(QDialog):
             💡 <b>Pro Tips:</b>
             <ul>
                 <li>Use <span class="keyboard">BOOTSEL</span> + connect for guaranteed bootloader mode</li>
+                <li>Boards already running MicroPython, CircuitPython or Arduino can be rebooted into bootloader mode without pressing <span class="keyboard">BOOTSEL</span> via <span class="button">Tools > Reboot Boards to Bootloader</span></li>
                 <li>Check console messages for detailed progress</li>
                 <li>Keep firmware files for offline use</li>
             </ul>
@@ -514,54 +563,617 @@ class DonationDialog(QDialog):
 
         self.setLayout(layout)
 
+class DiagnosticsDialog(QDialog):
+    def __init__(self, flasher):
+        super().__init__()
+        self.flasher = flasher
+        self.setWindowTitle("Diagnostics")
+        self.setWindowIcon(QIcon(resource_path('app_icon.ico')))
+        self.resize(700, 500)
+        self.setStyleSheet("""
+            QDialog {
+                background-color: #2b2b2b;
+                color: #ffffff;
+            }
+            QTextBrowser {
+                background-color: #1e1e1e;
+                color: #ffffff;
+                border: 1px solid #666666;
+                border-radius: 4px;
+                padding: 16px;
+            }
+        """)
+
+        layout = QVBoxLayout()
+        self.text = QTextBrowser()
+        layout.addWidget(self.text)
+        self.setLayout(layout)
+
+        # Refresh while open so utilisation can be watched during a batch
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+
+    def refresh(self):
+        self.text.setHtml(self.flasher.diagnostics_html())
+
+class DeviceTableModel(QAbstractTableModel):
+    """
+    One row per device (USB port, else drive) showing its latest job. Worker threads
+    hand events to post(); they are applied on the GUI thread by a timer and announced
+    with a single dataChanged per tick, so the view's cost stays flat however many
+    devices report at once.
+    """
+    COLUMNS = ("Device", "Mount", "Phase", "Progress", "Throughput", "Result")
+    RESULT_COLORS = {"succeeded": "#1b5e20", "warning": "#8d6e00", "failed": "#b71c1c"}
+
+    def __init__(self, interval_ms=50, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._device_rows = {}  # device id -> row
+        self._job_rows = {}  # job id -> row
+        self._pending = {}  # job id -> changed fields, filled from worker threads
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return row["device"]
+            if column == 1:
+                return row["mount"]
+            if column == 2:
+                return row["phase"]
+            if column == 3:
+                return f"{row['progress'] * 100:.0f}%"
+            if column == 4:
+                return f"{row['throughput'] / 1048576:.2f} MB/s" if row["throughput"] else ""
+            return row["result"] if not row["error"] else f"{row['result']}: {row['error']}"
+        if role == Qt.BackgroundRole and column == 5 and row["result"] in self.RESULT_COLORS:
+            return QColor(self.RESULT_COLORS[row["result"]])
+        if role == Qt.ToolTipRole:
+            return row["error"] or f"{row['label']} {row['kind']}"
+        if role == Qt.UserRole:
+            return row["job_id"]
+        return None
+
+    def add_jobs(self, jobs):
+        """Shows newly submitted jobs, reusing the row of a device that already has one. GUI thread only."""
+        new = []
+        for job in jobs:
+            device = job.usb_port or job.drive
+            values = {"device": device, "mount": job.drive, "phase": job.state, "progress": job.progress,
+                      "throughput": None, "result": job.state, "error": None, "label": job.label,
+                      "kind": job.kind, "job_id": job.job_id}
+            row = self._device_rows.get(device)
+            if row is None:
+                new.append(values)
+                continue
+            self._job_rows.pop(self._rows[row]["job_id"], None)
+            self._job_rows[job.job_id] = row
+            self._rows[row] = values
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.COLUMNS) - 1))
+        if new:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(new) - 1)
+            for offset, values in enumerate(new):
+                self._rows.append(values)
+                self._device_rows[values["device"]] = first + offset
+                self._job_rows[values["job_id"]] = first + offset
+            self.endInsertRows()
+
+    def post(self, job_id, event, data):
+        """Records a job event for the next refresh. Safe to call from any thread."""
+        if event == "progress":
+            changes = {"progress": data}
+        elif event == "phase":
+            changes = {"phase": data}
+        elif event == "throughput":
+            changes = {"throughput": data}
+        elif event == "state":
+            changes = {"phase": data, "result": data}
+        elif event == "done":
+            changes = {"phase": "done", "progress": data["progress"], "result": data["state"], "error": data["error"]}
+        else:
+            return
+        with self._lock:
+            self._pending.setdefault(job_id, {}).update(changes)
+
+    def flush(self):
+        """Applies pending events and emits one dataChanged covering the rows they touched."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        rows = []
+        for job_id, changes in pending.items():
+            row = self._job_rows.get(job_id)
+            if row is not None:
+                self._rows[row].update(changes)
+                rows.append(row)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), len(self.COLUMNS) - 1))
+            self.flushes += 1
+
+class HistoryDialog(QDialog):
+    def __init__(self, history):
+        super().__init__()
+        self.history = history
+        self.setWindowTitle("Flash History")
+        self.setWindowIcon(QIcon(resource_path('app_icon.ico')))
+        self.resize(900, 600)
+        self.setStyleSheet("""
+            QDialog {
+                background-color: #2b2b2b;
+                color: #ffffff;
+            }
+            QLineEdit {
+                background-color: #1e1e1e;
+                color: #ffffff;
+                border: 1px solid #666666;
+                border-radius: 4px;
+                padding: 6px;
+            }
+            QTextBrowser {
+                background-color: #1e1e1e;
+                color: #ffffff;
+                border: 1px solid #666666;
+                border-radius: 4px;
+                padding: 16px;
+            }
+        """)
+
+        layout = QVBoxLayout()
+        self.device_filter = QLineEdit()
+        self.device_filter.setPlaceholderText("Filter by device (USB port, drive or personalization id)")
+        self.device_filter.returnPressed.connect(self.refresh)
+        layout.addWidget(self.device_filter)
+        self.text = QTextBrowser()
+        layout.addWidget(self.text)
+        self.setLayout(layout)
+        self.refresh()
+
+    def refresh(self):
+        device = self.device_filter.text().strip() or None
+        html = []
+        if device:
+            last = self.history.last_firmware(device)
+            html.append(f"<h3>{device}</h3>")
+            html.append(f"<p>Last firmware: {last['label']} ({(last['firmware_sha256'] or '')[:12]}) at "
+                        f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(last['finished']))}</p>"
+                        if last else "<p>No firmware flashed yet.</p>")
+        else:
+            for group_by, title in (("hub", "Hub"), ("firmware", "Firmware")):
+                html.append(f"<h3>Today by {title.lower()}</h3><table cellpadding='4'>"
+                            f"<tr><th>{title}</th><th>Jobs</th><th>Failed</th><th>Failure rate</th></tr>")
+                for row in self.history.failure_rates(group_by):
+                    key = row["key"] or "unknown"
+                    if group_by == "firmware" and row["key"]:
+                        key = f"{row['label']} ({row['key'][:12]})"
+                    html.append(f"<tr><td>{key}</td><td>{row['jobs']}</td><td>{row['failed']}</td>"
+                                f"<td>{row['failure_rate'] * 100:.0f}%</td></tr>")
+                html.append("</table>")
+
+        html.append("<h3>Recent jobs</h3><table cellpadding='4'><tr><th>Finished</th><th>Device</th><th>Job</th>"
+                    "<th>Result</th><th>Phases</th><th>Error</th></tr>")
+        for row in self.history.recent(200, device):
+            finished = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row["finished"])) if row["finished"] else ""
+            phases = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in json.loads(row["phases"] or "{}").items())
+            html.append(f"<tr><td>{finished}</td><td>{row['device_id']}</td><td>{row['label']} {row['kind']}</td>"
+                        f"<td>{row['state']}</td><td>{phases}</td><td>{row['error'] or ''}</td></tr>")
+        html.append("</table>")
+        self.text.setHtml("".join(html))
+
 class WorkerSignals(QObject):
     """Signals for threading feedback."""
     finished = pyqtSignal()
     error = pyqtSignal(str)
     message = pyqtSignal(str)
 
+UPDATE_STATE_FILE = os.path.join(os.path.expanduser("~"), ".pico_revival_updates.json")
+UPDATE_CHECK_INTERVAL = 6 * 60 * 60  # Seconds between scheduled update checks
+UPDATE_BANDWIDTH_LIMIT = 1024 * 1024  # Bytes per second, 0 for unlimited
+
+def extract_bundle(rar_path, dest_folder):
+    """Extracts the downloaded RAR bundle into dest_folder and removes the archive."""
+    if not rarfile:
+        raise RuntimeError(
+            "Cannot extract RAR file. The 'rarfile' module is not installed.\n"
+            "Please install with 'pip install rarfile' or use an external tool."
+        )
+    try:
+        rf = rarfile.RarFile(rar_path)
+        rf.extractall(dest_folder)
+        rf.close()
+    except Exception as e:
+        raise RuntimeError(f"Error extracting RAR file: {str(e)}")
+    # Remove downloaded RAR to clean up
+    if os.path.exists(rar_path):
+        os.remove(rar_path)
+
+class BandwidthLimiter:
+    """Token bucket shared by all downloads so background updates stay below a byte rate."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= nbytes
+            delay = -self._allowance / self.rate if self._allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class UpdateChecker:
+    """
+    Conditional downloader for the firmware bundle and per-firmware manifests.
+    The ETag and Last-Modified of every URL are remembered in state_path, so a
+    check only transfers artifacts the server reports as changed. With a PeerClient,
+    changed artifacts are fetched from other stations first and the origin is the
+    fallback; with a PeerStore, downloads are kept to be served to them in turn.
+    """
+    def __init__(self, state_path=UPDATE_STATE_FILE, bandwidth_limit=UPDATE_BANDWIDTH_LIMIT, timeout=30,
+                 peers=None, store=None):
+        self.state_path = state_path
+        self.timeout = timeout
+        self.peers = peers
+        self.store = store
+        self.state = {"urls": {}, "manifests": []}
+        self._lock = threading.Lock()
+        try:
+            with open(state_path, "r") as f:
+                self.state.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        self.limiter = BandwidthLimiter(bandwidth_limit)
+
+    @property
+    def manifests(self):
+        return self.state["manifests"]
+
+    def save(self):
+        with self._lock:
+            try:
+                with open(self.state_path, "w") as f:
+                    json.dump(self.state, f, indent=1)
+            except OSError as e:
+                logging.warning(f"Could not save update state: {str(e)}")
+
+    def fetch(self, url, dest_path, conditional=None, sha256=None):
+        """
+        Downloads url to dest_path unless the server answers 304 Not Modified.
+        Requests are conditional when dest_path exists, unless conditional says
+        otherwise. A known sha256 skips files that already match it and lets
+        peers serve it without asking the origin. Returns True if a new copy was written.
+        """
+        meta = self.state["urls"].get(url, {})
+        headers = {}
+        if conditional is None:
+            conditional = os.path.exists(dest_path)
+        if sha256 and conditional and os.path.exists(dest_path) and hash_file(dest_path) == sha256:
+            return False
+        if conditional:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        if self.peers:
+            validators = {}
+            if not sha256:
+                # Only the headers come from the origin, they tell which copy the peers must have
+                r = requests.head(url, headers=headers, timeout=self.timeout, allow_redirects=True)
+                if r.status_code == 304:
+                    meta["checked"] = time.time()
+                    self.state["urls"][url] = meta
+                    return False
+                if r.ok:
+                    validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+            if sha256 or any(validators.values()):
+                found, peers = self.peers.locate(sha256, url, **validators)
+                peer = self.peers.download(found, peers, dest_path) if found else None
+                if peer:
+                    logging.info(f"Fetched {os.path.basename(dest_path)} from peer {peer}")
+                    self.state["urls"][url] = dict(validators, size=os.path.getsize(dest_path), checked=time.time(),
+                                                   peer=peer)
+                    self._keep(dest_path, url)
+                    return True
+
+        with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304:
+                meta["checked"] = time.time()
+                self.state["urls"][url] = meta
+                return False
+            r.raise_for_status()
+            part_path = dest_path + ".part"
+            size = 0
+            with open(part_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=8192):
+                    if chunk:
+                        self.limiter.consume(len(chunk))
+                        f.write(chunk)
+                        size += len(chunk)
+            os.replace(part_path, dest_path)
+            self.state["urls"][url] = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "size": size,
+                "checked": time.time(),
+            }
+        self._keep(dest_path, url)
+        return True
+
+    def _keep(self, path, url):
+        """Adds a fresh download to the peer store, if there is one."""
+        if not self.store:
+            return
+        meta = self.state["urls"].get(url, {})
+        try:
+            self.store.add(path, url, meta.get("etag"), meta.get("last_modified"))
+        except OSError as e:
+            logging.warning(f"Could not add {os.path.basename(path)} to the peer store: {str(e)}")
+
+    def update_manifest(self, manifest_url, dest_folder):
+        """
+        Fetches a manifest ({"artifacts": [{"name": ..., "url": ..., "sha256": optional}]}) and
+        downloads the artifacts that changed or are missing. Returns the updated paths.
+        """
+        manifest_path = os.path.join(dest_folder, "." + hashlib.sha256(manifest_url.encode()).hexdigest()[:16] + ".json")
+        self.fetch(manifest_url, manifest_path)
+        with open(manifest_path, "r") as f:
+            artifacts = json.load(f).get("artifacts", [])
+
+        updated = []
+        for artifact in artifacts:
+            name = os.path.basename(artifact["name"])
+            url = urljoin(manifest_url, artifact["url"])
+            path = os.path.join(dest_folder, name)
+            if self.fetch(url, path, sha256=artifact.get("sha256")):
+                updated.append(path)
+        return updated
+
+    def check(self, bundle_url, dest_folder, bundle_present=True, log=print):
+        """Checks the bundle and every manifest once; returns the list of updated files."""
+        os.makedirs(dest_folder, exist_ok=True)
+        updated = []
+        try:
+            rar_path = os.path.join(dest_folder, os.path.basename(urlparse(bundle_url).path))
+            # The archive is removed after extraction, so whether the extracted files exist decides
+            if self.fetch(bundle_url, rar_path, conditional=bundle_present):
+                log("New firmware bundle downloaded. Extracting files...")
+                try:
+                    extract_bundle(rar_path, dest_folder)
+                except Exception:
+                    # Forget the validators so the next check downloads the bundle again
+                    self.state["urls"].pop(bundle_url, None)
+                    raise
+                updated.append(bundle_url)
+            else:
+                log("Firmware bundle is up to date.")
+
+            for manifest_url in self.manifests:
+                paths = self.update_manifest(manifest_url, dest_folder)
+                for path in paths:
+                    log(f"Updated {os.path.basename(path)}")
+                updated.extend(paths)
+        finally:
+            self.save()
+        return updated
+
+PEER_PORT = 8766
+PEER_STORE_DIR = os.path.join(os.path.expanduser("~"), ".pico_revival_peer_store")
+PEER_TIMEOUT = 2.0  # Seconds a peer gets to answer before it is left out of a lookup
+PEER_CHUNK_SIZE = 64 * 1024
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class PeerStore:
+    """
+    What this station offers to its peers: downloaded artifacts (bundle archives,
+    manifest firmware) kept in directory under their SHA-256 along with the URL and
+    validators they came with, plus the firmware library files returned by files(),
+    which are served from where they are.
+    """
+    def __init__(self, directory=PEER_STORE_DIR, files=None):
+        self.directory = directory
+        self.files = files or (lambda: [])
+        self.meta_path = os.path.join(directory, "index.json")
+        self.meta = {}  # sha256 -> {"size", "name", "url", "etag", "last_modified"}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.meta_path, "r") as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def add(self, path, url=None, etag=None, last_modified=None):
+        """Keeps a copy of a downloaded file for peers and returns its SHA-256."""
+        sha256 = hash_file(path)
+        stored = os.path.join(self.directory, sha256)
+        if not os.path.exists(stored):
+            try:
+                os.link(path, stored)
+            except OSError:
+                shutil.copyfile(path, stored + ".tmp")
+                os.replace(stored + ".tmp", stored)
+        with self._lock:
+            self.meta[sha256] = {"size": os.path.getsize(stored), "name": os.path.basename(urlparse(url).path)
+                                 if url else os.path.basename(path),
+                                 "url": url, "etag": etag, "last_modified": last_modified}
+            with open(self.meta_path + ".tmp", "w") as f:
+                json.dump(self.meta, f, indent=1)
+            os.replace(self.meta_path + ".tmp", self.meta_path)
+        return sha256
+
+    def _library(self):
+        """(sha256, path, size) of every readable library file."""
+        for path in self.files():
+            try:
+                st = os.stat(path)
+                yield hash_file(path, st), path, st.st_size
+            except OSError:
+                continue
+
+    def objects(self):
+        """Index of everything this station can serve."""
+        with self._lock:
+            entries = {sha256: dict(meta, sha256=sha256) for sha256, meta in self.meta.items()
+                       if os.path.exists(os.path.join(self.directory, sha256))}
+        for sha256, path, size in self._library():
+            entries.setdefault(sha256, {"sha256": sha256, "size": size, "name": os.path.basename(path)})
+        return list(entries.values())
+
+    def path(self, sha256):
+        """Local file with the given SHA-256, or None."""
+        stored = os.path.join(self.directory, sha256)
+        if SHA256_RE.match(sha256) and os.path.exists(stored):
+            return stored
+        for digest, path, _ in self._library():
+            if digest == sha256:
+                return path
+        return None
+
+class PeerClient:
+    """
+    Fetches artifacts from other stations' peer caches. A lookup asks every peer for
+    its index at once; peers holding the wanted content are tried fastest first (by
+    the throughput of earlier transfers, else by how quickly they answered) and each
+    download must match the expected SHA-256 before it replaces the destination.
+    """
+    def __init__(self, peers, timeout=PEER_TIMEOUT):
+        self.peers = [peer if "://" in peer else f"http://{peer if ':' in peer else f'{peer}:{PEER_PORT}'}"
+                      for peer in peers]
+        self.timeout = timeout
+        self.speeds = {}  # peer -> bytes/s of its last transfer
+        self._lock = threading.Lock()
+
+    def indexes(self):
+        """Asks all peers for their index in parallel. Returns [(peer, response seconds, objects)]."""
+        results = []
+
+        def ask(peer):
+            start = time.monotonic()
+            try:
+                r = requests.get(f"{peer}/peer/v1/index", timeout=self.timeout)
+                r.raise_for_status()
+                objects = r.json()["objects"]
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logging.info(f"Peer {peer} unavailable: {str(e)}")
+                return
+            with self._lock:
+                results.append((peer, time.monotonic() - start, objects))
+
+        threads = [threading.Thread(target=ask, args=(peer,), daemon=True) for peer in self.peers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(self.timeout + 1)
+        with self._lock:
+            return list(results)
+
+    def locate(self, sha256=None, url=None, etag=None, last_modified=None):
+        """
+        Finds the content with sha256, or else the copy of url with the given validator.
+        Returns (sha256, peers fastest first), or (None, []) if no peer has it.
+        """
+        holders = []
+        for peer, elapsed, objects in self.indexes():
+            for entry in objects:
+                if sha256:
+                    match = entry.get("sha256") == sha256
+                else:
+                    match = url and entry.get("url") == url and (
+                        entry.get("etag") == etag if etag else last_modified and entry.get("last_modified") == last_modified)
+                if match:
+                    holders.append((peer, elapsed, entry["sha256"]))
+                    break
+        if not holders:
+            return None, []
+        # Peers that disagree on the content of url are outvoted
+        wanted = sha256 or max({h[2] for h in holders}, key=lambda digest: sum(h[2] == digest for h in holders))
+        holders = [h for h in holders if h[2] == wanted]
+        holders.sort(key=lambda h: (h[0] not in self.speeds, -self.speeds.get(h[0], 0), h[1]))
+        return wanted, [h[0] for h in holders]
+
+    def download(self, sha256, peers, dest_path):
+        """Downloads sha256 from the first peer that delivers it intact. Returns that peer or None."""
+        part_path = dest_path + ".part"
+        for peer in peers:
+            start = time.monotonic()
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with requests.get(f"{peer}/peer/v1/objects/{sha256}", stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    with open(part_path, "wb") as f:
+                        for chunk in r.iter_content(chunk_size=PEER_CHUNK_SIZE):
+                            digest.update(chunk)
+                            f.write(chunk)
+                            size += len(chunk)
+            except (requests.exceptions.RequestException, OSError) as e:
+                logging.info(f"Download of {sha256[:12]} from peer {peer} failed: {str(e)}")
+                continue
+            if digest.hexdigest() != sha256:
+                logging.warning(f"Peer {peer} sent {sha256[:12]} with the wrong hash, discarded")
+                continue
+            os.replace(part_path, dest_path)
+            with self._lock:
+                self.speeds[peer] = size / max(time.monotonic() - start, 1e-6)
+            return peer
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
+
 class DownloadWorker(threading.Thread):
     """Worker thread to download and extract the RAR file."""
-    def __init__(self, url, dest_folder, signals):
+    def __init__(self, url, dest_folder, signals, peers=None, store=None):
         super().__init__()
         self.url = url
         self.dest_folder = dest_folder
         self.signals = signals
+        self.peers = peers
+        self.store = store
 
     def run(self):
         try:
             self.signals.message.emit("Downloading TSTP-Pico_Revival package...")
             rar_path = os.path.join(self.dest_folder, "TSTP-Pico_Revival.rar")
             
-            # Download the file
-            r = requests.get(self.url, stream=True, timeout=30)
-            r.raise_for_status()
-            
-            with open(rar_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            # Download the file, remembering its ETag/Last-Modified for later update checks
+            checker = UpdateChecker(bandwidth_limit=0, peers=self.peers, store=self.store)
+            try:
+                checker.fetch(self.url, rar_path, conditional=False)
+            finally:
+                checker.save()
             
             self.signals.message.emit("Download complete. Extracting files...")
-
-            # Check if we can extract
-            if rarfile:
-                try:
-                    rf = rarfile.RarFile(rar_path)
-                    rf.extractall(self.dest_folder)
-                    rf.close()
-                    self.signals.message.emit("Extraction complete.")
-                except Exception as e:
-                    raise RuntimeError(f"Error extracting RAR file: {str(e)}")
-            else:
-                raise RuntimeError(
-                    "Cannot extract RAR file. The 'rarfile' module is not installed.\n"
-                    "Please install with 'pip install rarfile' or use an external tool."
-                )
-            
-            # Remove downloaded RAR to clean up
-            if os.path.exists(rar_path):
-                os.remove(rar_path)
+            extract_bundle(rar_path, self.dest_folder)
+            self.signals.message.emit("Extraction complete.")
 
             self.signals.finished.emit()
 
@@ -570,6 +1182,4088 @@ class DownloadWorker(threading.Thread):
         except Exception as e:
             self.signals.error.emit(str(e))
 
+# UF2 block layout (see https://github.com/microsoft/uf2)
+UF2_MAGIC_START0 = 0x0A324655
+UF2_MAGIC_START1 = 0x9E5D5157
+UF2_MAGIC_END = 0x0AB16F30
+UF2_BLOCK_SIZE = 512
+UF2_HEADER = struct.Struct("<8I")
+UF2_FLAG_NOT_MAIN_FLASH = 0x00000001
+UF2_FLAG_FAMILY_ID_PRESENT = 0x00002000
+
+UF2_FAMILIES = {
+    0xE48BFF56: "RP2040",
+    0xE48BFF57: "ABSOLUTE",
+    0xE48BFF58: "DATA",
+    0xE48BFF59: "RP2350-ARM-S",
+    0xE48BFF5A: "RP2350-RISCV",
+    0xE48BFF5B: "RP2350-ARM-NS",
+}
+
+class UF2Info:
+    """Summary of a UF2 image parsed from its block headers."""
+    def __init__(self):
+        self.block_count = 0
+        self.payload_bytes = 0
+        self.families = set()
+        self.flash_start = None
+        self.flash_end = None
+
+    @property
+    def family_names(self):
+        return sorted(UF2_FAMILIES.get(f, f"0x{f:08x}") for f in self.families)
+
+    def __repr__(self):
+        span = ""
+        if self.flash_start is not None:
+            span = f" 0x{self.flash_start:08x}-0x{self.flash_end:08x}"
+        return f"<UF2Info {self.block_count} blocks {'/'.join(self.family_names)}{span}>"
+
+def parse_uf2(data):
+    """Parse the block headers of a UF2 image. Raises ValueError if it is not a valid UF2."""
+    view = memoryview(data)
+    if len(view) == 0 or len(view) % UF2_BLOCK_SIZE:
+        raise ValueError(f"UF2 size {len(view)} is not a multiple of {UF2_BLOCK_SIZE} bytes")
+
+    info = UF2Info()
+    for offset in range(0, len(view), UF2_BLOCK_SIZE):
+        magic0, magic1, flags, addr, size, _block_no, _num_blocks, family = UF2_HEADER.unpack_from(view, offset)
+        magic_end = struct.unpack_from("<I", view, offset + UF2_BLOCK_SIZE - 4)[0]
+        if magic0 != UF2_MAGIC_START0 or magic1 != UF2_MAGIC_START1 or magic_end != UF2_MAGIC_END:
+            raise ValueError(f"Bad UF2 magic in block at offset {offset}")
+
+        info.block_count += 1
+        if flags & UF2_FLAG_NOT_MAIN_FLASH:
+            continue
+        info.payload_bytes += size
+        if flags & UF2_FLAG_FAMILY_ID_PRESENT:
+            info.families.add(family)
+        if info.flash_start is None or addr < info.flash_start:
+            info.flash_start = addr
+        if info.flash_end is None or addr + size > info.flash_end:
+            info.flash_end = addr + size
+    return info
+
+def uf2_block(addr, payload, block_no, num_blocks, family=None, flags=0):
+    """Builds one 512-byte UF2 block carrying up to 476 payload bytes (256 for RP2 flash)."""
+    if family is not None:
+        flags |= UF2_FLAG_FAMILY_ID_PRESENT
+    header = UF2_HEADER.pack(UF2_MAGIC_START0, UF2_MAGIC_START1, flags, addr, len(payload),
+                             block_no, num_blocks, family or 0)
+    return header + bytes(payload) + bytes(476 - len(payload)) + struct.pack("<I", UF2_MAGIC_END)
+
+def uf2_block_index(data):
+    """Maps the target address of every main-flash block to its block number."""
+    view = memoryview(data)
+    index = {}
+    for offset in range(0, len(view), UF2_BLOCK_SIZE):
+        _, _, flags, addr, _, _, _, _ = UF2_HEADER.unpack_from(view, offset)
+        if not flags & UF2_FLAG_NOT_MAIN_FLASH:
+            index[addr] = offset // UF2_BLOCK_SIZE
+    return index
+
+class PersonalizedImage:
+    """
+    Copy-on-write view of a UF2 image: the base buffer is shared untouched,
+    only patched blocks are copied, and extra blocks are appended at the end.
+    When blocks are appended every header is renumbered while streaming.
+    """
+    def __init__(self, base, patched, appended):
+        self.base = memoryview(base)
+        self.patched = patched  # block number -> bytes
+        self.appended = appended
+        self.base_blocks = len(self.base) // UF2_BLOCK_SIZE
+        self.num_blocks = self.base_blocks + len(appended)
+
+    def __len__(self):
+        return self.num_blocks * UF2_BLOCK_SIZE
+
+    def _renumbered(self, block):
+        return block[:24] + struct.pack("<I", self.num_blocks) + block[28:]
+
+    def iter_chunks(self, chunk_size=64 * 1024):
+        """Yields the image as buffers, sharing unmodified runs of the base image."""
+        renumber = bool(self.appended)
+        run_start = 0
+        for block_no in sorted(self.patched) + [self.base_blocks]:
+            if not renumber:
+                # Unpatched blocks between patches go out as slices of the base buffer
+                run_end = block_no * UF2_BLOCK_SIZE
+                for offset in range(run_start, run_end, chunk_size):
+                    yield self.base[offset:min(offset + chunk_size, run_end)]
+            else:
+                for other in range(run_start // UF2_BLOCK_SIZE, block_no):
+                    offset = other * UF2_BLOCK_SIZE
+                    yield self.base[offset:offset + 24]
+                    yield struct.pack("<I", self.num_blocks)
+                    yield self.base[offset + 28:offset + UF2_BLOCK_SIZE]
+            if block_no < self.base_blocks:
+                block = self.patched[block_no]
+                yield self._renumbered(block) if renumber else block
+            run_start = (block_no + 1) * UF2_BLOCK_SIZE
+        for i, block in enumerate(self.appended):
+            yield block[:20] + struct.pack("<II", self.base_blocks + i, self.num_blocks) + block[28:]
+
+    def tobytes(self):
+        return b"".join(bytes(chunk) for chunk in self.iter_chunks())
+
+    def sha256(self):
+        h = hashlib.sha256()
+        for chunk in self.iter_chunks():
+            h.update(chunk)
+        return h.hexdigest()
+
+def personalize_uf2(base, patches, block_index=None, family=None):
+    """
+    Applies per-device data to a UF2 image without copying it. patches is a
+    list of (flash address, bytes). Pages already in the image have their
+    256-byte payload patched; other pages are appended as new blocks, padded
+    with 0xFF. Returns a PersonalizedImage ready for write_image.
+    """
+    view = memoryview(base)
+    block_index = block_index if block_index is not None else uf2_block_index(view)
+    patched = {}
+    new_pages = {}
+
+    if family is None:
+        for offset in range(0, len(view), UF2_BLOCK_SIZE):
+            _, _, flags, _, _, _, _, block_family = UF2_HEADER.unpack_from(view, offset)
+            if flags & UF2_FLAG_FAMILY_ID_PRESENT:
+                family = block_family
+                break
+
+    for address, data in patches:
+        position = 0
+        while position < len(data):
+            page = (address + position) & ~0xFF
+            start = (address + position) - page
+            count = min(256 - start, len(data) - position)
+            piece = data[position:position + count]
+            block_no = block_index.get(page)
+            if block_no is not None:
+                block = patched.get(block_no)
+                if block is None:
+                    block = bytearray(view[block_no * UF2_BLOCK_SIZE:(block_no + 1) * UF2_BLOCK_SIZE])
+                    patched[block_no] = block
+                block[32 + start:32 + start + count] = piece
+            else:
+                payload = new_pages.setdefault(page, bytearray(b"\xff" * 256))
+                payload[start:start + count] = piece
+            position += count
+
+    appended = [uf2_block(page, payload, 0, 0, family) for page, payload in sorted(new_pages.items())]
+    return PersonalizedImage(view, {n: bytes(b) for n, b in patched.items()}, appended)
+
+def _parse_patch(entry):
+    address = entry["address"]
+    address = int(address, 0) if isinstance(address, str) else int(address)
+    if "hex" in entry:
+        data = bytes.fromhex(entry["hex"])
+    else:
+        data = entry["text"].encode()
+    return address, data
+
+class PersonalizationRecords:
+    """
+    Per-device data records loaded from a JSON list such as
+    [{"id": "SN0001", "address": "0x101FF000", "text": "serial=SN0001"}, ...]
+    (or "hex" instead of "text", or a "patches" list of those). Each record is
+    handed out once; used ids are appended to <file>.used so they survive restarts.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.used_path = path + ".used"
+        used = set()
+        if os.path.exists(self.used_path):
+            with open(self.used_path) as f:
+                used = {line.strip() for line in f if line.strip()}
+        with open(path) as f:
+            entries = json.load(f)
+        self._records = []
+        for entry in entries:
+            record_id = str(entry["id"])
+            if record_id in used:
+                continue
+            patches = [_parse_patch(p) for p in entry.get("patches", [entry])]
+            self._records.append({"id": record_id, "patches": patches})
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        with self._lock:
+            return len(self._records)
+
+    def take(self, count):
+        """Removes and returns the next `count` records, or raises if there are not enough left."""
+        with self._lock:
+            if count > len(self._records):
+                raise RuntimeError(f"Not enough personalization records: {count} needed, {len(self._records)} left")
+            taken, self._records = self._records[:count], self._records[count:]
+            with open(self.used_path, "a") as f:
+                for record in taken:
+                    f.write(record["id"] + "\n")
+            return taken
+
+    def assign(self, jobs):
+        """
+        Hands each job the next record. Records are burned once taken, so call this last,
+        when nothing can abort the batch any more.
+        """
+        for job, record in zip(jobs, self.take(len(jobs))):
+            job.personalization = record["patches"]
+            job.personalization_id = record["id"]
+
+_block_indexes = OrderedDict()
+_block_indexes_lock = threading.Lock()
+
+def cached_block_index(sha256, data):
+    """Returns uf2_block_index(data), reusing it for images with the same hash."""
+    with _block_indexes_lock:
+        index = _block_indexes.get(sha256)
+        if index is not None:
+            _block_indexes.move_to_end(sha256)
+            return index
+    index = uf2_block_index(data)
+    with _block_indexes_lock:
+        _block_indexes[sha256] = index
+        while len(_block_indexes) > 4:
+            _block_indexes.popitem(last=False)
+    return index
+
+UF2_PAGE_SIZE = 256
+RP2_FLASH_BASE = 0x10000000
+FIRMWARE_FILE_TYPES = (".uf2", ".bin", ".hex", ".elf")
+FAMILY_IDS = {name: family for family, name in UF2_FAMILIES.items()}
+
+def _page_runs(segments):
+    """
+    Splits (address, data) segments into runs of whole 256-byte pages. Aligned
+    middles stay views of the input; unaligned edges are copied into 0xFF-padded pages.
+    Returns sorted [(address, buffer)] with len(buffer) a multiple of 256.
+    """
+    runs = []
+    edge_pages = {}
+    for address, data in segments:
+        view = memoryview(data)
+        end = address + len(view)
+        aligned_start = (address + UF2_PAGE_SIZE - 1) & ~(UF2_PAGE_SIZE - 1)
+        aligned_end = end & ~(UF2_PAGE_SIZE - 1)
+        if aligned_end > aligned_start:
+            runs.append((aligned_start, view[aligned_start - address:aligned_end - address]))
+            edges = [(address, aligned_start), (aligned_end, end)]
+        else:
+            edges = [(address, end)]
+        for start, stop in edges:
+            while start < stop:
+                page = start & ~(UF2_PAGE_SIZE - 1)
+                count = min(page + UF2_PAGE_SIZE, stop) - start
+                payload = edge_pages.setdefault(page, bytearray(b"\xff" * UF2_PAGE_SIZE))
+                payload[start - page:start - page + count] = view[start - address:start - address + count]
+                start += count
+    runs.extend(edge_pages.items())
+    runs.sort(key=lambda run: run[0])
+    return runs
+
+class Uf2Stream:
+    """
+    UF2 image generated on the fly from raw segments. Behaves like a buffer for
+    write_image (len + iter_chunks) so it can go straight to a drive, or be
+    materialized with tobytes() for the firmware cache.
+    """
+    def __init__(self, segments, family=FAMILY_IDS["RP2040"]):
+        self.family = family
+        self.runs = _page_runs(segments)
+        self.num_blocks = sum(len(data) // UF2_PAGE_SIZE for _, data in self.runs)
+
+    def __len__(self):
+        return self.num_blocks * UF2_BLOCK_SIZE
+
+    def _blocks(self, address, data, first_block):
+        """Builds the blocks for one run; headers are filled with strided array writes."""
+        count = len(data) // UF2_PAGE_SIZE
+        words = array("I", bytes(count * UF2_BLOCK_SIZE))
+        words[0::128] = array("I", [UF2_MAGIC_START0]) * count
+        words[1::128] = array("I", [UF2_MAGIC_START1]) * count
+        words[2::128] = array("I", [UF2_FLAG_FAMILY_ID_PRESENT]) * count
+        words[3::128] = array("I", range(address, address + count * UF2_PAGE_SIZE, UF2_PAGE_SIZE))
+        words[4::128] = array("I", [UF2_PAGE_SIZE]) * count
+        words[5::128] = array("I", range(first_block, first_block + count))
+        words[6::128] = array("I", [self.num_blocks]) * count
+        words[7::128] = array("I", [self.family]) * count
+        words[127::128] = array("I", [UF2_MAGIC_END]) * count
+        if sys.byteorder != "little":
+            words.byteswap()
+        out = memoryview(words).cast("B")
+        source = memoryview(data)
+        for i in range(count):
+            out[i * UF2_BLOCK_SIZE + 32:i * UF2_BLOCK_SIZE + 32 + UF2_PAGE_SIZE] = \
+                source[i * UF2_PAGE_SIZE:(i + 1) * UF2_PAGE_SIZE]
+        return out
+
+    def iter_chunks(self, chunk_size=64 * 1024):
+        pages_per_chunk = max(chunk_size // UF2_BLOCK_SIZE, 1)
+        block = 0
+        for address, data in self.runs:
+            view = memoryview(data)
+            for start in range(0, len(view), pages_per_chunk * UF2_PAGE_SIZE):
+                part = view[start:start + pages_per_chunk * UF2_PAGE_SIZE]
+                yield self._blocks(address + start, part, block)
+                block += len(part) // UF2_PAGE_SIZE
+
+    def tobytes(self):
+        return b"".join(self.iter_chunks(4 * 1024 * 1024))
+
+def read_bin_segments(path, base_address=RP2_FLASH_BASE):
+    with open(path, "rb") as f:
+        return [(base_address, f.read())]
+
+def read_hex_segments(path):
+    """Parses an Intel HEX file into contiguous (address, bytes) segments."""
+    segments = []
+    current_start = None
+    current = bytearray()
+    upper = 0
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(":"):
+                raise ValueError(f"Line {line_no}: not an Intel HEX record")
+            record = bytes.fromhex(line[1:])
+            if sum(record) & 0xFF:
+                raise ValueError(f"Line {line_no}: bad checksum")
+            length, offset, kind = record[0], (record[1] << 8) | record[2], record[3]
+            data = record[4:4 + length]
+            if kind == 0x00:
+                address = upper + offset
+                if current_start is not None and address == current_start + len(current):
+                    current += data
+                else:
+                    if current:
+                        segments.append((current_start, bytes(current)))
+                    current_start = address
+                    current = bytearray(data)
+            elif kind == 0x01:
+                break
+            elif kind == 0x02:
+                upper = int.from_bytes(data, "big") << 4
+            elif kind == 0x04:
+                upper = int.from_bytes(data, "big") << 16
+    if current:
+        segments.append((current_start, bytes(current)))
+    return segments
+
+def read_elf_segments(path):
+    """Returns the loadable segments of a 32-bit little-endian ELF at their physical (load) addresses."""
+    with open(path, "rb") as f:
+        header = f.read(52)
+        if header[:4] != b"\x7fELF":
+            raise ValueError("Not an ELF file")
+        if header[4] != 1 or header[5] != 1:
+            raise ValueError("Only 32-bit little-endian ELF files are supported")
+        phoff, = struct.unpack_from("<I", header, 28)
+        phentsize, phnum = struct.unpack_from("<HH", header, 42)
+        segments = []
+        for i in range(phnum):
+            f.seek(phoff + i * phentsize)
+            p_type, p_offset, _vaddr, p_paddr, p_filesz = struct.unpack("<5I", f.read(20))
+            if p_type != 1 or p_filesz == 0:  # PT_LOAD with file contents only
+                continue
+            f.seek(p_offset)
+            segments.append((p_paddr, f.read(p_filesz)))
+    return segments
+
+def convert_to_uf2(path, family=None, base_address=None):
+    """Converts a .bin, .hex or .elf file into a Uf2Stream for the given family (default RP2040)."""
+    family = FAMILY_IDS["RP2040"] if family is None else family
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".bin":
+        segments = read_bin_segments(path, RP2_FLASH_BASE if base_address is None else base_address)
+    elif ext == ".hex":
+        segments = read_hex_segments(path)
+    elif ext == ".elf":
+        segments = read_elf_segments(path)
+    else:
+        raise ValueError(f"Unsupported firmware file type: {ext}")
+    if not segments:
+        raise ValueError(f"{os.path.basename(path)} contains no data to flash")
+    return Uf2Stream(segments, family)
+
+COMPRESSED_SUFFIXES = (".zst", ".xz")
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+def firmware_name(path):
+    """Returns the file name of a firmware image without its compression suffix."""
+    name = os.path.basename(path)
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def compression_method(path):
+    lowered = path.lower()
+    if lowered.endswith(".zst"):
+        return "zstd"
+    if lowered.endswith(".xz"):
+        return "xz"
+    return None
+
+def open_firmware(path, method=None):
+    """Opens a firmware file for reading, decompressing .zst and .xz files as a stream."""
+    method = method or compression_method(path)
+    if method == "zstd":
+        if not zstandard:
+            raise RuntimeError(f"Cannot read {os.path.basename(path)}: the 'zstandard' module is not installed.")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    if method == "xz":
+        return lzma.open(path, "rb")
+    return open(path, "rb")
+
+def iter_firmware_chunks(path, method=None, chunk_size=DECOMPRESS_CHUNK_SIZE):
+    """Yields the (decompressed) contents of a firmware file in chunks."""
+    with open_firmware(path, method) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+def read_firmware(path):
+    """Reads a whole firmware image, decompressing it chunk by chunk."""
+    if not compression_method(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return b"".join(iter_firmware_chunks(path))
+
+def compress_firmware(path, method=None, level=None):
+    """
+    Compresses a .uf2 file next to itself with zstd (or lzma if zstandard is missing),
+    verifies the round trip and removes the original. Returns the compressed path.
+    """
+    method = method or ("zstd" if zstandard else "xz")
+    if method == "zstd" and not zstandard:
+        raise RuntimeError("The 'zstandard' module is not installed.")
+    dest = path + (".zst" if method == "zstd" else ".xz")
+    part = dest + ".part"
+    digest = hashlib.sha256()
+    with open(path, "rb") as src, open(part, "wb") as raw:
+        if method == "zstd":
+            size = os.fstat(src.fileno()).st_size
+            out = zstandard.ZstdCompressor(level=level or 19).stream_writer(raw, size=size, closefd=False)
+        else:
+            out = lzma.open(raw, "wb", preset=6 if level is None else level)
+        with out:
+            for chunk in iter(lambda: src.read(DECOMPRESS_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+
+    check = hashlib.sha256()
+    for chunk in iter_firmware_chunks(part, method):
+        check.update(chunk)
+    if check.digest() != digest.digest():
+        os.remove(part)
+        raise RuntimeError(f"Compressed copy of {os.path.basename(path)} does not match the original")
+    os.replace(part, dest)
+    shutil.copystat(path, dest)
+    os.remove(path)
+    return dest
+
+def benchmark_decompression(path, repeat=3):
+    """Returns the best decompression throughput of a firmware file in bytes per second."""
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = sum(len(chunk) for chunk in iter_firmware_chunks(path))
+        best = max(best, size / max(time.perf_counter() - start, 1e-9))
+    return best
+
+class FirmwareImage:
+    """An immutable in-memory copy of a firmware file plus its hash and UF2 metadata."""
+    def __init__(self, path, data, mtime_ns, source_size=None):
+        self.path = path
+        self.data = bytes(data)
+        self.size = len(self.data)
+        self.mtime_ns = mtime_ns
+        # Converted images are larger than the .bin/.hex/.elf they came from
+        self.source_size = self.size if source_size is None else source_size
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        try:
+            self.info = parse_uf2(self.data)
+        except ValueError as e:
+            logging.warning(f"{os.path.basename(path)} is not a valid UF2 image: {str(e)}")
+            self.info = None
+
+    def view(self):
+        """Returns a read-only zero-copy view of the image bytes."""
+        return memoryview(self.data)
+
+    def describe(self):
+        families = "/".join(self.info.family_names) if self.info and self.info.families else "unknown family"
+        return f"{self.size / 1024:.0f} KB, {families}, sha256 {self.sha256[:12]}"
+
+class FirmwareCache:
+    """
+    Thread-safe LRU cache of firmware images keyed by path.
+    Entries are invalidated when the file's size or mtime changes and the
+    least recently used images are evicted once max_bytes is exceeded.
+    Non-UF2 files are converted once and cached per family/base address.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._path_locks = {}
+
+    def get(self, path, family=None, base_address=None):
+        """Returns the FirmwareImage for path, loading it from disk only if it changed."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        convert = os.path.splitext(firmware_name(path))[1].lower() != ".uf2"
+        key = (path, family, base_address) if convert else path
+
+        image = self._lookup(key, st)
+        if image:
+            return image
+
+        # Serialize loads of the same file so parallel jobs read it only once
+        with self._lock:
+            path_lock = self._path_locks.setdefault(key, threading.Lock())
+        with path_lock:
+            image = self._lookup(key, st)
+            if image:
+                return image
+            with self._lock:
+                self.misses += 1
+            if convert:
+                start = time.monotonic()
+                data = convert_to_uf2(path, family, base_address).tobytes()
+                image = FirmwareImage(path, data, st.st_mtime_ns, st.st_size)
+                logging.info(f"Converted {os.path.basename(path)} to UF2 in {time.monotonic() - start:.2f}s")
+            elif compression_method(path):
+                start = time.monotonic()
+                image = FirmwareImage(path, read_firmware(path), st.st_mtime_ns, st.st_size)
+                logging.info(f"Decompressed {os.path.basename(path)} in {time.monotonic() - start:.2f}s")
+            else:
+                with open(path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    image = FirmwareImage(path, f.read(), st.st_mtime_ns)
+            self._store(key, image)
+            return image
+
+    def _lookup(self, key, st):
+        with self._lock:
+            image = self._entries.get(key)
+            if image and image.source_size == st.st_size and image.mtime_ns == st.st_mtime_ns:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            return None
+
+    def _store(self, key, image):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.total_bytes -= old.size
+            if image.size > self.max_bytes:
+                logging.info(f"Firmware {os.path.basename(image.path)} exceeds cache limit, not cached")
+                return
+            self._entries[key] = image
+            self.total_bytes += image.size
+            # Evicted images stay alive for as long as a writer still holds a view
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+                logging.info(f"Evicted {os.path.basename(evicted.path)} from firmware cache")
+
+    def invalidate(self, path=None):
+        """Drops one cached image, or all of them if no path is given."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self.total_bytes = 0
+                return
+            path = os.path.abspath(path)
+            for key in [k for k, image in self._entries.items() if image.path == path]:
+                self.total_bytes -= self._entries.pop(key).size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+FIRMWARE_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".pico_revival_index.json")
+FIRMWARE_VERSION_RE = re.compile(
+    rb"(?:Adafruit CircuitPython|MicroPython) v?\d+\.\d+[\w.+-]*(?: on \d{4}-\d{2}-\d{2})?"
+    rb"|(?:pico-sdk|Pico SDK) v?\d+\.\d+\.\d+")
+
+def uf2_payload(data):
+    """Concatenates the payloads of a UF2 image's blocks so strings split across blocks can be found."""
+    view = memoryview(data)
+    parts = []
+    for offset in range(0, len(view), UF2_BLOCK_SIZE):
+        size = struct.unpack_from("<I", view, offset + 16)[0]
+        parts.append(view[offset + 32:offset + 32 + min(size, UF2_BLOCK_SIZE - 36)])
+    return b"".join(parts)
+
+def firmware_kind(name, version):
+    """Classifies an indexed image as micropython, circuitpython, nuke or custom."""
+    lowered = name.lower()
+    if "nuke" in lowered:
+        return "nuke"
+    if (version and "CircuitPython" in version) or "circuitpython" in lowered:
+        return "circuitpython"
+    if (version and "MicroPython" in version) or "micropython" in lowered or lowered.startswith("rpi_pico"):
+        return "micropython"
+    return "custom"
+
+class FirmwareIndex:
+    """
+    Persistent index of the UF2 images found in a set of library directories.
+    Entries are keyed by path and only re-read when a file's size or mtime changes.
+    """
+    def __init__(self, path=FIRMWARE_INDEX_FILE, directories=None, max_depth=3):
+        self.path = path
+        self.directories = list(directories or [])
+        self.max_depth = max_depth
+        self.entries = {}
+        self._rejected = {}  # Files that are not valid UF2 images, with their (size, mtime)
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.entries = {entry["path"]: entry for entry in saved.get("entries", [])}
+        for directory in saved.get("directories", []):
+            if directory not in self.directories:
+                self.directories.append(directory)
+
+    def save(self):
+        with self._lock:
+            saved = {"directories": self.directories, "entries": list(self.entries.values())}
+        try:
+            with open(self.path, "w") as f:
+                json.dump(saved, f, indent=1)
+        except OSError as e:
+            logging.warning(f"Could not save firmware index: {str(e)}")
+
+    def add_directory(self, directory):
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if directory in self.directories:
+                return False
+            self.directories.append(directory)
+        self.save()
+        return True
+
+    def _read_entry(self, path, st):
+        data = read_firmware(path)
+        info = parse_uf2(data)
+        match = FIRMWARE_VERSION_RE.search(uf2_payload(data))
+        version = match.group().decode("ascii", "replace") if match else None
+        name = firmware_name(path)
+        return {
+            "path": path, "name": name, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "image_size": len(data), "compression": compression_method(path), "blocks": info.block_count, "families": info.family_names,
+            "flash_start": info.flash_start, "flash_end": info.flash_end,
+            "version": version, "kind": firmware_kind(name, version),
+        }
+
+    def _walk(self, directory, depth, seen_dirs):
+        """Yields (path, stat) for every .uf2 file below directory using os.scandir."""
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            return
+        seen_dirs.append(directory)
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < self.max_depth and not entry.name.startswith((".", "__")):
+                        yield from self._walk(entry.path, depth + 1, seen_dirs)
+                elif firmware_name(entry.name).lower().endswith(".uf2"):
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+    def scan(self, directories=None):
+        """
+        Rescans directories (default: all configured ones), re-reading only new or changed
+        files. Returns (changed, scanned_directories).
+        """
+        roots = [os.path.abspath(d) for d in (directories or self.directories)]
+        seen_dirs = []
+        found = {}
+        changed = 0
+        for root in roots:
+            for path, st in self._walk(root, 0, seen_dirs):
+                with self._lock:
+                    entry = self.entries.get(path)
+                if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                    found[path] = entry
+                    continue
+                if self._rejected.get(path) == (st.st_size, st.st_mtime_ns):
+                    continue
+                try:
+                    found[path] = self._read_entry(path, st)
+                    changed += 1
+                except (OSError, ValueError, RuntimeError, lzma.LZMAError) as e:
+                    self._rejected[path] = (st.st_size, st.st_mtime_ns)
+                    logging.info(f"Skipping {path}: {str(e)}")
+
+        with self._lock:
+            for path in list(self.entries):
+                if path not in found and any(path.startswith(os.path.join(root, "")) for root in roots):
+                    del self.entries[path]
+                    changed += 1
+            self.entries.update(found)
+        if changed:
+            self.save()
+        return changed, seen_dirs
+
+    def images(self, kind=None):
+        """Returns indexed entries, optionally of one kind, newest first."""
+        with self._lock:
+            entries = [e for e in self.entries.values() if kind is None or e["kind"] == kind]
+        return sorted(entries, key=lambda e: e["mtime_ns"], reverse=True)
+
+    def find(self, name):
+        """Returns the newest indexed entry whose file name is name, or None."""
+        for entry in self.images():
+            if entry["name"] == name:
+                return entry
+        return None
+
+def describe_index_entry(entry):
+    families = "/".join(entry["families"]) or "unknown family"
+    version = entry["version"] or "unknown version"
+    size = entry.get("image_size", entry["size"])
+    compressed = f", {entry['compression']}" if entry.get("compression") else ""
+    return f"{entry['name']} ({version}, {families}, {size / 1024:.0f} KB{compressed})"
+
+def iter_image_chunks(image, chunk_size=64 * 1024):
+    """Yields a firmware buffer (or a PersonalizedImage) as zero-copy chunks."""
+    if hasattr(image, "iter_chunks"):
+        yield from image.iter_chunks(chunk_size)
+        return
+    view = memoryview(image)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+def write_image(view, dest_path, chunk_size=64 * 1024, progress=None, cancel=None):
+    """
+    Writes a firmware buffer to dest_path in chunks without copying it. Returns bytes written.
+    Stops with RuntimeError between chunks once the cancel event is set.
+    """
+    written = 0
+    if cancel is not None and cancel.is_set():
+        raise RuntimeError(f"Write to {dest_path} cancelled")
+    with open(dest_path, "wb") as f:
+        for chunk in iter_image_chunks(view, chunk_size):
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError(f"Write to {dest_path} cancelled")
+            f.write(chunk)
+            written += len(chunk)
+            if progress:
+                progress(written)
+        f.flush()
+        try:
+            os.fsync(f.fileno())
+        except OSError:
+            # The bootloader may already be rebooting once the last block lands
+            pass
+    return written
+
+class DeviceWatchdog:
+    """
+    Runs blocking device I/O on a helper thread and gives up on it when it stops
+    making progress. An OS-level write to a board that vanished cannot be
+    interrupted, so the helper thread is abandoned (and told to stop between
+    chunks) while the caller fails fast and releases its hub slot. The drive is
+    refused new work until the abandoned operation returns.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stuck = {}  # thread -> {"drive", "operation", "since"}
+
+    def check(self, drive):
+        """Raises RuntimeError if an earlier operation on drive is still hung."""
+        with self._lock:
+            stuck = [s for s in self._stuck.values() if s["drive"] == drive]
+        if stuck:
+            age = time.monotonic() - stuck[0]["since"]
+            raise RuntimeError(f"{stuck[0]['operation']} on {drive} has been stuck for {age:.0f}s, "
+                               f"please reconnect the device")
+
+    def stuck(self):
+        with self._lock:
+            return [dict(s, age=time.monotonic() - s["since"]) for s in self._stuck.values()]
+
+    def run(self, drive, operation, func, stall_timeout=None, deadline=None):
+        """
+        Calls func(tick, cancel) on a helper thread. func calls tick() whenever it makes
+        progress and should stop once cancel is set. Raises RuntimeError if no tick
+        arrives for stall_timeout seconds or the whole call exceeds deadline.
+        """
+        cond = threading.Condition()
+        state = {"last": time.monotonic(), "done": False, "result": None, "error": None}
+        cancel = threading.Event()
+
+        def tick():
+            state["last"] = time.monotonic()
+
+        def target():
+            try:
+                state["result"] = func(tick, cancel)
+            except BaseException as e:
+                state["error"] = e
+            finally:
+                with cond:
+                    state["done"] = True
+                    cond.notify_all()
+                with self._lock:
+                    if self._stuck.pop(threading.current_thread(), None):
+                        logging.info(f"Stuck {operation} on {drive} returned after being abandoned")
+
+        thread = threading.Thread(target=target, name=f"{operation} {drive}", daemon=True)
+        started = time.monotonic()
+        thread.start()
+        with cond:
+            while not state["done"]:
+                now = time.monotonic()
+                waits = [0.5]
+                if stall_timeout is not None:
+                    idle = now - state["last"]
+                    if idle >= stall_timeout:
+                        self._abandon(thread, drive, operation, cancel)
+                        raise RuntimeError(f"{operation} on {drive} stalled with no progress for "
+                                           f"{idle:.0f}s, device marked as failed")
+                    waits.append(stall_timeout - idle)
+                if deadline is not None:
+                    if now - started >= deadline:
+                        self._abandon(thread, drive, operation, cancel)
+                        raise RuntimeError(f"{operation} on {drive} did not finish within {deadline:.0f}s, "
+                                           f"device marked as failed")
+                    waits.append(deadline - (now - started))
+                cond.wait(max(min(waits), 0.01))
+        if state["error"]:
+            raise state["error"]
+        return state["result"]
+
+    def _abandon(self, thread, drive, operation, cancel):
+        cancel.set()
+        with self._lock:
+            self._stuck[thread] = {"drive": drive, "operation": operation, "since": time.monotonic()}
+        logging.error(f"Abandoning stuck {operation} on {drive}")
+
+# One per process; flashing worker processes each get their own
+DEVICE_WATCHDOG = DeviceWatchdog()
+
+REMOVABLE_FILESYSTEMS = ("vfat", "msdos", "exfat")
+
+def _linux_mounts():
+    """Returns (device, mount point) pairs for FAT filesystems from /proc/mounts."""
+    mounts = []
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[2] in REMOVABLE_FILESYSTEMS:
+                    mount_point = fields[1].replace("\\040", " ")
+                    mounts.append((fields[0], mount_point))
+    except OSError:
+        pass
+    return mounts
+
+def _linux_label(device):
+    """Looks up the filesystem label of a block device through /dev/disk/by-label."""
+    by_label = "/dev/disk/by-label"
+    try:
+        device = os.path.realpath(device)
+        for label in os.listdir(by_label):
+            if os.path.realpath(os.path.join(by_label, label)) == device:
+                return label.encode().decode("unicode_escape")
+    except OSError:
+        pass
+    return None
+
+def get_available_drives():
+    """Returns a list of available drives (drive letters on Windows, FAT mount points on Linux)."""
+    if sys.platform == 'win32':
+        from ctypes import windll
+        drives = []
+        bitmask = windll.kernel32.GetLogicalDrives()
+        for letter in range(65, 91):
+            if bitmask & 1:
+                drives.append(chr(letter) + ":")
+            bitmask >>= 1
+        return drives
+    if sys.platform.startswith('linux'):
+        return [mount_point for _, mount_point in _linux_mounts()]
+    return []
+
+def get_volume_name(drive):
+    if sys.platform == 'win32':
+        import win32api
+        try:
+            return win32api.GetVolumeInformation(drive.rstrip("\\") + "\\")[0]
+        except:
+            return None
+    if sys.platform.startswith('linux'):
+        drive = os.path.normpath(drive)
+        for device, mount_point in _linux_mounts():
+            if mount_point == drive:
+                # udisks names the mount point after the label, use it if by-label is unavailable
+                return _linux_label(device) or os.path.basename(mount_point)
+    return None
+
+def find_drive(drives, name):
+    """Find a drive by volume name among the currently available drives."""
+    for drive in drives:
+        if get_volume_name(drive) == name:
+            return drive + os.sep
+    return None
+
+def find_drives(name):
+    """Returns every attached drive with the given volume name."""
+    return [drive + os.sep for drive in get_available_drives() if get_volume_name(drive) == name]
+
+def wait_for_volume(drive, name, timeout, poll=0.5):
+    """Polls until drive shows up with the given volume name. Returns False on timeout."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if get_volume_name(drive) == name:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll)
+
+USB_DEVICE_DIR = re.compile(r"^\d+-\d+(\.\d+)*$")
+USB_ROOT_HUB_DIR = re.compile(r"^usb\d+$")
+
+def usb_location_from_sysfs_path(path):
+    """
+    Returns (hub, port) of the USB device found in a sysfs device path, e.g.
+    .../usb1/1-1/1-1.2/1-1.2:1.0/host3/... -> ("1-1", "1-1.2"). Returns (None, None) if there is no USB device.
+    """
+    parts = path.split("/")
+    for i in range(len(parts) - 1, 0, -1):
+        if USB_DEVICE_DIR.match(parts[i]):
+            parent = parts[i - 1]
+            if USB_DEVICE_DIR.match(parent) or USB_ROOT_HUB_DIR.match(parent):
+                return parent, parts[i]
+            return None, parts[i]
+    return None, None
+
+def usb_port_key(location):
+    """Normalizes a USB port path such as "1-1.2" or a serial port location "1-1.2:1.0" for comparison."""
+    if not location:
+        return None
+    numbers = tuple(int(n) for n in re.findall(r"\d+", location.split(":")[0]))
+    return numbers or None
+
+USB_TOPOLOGY_TIMEOUT = 30  # Seconds the Windows topology query may take, PowerShell starts slowly
+
+# Walks from each USB disk up the PnP tree to its hub and prints
+# "E:|<hub instance id>|<location path of the nearest USB device>"
+WINDOWS_TOPOLOGY_SCRIPT = r"""
+Get-CimInstance Win32_DiskDrive | Where-Object InterfaceType -eq 'USB' | ForEach-Object {
+    $disk = $_
+    $id = $disk.PNPDeviceID
+    $hub = $null
+    $location = $null
+    for ($i = 0; $i -lt 6 -and -not $hub; $i++) {
+        $id = (Get-PnpDeviceProperty -InstanceId $id -KeyName DEVPKEY_Device_Parent).Data
+        if (-not $id) { break }
+        if (-not $location) {
+            $location = (Get-PnpDeviceProperty -InstanceId $id -KeyName DEVPKEY_Device_LocationPaths).Data |
+                Where-Object { $_ -match 'USBROOT' } | Select-Object -First 1
+        }
+        $service = (Get-PnpDeviceProperty -InstanceId $id -KeyName DEVPKEY_Device_Service).Data
+        if ($service -match '^usbhub') { $hub = $id }
+    }
+    Get-CimAssociatedInstance -InputObject $disk -ResultClassName Win32_DiskPartition | ForEach-Object {
+        Get-CimAssociatedInstance -InputObject $_ -ResultClassName Win32_LogicalDisk | ForEach-Object {
+            "$($_.DeviceID)|$hub|$location"
+        }
+    }
+}
+"""
+
+def windows_usb_port(location_path):
+    """
+    Turns a PnP location path such as "PCIROOT(0)#PCI(1400)#USBROOT(0)#USB(1)#USB(2)" into "1-1.2",
+    the same form pyserial reports as a serial port's location on Windows.
+    """
+    port = ""
+    for root, hop in re.findall(r"USBROOT\((\w+)\)|#USB\((\w+)\)", location_path or ""):
+        if root:
+            port = str(int(root) + 1)
+        elif port:
+            port += ("-" if "-" not in port else ".") + hop
+    return port if "-" in port else None
+
+class UsbTopology:
+    """Maps mounted drives to the USB hub and port they are attached through."""
+    def __init__(self):
+        self._devices = {}  # drive -> (hub, port)
+
+    def refresh(self):
+        try:
+            if sys.platform == 'win32':
+                self._devices = self._read_windows()
+            elif sys.platform.startswith('linux'):
+                self._devices = self._read_sysfs()
+        except Exception as e:
+            logging.warning(f"Could not read USB topology: {str(e)}")
+            self._devices = {}
+        return self._devices
+
+    def _lookup(self, drive):
+        if sys.platform == 'win32':
+            return self._devices.get(drive.rstrip("\\/").upper(), (None, None))
+        return self._devices.get(os.path.normpath(drive), (None, None))
+
+    def hub_for(self, drive):
+        """Returns the hub id for a drive, or None when the topology is unknown."""
+        return self._lookup(drive)[0]
+
+    def port_for(self, drive):
+        """Returns the USB port path (e.g. "1-1.2") of a drive, or None when it is unknown."""
+        return self._lookup(drive)[1]
+
+    def _read_sysfs(self):
+        devices = {}
+        for device, mount_point in _linux_mounts():
+            block = os.path.join("/sys/class/block", os.path.basename(os.path.realpath(device)))
+            if not os.path.exists(block):
+                continue
+            hub, port = usb_location_from_sysfs_path(os.path.realpath(block))
+            if hub or port:
+                devices[mount_point] = (hub, port)
+        return devices
+
+    def _read_windows(self):
+        output = subprocess.run(
+            ["powershell", "-NoProfile", "-NonInteractive", "-Command", WINDOWS_TOPOLOGY_SCRIPT],
+            capture_output=True, text=True, timeout=USB_TOPOLOGY_TIMEOUT,
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        ).stdout
+        devices = {}
+        for line in output.splitlines():
+            drive, hub, location = (line.strip().split("|") + ["", ""])[:3]
+            if drive and (hub or location):
+                devices[drive.upper()] = (hub or None, windows_usb_port(location))
+        return devices
+
+class HubScheduler:
+    """
+    Caps the number of concurrent device writes per upstream USB hub.
+    With a fixed limit every hub gets that many slots. Without one, each hub
+    starts at two slots and moves up or down depending on whether the measured
+    aggregate throughput improved at the higher concurrency level.
+    """
+    def __init__(self, limit=None, max_limit=8):
+        self.fixed_limit = limit
+        self.max_limit = max_limit
+        self._hubs = {}
+        self._cond = threading.Condition()
+
+    def _hub(self, hub):
+        state = self._hubs.get(hub)
+        if state is None:
+            state = self._hubs[hub] = {
+                "limit": self.fixed_limit or 2,
+                "active": 0,
+                "waiting": 0,
+                "peak": 0,
+                "writes": 0,
+                "bytes": 0,
+                "busy": 0.0,
+                "busy_since": None,
+                "first_use": time.monotonic(),
+                "level_throughput": {},
+            }
+        return state
+
+    @contextmanager
+    def slot(self, hub, nbytes):
+        """Holds a write slot on hub for the duration of the block. hub=None is never throttled."""
+        if hub is None:
+            yield
+            return
+        with self._cond:
+            state = self._hub(hub)
+            state["waiting"] += 1
+            while state["active"] >= state["limit"]:
+                self._cond.wait()
+            state["waiting"] -= 1
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            if state["busy_since"] is None:
+                state["busy_since"] = time.monotonic()
+            level = state["active"]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                state["active"] -= 1
+                if state["active"] == 0:
+                    state["busy"] += time.monotonic() - state["busy_since"]
+                    state["busy_since"] = None
+                state["writes"] += 1
+                state["bytes"] += nbytes
+                self._tune(state, level, nbytes, elapsed)
+                self._cond.notify_all()
+
+    def _tune(self, state, level, nbytes, elapsed):
+        if self.fixed_limit or elapsed <= 0:
+            return
+        # Estimate what the hub moves in aggregate while `level` writes share it
+        samples = state["level_throughput"]
+        estimate = nbytes / elapsed * level
+        previous = samples.get(level)
+        samples[level] = estimate if previous is None else previous * 0.7 + estimate * 0.3
+
+        limit = state["limit"]
+        current = samples.get(limit)
+        lower = samples.get(limit - 1)
+        if current is None or lower is None:
+            return
+        if current > lower * 1.1 and limit < self.max_limit:
+            state["limit"] = limit + 1
+        elif current < lower * 0.95 and limit > 1:
+            state["limit"] = limit - 1
+
+    def set_limit(self, limit):
+        """Sets a fixed per-hub limit, or None to tune it from measured throughput."""
+        with self._cond:
+            self.fixed_limit = limit
+            for state in self._hubs.values():
+                state["limit"] = limit or 2
+                state["level_throughput"].clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        """Returns per-hub utilisation figures."""
+        now = time.monotonic()
+        with self._cond:
+            result = {}
+            for hub, state in self._hubs.items():
+                busy = state["busy"]
+                if state["busy_since"] is not None:
+                    busy += now - state["busy_since"]
+                result[hub] = {
+                    "limit": state["limit"],
+                    "active": state["active"],
+                    "waiting": state["waiting"],
+                    "peak": state["peak"],
+                    "writes": state["writes"],
+                    "bytes": state["bytes"],
+                    "throughput": state["bytes"] / busy if busy else 0.0,
+                    "utilisation": busy / max(now - state["first_use"], 1e-6),
+                }
+            return result
+
+PICO_USB_VIDS = {
+    0x2E8A: "Raspberry Pi",
+    0x239A: "Adafruit",
+}
+
+# REPL commands that reboot into the UF2 bootloader, by firmware
+REPL_BOOTLOADER_COMMANDS = {
+    "MicroPython": "import machine; machine.bootloader()",
+    "CircuitPython": "import microcontroller; microcontroller.on_next_reset(microcontroller.RunMode.UF2); microcontroller.reset()",
+}
+
+def guess_serial_firmware(vid, pid):
+    """Guesses which firmware runs behind a CDC port from its USB ids."""
+    if vid == 0x239A:
+        return "CircuitPython"
+    if vid == 0x2E8A and pid == 0x0005:
+        return "MicroPython"
+    # 0x000F is not among these: it is the RP2350 boot ROM (see PICOBOOT_USB_IDS)
+    if vid == 0x2E8A and pid in (0x000A, 0x000B):
+        return "Arduino"
+    return "Unknown"
+
+def find_pico_serial_ports():
+    """Returns [{"port", "firmware", "serial_number", "location"}] for every Pico CDC serial port."""
+    if not list_ports:
+        raise RuntimeError("Serial support requires the 'pyserial' module. Please install with 'pip install pyserial'.")
+    ports = []
+    for info in list_ports.comports():
+        if info.vid not in PICO_USB_VIDS:
+            continue
+        ports.append({
+            "port": info.device,
+            "firmware": guess_serial_firmware(info.vid, info.pid),
+            "serial_number": info.serial_number,
+            "location": info.location,
+        })
+    return ports
+
+def serial_port_present(port):
+    return os.path.exists(port) or port in {info.device for info in list_ports.comports()}
+
+def touch_1200_baud(port):
+    """Opens and drops the port at 1200 baud, which Pico firmware treats as 'reboot to BOOTSEL'."""
+    with serial.Serial(port, 1200, timeout=1) as s:
+        try:
+            s.dtr = False
+        except (OSError, serial.SerialException):
+            # Not every port supports modem lines (e.g. ptys), closing still drops the line
+            pass
+
+def repl_bootloader(port, firmware="MicroPython", timeout=2):
+    """Interrupts the REPL and runs the firmware's reboot-to-bootloader command."""
+    command = REPL_BOOTLOADER_COMMANDS.get(firmware, REPL_BOOTLOADER_COMMANDS["MicroPython"])
+    with serial.Serial(port, 115200, timeout=timeout, write_timeout=timeout) as s:
+        # Two Ctrl-C stop a running program, Ctrl-B leaves raw REPL if it was active
+        s.write(b"\r\x03\x03\x02")
+        time.sleep(0.2)
+        s.reset_input_buffer()
+        try:
+            s.write(command.encode() + b"\r")
+            s.flush()
+        except serial.SerialException:
+            # The board may drop off the bus before the write completes
+            pass
+
+def enter_bootloader(port, firmware="Unknown", method="auto", disappear_timeout=3.0):
+    """
+    Reboots one board into BOOTSEL mode. method is "touch", "repl" or "auto"
+    (touch first, REPL command if the port is still there afterwards).
+    Returns the method that was used.
+    """
+    if method in ("touch", "auto"):
+        touch_1200_baud(port)
+        if method == "touch":
+            return "touch"
+        deadline = time.monotonic() + disappear_timeout
+        while time.monotonic() < deadline:
+            if not serial_port_present(port):
+                return "touch"
+            time.sleep(0.2)
+    repl_bootloader(port, firmware)
+    return "repl"
+
+def wait_for_new_drives(before, count, timeout, list_drives=None, poll=0.5):
+    """Waits until `count` RPI-RP2 drives not in `before` show up. Returns the ones that did."""
+    list_drives = list_drives or (lambda: find_drives("RPI-RP2"))
+    before = set(before)
+    deadline = time.monotonic() + timeout
+    while True:
+        new = [drive for drive in list_drives() if drive not in before]
+        if len(new) >= count or time.monotonic() >= deadline:
+            return new
+        time.sleep(poll)
+
+def reboot_to_bootloader(ports, method="auto", timeout=20, log=logging.info, list_drives=None):
+    """
+    Reboots every port into BOOTSEL mode in parallel and waits for the boards to
+    re-enumerate as RPI-RP2 drives. Returns the new drives, ready to be flashed.
+    """
+    list_drives = list_drives or (lambda: find_drives("RPI-RP2"))
+    before = list_drives()
+    rebooted = []
+    lock = threading.Lock()
+
+    def reboot(entry):
+        try:
+            used = enter_bootloader(entry["port"], entry.get("firmware", "Unknown"), method)
+            log(f"[{entry['port']}] Rebooting {entry.get('firmware', 'board')} to bootloader ({used})")
+            with lock:
+                rebooted.append(entry["port"])
+        except Exception as e:
+            log(f"[{entry['port']}] Could not reboot to bootloader: {str(e)}")
+
+    threads = [threading.Thread(target=reboot, args=(entry,), daemon=True) for entry in ports]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not rebooted:
+        return []
+    drives = wait_for_new_drives(before, len(rebooted), timeout, list_drives)
+    log(f"{len(drives)} of {len(rebooted)} board(s) reappeared in bootloader mode")
+    return drives
+
+# PICOBOOT vendor interface of the RP2040/RP2350 boot ROM (see the RP2040 datasheet, section 2.8.5)
+PICOBOOT_MAGIC = 0x431FD10B
+PICOBOOT_COMMAND = struct.Struct("<IIBBHI16s")
+PICOBOOT_USB_IDS = {(0x2E8A, 0x0003): "RP2040", (0x2E8A, 0x000F): "RP2350"}
+PICOBOOT_EXCLUSIVE_ACCESS = 0x01
+PICOBOOT_REBOOT = 0x02
+PICOBOOT_FLASH_ERASE = 0x03
+PICOBOOT_READ = 0x84
+PICOBOOT_WRITE = 0x05
+PICOBOOT_EXIT_XIP = 0x06
+PICOBOOT_REBOOT2 = 0x0A
+PICOBOOT_IF_RESET = 0x41
+PICOBOOT_IF_CMD_STATUS = 0x42
+PICOBOOT_STATUS = ("OK", "UNKNOWN_CMD", "INVALID_CMD_LENGTH", "INVALID_TRANSFER_LENGTH", "INVALID_ADDRESS",
+                   "BAD_ALIGNMENT", "INTERLEAVED_WRITE", "REBOOTING", "UNKNOWN_ERROR")
+FLASH_SECTOR_SIZE = 4096
+PICOBOOT_TRANSFER_SIZE = 64 * 1024
+PICOBOOT_DRIVE_PREFIX = "usb:"  # PICOBOOT jobs have no mount point, their "drive" is usb:<port path>
+PICOBOOT_FLASH_WINDOW = 16 * 1024 * 1024  # XIP address window, reads past the end of a smaller chip wrap around
+PICOBOOT_FAMILIES = {"RP2040": {"RP2040"}, "RP2350": {"RP2350-ARM-S", "RP2350-ARM-NS", "RP2350-RISCV"}}
+RP2350_E10_BLOCK = 0x10FFFF00  # ABSOLUTE-family page RP2350 SDK images carry for the bootrom's erratum E10
+
+def usb_port_name(bus, port_numbers):
+    """Formats a USB location the way sysfs does, e.g. bus 1, ports (1, 2) -> "1-1.2"."""
+    return f"{bus}-" + ".".join(str(n) for n in port_numbers)
+
+def usb_parent_hub(port):
+    """Returns the hub a USB port path hangs off, e.g. "1-1.2" -> "1-1", "1-1" -> "usb1"."""
+    if "." in port:
+        return port.rsplit(".", 1)[0]
+    return "usb" + port.split("-")[0]
+
+class UsbPicobootTransport:
+    """Bulk and control transfers to the PICOBOOT interface of a pyusb device."""
+    def __init__(self, device, timeout_ms=5000):
+        self.device = device
+        self.timeout_ms = timeout_ms
+        config = device.get_active_configuration()
+        interface = usb.util.find_descriptor(config, bInterfaceClass=0xFF)
+        if interface is None:
+            raise RuntimeError("Device has no PICOBOOT interface")
+        self.interface = interface.bInterfaceNumber
+        self.ep_out = usb.util.find_descriptor(interface, custom_match=lambda e: usb.util.endpoint_direction(
+            e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        self.ep_in = usb.util.find_descriptor(interface, custom_match=lambda e: usb.util.endpoint_direction(
+            e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+
+    def bulk_out(self, data):
+        self.ep_out.write(data, self.timeout_ms)
+
+    def bulk_in(self, size):
+        return bytes(self.ep_in.read(max(size, self.ep_in.wMaxPacketSize), self.timeout_ms))[:size]
+
+    def control_out(self, request):
+        self.device.ctrl_transfer(0x41, request, 0, self.interface, None, self.timeout_ms)
+
+    def control_in(self, request, length):
+        return bytes(self.device.ctrl_transfer(0xC1, request, 0, self.interface, length, self.timeout_ms))
+
+    def close(self):
+        usb.util.dispose_resources(self.device)
+
+class FakePicobootTransport:
+    """
+    In-memory stand-in for a board in BOOTSEL mode, for exercising the PICOBOOT path
+    without hardware. Flash programming only clears bits, like real NOR flash, so a
+    write to a sector that was not erased shows up in the read-back.
+    """
+    def __init__(self, chip="RP2040", flash_size=2 * 1024 * 1024, fail_address=None):
+        self.chip = chip
+        self.flash = bytearray(b"\xff" * flash_size)
+        self.fail_address = fail_address  # Writes covering this address fail with INVALID_ADDRESS
+        self.commands = []
+        self.rebooted = False
+        self.status = 0
+        self._pending = None  # (command id, address, remaining bytes, received data)
+        self._ack = None  # "in" if the host must read a zero-length ack, "out" if it must send one
+        self._token = 0
+
+    def _range(self, args):
+        address, size = struct.unpack_from("<II", args)
+        offset = address - RP2_FLASH_BASE
+        if offset < 0 or offset + size > PICOBOOT_FLASH_WINDOW:
+            self._fail(4)
+        # Like the real chip, addresses past the end of flash wrap around to its start
+        offset %= len(self.flash)
+        if offset + size > len(self.flash):
+            self._fail(4)
+        return offset, size
+
+    def _fail(self, status):
+        self.status = status
+        self._pending = None
+        self._ack = None
+        raise OSError(f"Pipe error (PICOBOOT status {PICOBOOT_STATUS[status]})")
+
+    def bulk_out(self, data):
+        data = bytes(data)
+        if self._pending:
+            cmd, offset, remaining, received = self._pending
+            received += data
+            if len(received) >= remaining:
+                self._pending = None
+                if self.fail_address is not None and offset <= self.fail_address - RP2_FLASH_BASE < offset + remaining:
+                    self._fail(4)
+                for i, byte in enumerate(received[:remaining]):
+                    self.flash[offset + i] &= byte
+                self._ack = "in"
+            else:
+                self._pending = (cmd, offset, remaining, received)
+            return
+        if self._ack == "out":
+            if data:
+                self._fail(3)
+            self._ack = None
+            return
+        magic, self._token, cmd, _cmd_size, _, length, args = PICOBOOT_COMMAND.unpack(data)
+        if magic != PICOBOOT_MAGIC:
+            self._fail(1)
+        self.commands.append(cmd)
+        self.status = 0
+        if cmd == PICOBOOT_FLASH_ERASE:
+            offset, size = self._range(args)
+            if offset % FLASH_SECTOR_SIZE or size % FLASH_SECTOR_SIZE:
+                self._fail(5)
+            self.flash[offset:offset + size] = b"\xff" * size
+            self._ack = "in"
+        elif cmd == PICOBOOT_WRITE:
+            offset, size = self._range(args)
+            if offset % UF2_PAGE_SIZE or size % UF2_PAGE_SIZE or size != length:
+                self._fail(5)
+            self._pending = (cmd, offset, size, b"")
+        elif cmd == PICOBOOT_READ:
+            offset, size = self._range(args)
+            self._pending = (cmd, offset, size, b"")
+        elif cmd in (PICOBOOT_EXCLUSIVE_ACCESS, PICOBOOT_EXIT_XIP, PICOBOOT_REBOOT, PICOBOOT_REBOOT2):
+            self.rebooted = self.rebooted or cmd in (PICOBOOT_REBOOT, PICOBOOT_REBOOT2)
+            self._ack = "in"
+        else:
+            self._fail(1)
+
+    def bulk_in(self, size):
+        if self._pending and self._pending[0] == PICOBOOT_READ:
+            _, offset, remaining, _ = self._pending
+            self._pending = None
+            self._ack = "out"
+            return bytes(self.flash[offset:offset + min(size, remaining)])
+        if self._ack == "in":
+            self._ack = None
+            return b""
+        self._fail(8)
+
+    def control_out(self, request):
+        if request == PICOBOOT_IF_RESET:
+            self._pending = None
+            self._ack = None
+            self.status = 0
+
+    def control_in(self, request, length):
+        return struct.pack("<IIBB6x", self._token, self.status, self.commands[-1] if self.commands else 0, 0)[:length]
+
+    def close(self):
+        pass
+
+class PicobootDevice:
+    """PICOBOOT command layer over a transport (a real USB device or FakePicobootTransport)."""
+    def __init__(self, transport, chip="RP2040"):
+        self.transport = transport
+        self.chip = chip
+        self._tokens = itertools.count(1)
+        self.transport.control_out(PICOBOOT_IF_RESET)
+
+    def command(self, cmd, args=b"", transfer_length=0, data=None):
+        """Sends one command with its optional data phase. Raises RuntimeError with the device status on failure."""
+        packet = PICOBOOT_COMMAND.pack(PICOBOOT_MAGIC, next(self._tokens), cmd, len(args), 0,
+                                       transfer_length, args.ljust(16, b"\0"))
+        try:
+            self.transport.bulk_out(packet)
+            result = None
+            if cmd & 0x80:
+                result = self.transport.bulk_in(transfer_length) if transfer_length else b""
+                self.transport.bulk_out(b"")
+            else:
+                if transfer_length:
+                    self.transport.bulk_out(data)
+                self.transport.bulk_in(0)
+            return result
+        except (OSError, RuntimeError) as e:
+            status = self.status()
+            self.transport.control_out(PICOBOOT_IF_RESET)
+            detail = ""
+            if len(args) >= 8 and cmd in (PICOBOOT_FLASH_ERASE, PICOBOOT_WRITE, PICOBOOT_READ):
+                address, size = struct.unpack_from("<II", args)
+                detail = f" at 0x{address:08x} (+{size} bytes)"
+            raise RuntimeError(f"PICOBOOT command 0x{cmd:02x}{detail} failed: {status or str(e)}")
+
+    def status(self):
+        try:
+            _, code, _, _ = struct.unpack_from("<IIBB", self.transport.control_in(PICOBOOT_IF_CMD_STATUS, 16))
+        except (OSError, struct.error):
+            return None
+        return PICOBOOT_STATUS[code] if code < len(PICOBOOT_STATUS) else f"status {code}"
+
+    def exclusive_access(self, exclusive=1):
+        self.command(PICOBOOT_EXCLUSIVE_ACCESS, bytes([exclusive]))
+
+    def exit_xip(self):
+        self.command(PICOBOOT_EXIT_XIP)
+
+    def erase(self, address, size):
+        self.command(PICOBOOT_FLASH_ERASE, struct.pack("<II", address, size))
+
+    def write(self, address, data):
+        self.command(PICOBOOT_WRITE, struct.pack("<II", address, len(data)), len(data), data)
+
+    def read(self, address, size):
+        return self.command(PICOBOOT_READ, struct.pack("<II", address, size), size)
+
+    def reboot(self, delay_ms=500):
+        """Reboots into the image in flash."""
+        if self.chip == "RP2350":
+            self.command(PICOBOOT_REBOOT2, struct.pack("<IIII", 0, delay_ms, 0, 0))
+        else:
+            self.command(PICOBOOT_REBOOT, struct.pack("<III", 0, 0x20042000, delay_ms))
+
+    def close(self):
+        self.transport.close()
+
+def find_picoboot_devices():
+    """Lists boards in BOOTSEL mode that expose PICOBOOT, as dicts with usb_port, hub and chip."""
+    if not usb:
+        return []
+    devices = []
+    for (vid, pid), chip in PICOBOOT_USB_IDS.items():
+        for device in usb.core.find(find_all=True, idVendor=vid, idProduct=pid):
+            port = usb_port_name(device.bus, device.port_numbers or ())
+            devices.append({"usb_port": port, "hub": usb_parent_hub(port), "chip": chip,
+                            "drive": PICOBOOT_DRIVE_PREFIX + port})
+    return devices
+
+def open_picoboot(usb_port):
+    """Opens the PICOBOOT interface of the board at a USB port path such as "1-1.2"."""
+    if not usb:
+        raise RuntimeError("PICOBOOT needs pyusb and libusb. Please install with 'pip install pyusb'.")
+    for (vid, pid), chip in PICOBOOT_USB_IDS.items():
+        for device in usb.core.find(find_all=True, idVendor=vid, idProduct=pid):
+            if usb_port_name(device.bus, device.port_numbers or ()) == usb_port:
+                return PicobootDevice(UsbPicobootTransport(device), chip)
+    raise RuntimeError(f"No board in BOOTSEL mode at USB port {usb_port}")
+
+def uf2_flash_runs(data, chip="RP2040", flash_size=PICOBOOT_FLASH_WINDOW):
+    """
+    Returns the main-flash payload of a UF2 image as sorted, merged (address, bytes) runs.
+    data is a buffer or a PersonalizedImage. Only blocks of chip's families, DATA and ABSOLUTE
+    are kept; the RP2350 erratum E10 page is dropped. Raises ValueError for blocks past flash_size.
+    """
+    view = memoryview(data.tobytes() if hasattr(data, "iter_chunks") else data)
+    families = PICOBOOT_FAMILIES[chip] | {"DATA", "ABSOLUTE"}
+    blocks = []
+    skipped = 0
+    for offset in range(0, len(view), UF2_BLOCK_SIZE):
+        _, _, flags, address, size, _, _, family = UF2_HEADER.unpack_from(view, offset)
+        if flags & UF2_FLAG_NOT_MAIN_FLASH:
+            continue
+        if flags & UF2_FLAG_FAMILY_ID_PRESENT:
+            name = UF2_FAMILIES.get(family)
+            if name not in families:
+                skipped += 1
+                continue
+            if name == "ABSOLUTE" and address == RP2350_E10_BLOCK:
+                # Only meaningful to the RP2350 bootrom's UF2 loader; written here it would land at an alias
+                continue
+        if not RP2_FLASH_BASE <= address or address + size > RP2_FLASH_BASE + flash_size:
+            raise ValueError(f"UF2 block at 0x{address:08x} is outside the {flash_size // 1024} KB of flash "
+                             f"and cannot be written over PICOBOOT")
+        blocks.append((address, view[offset + 32:offset + 32 + size]))
+    if skipped and not blocks:
+        raise ValueError(f"UF2 image has no blocks for {chip}")
+    blocks.sort(key=lambda block: block[0])
+
+    runs = []
+    for address, payload in blocks:
+        if runs and runs[-1][0] + len(runs[-1][1]) == address:
+            runs[-1][1].extend(payload)
+        else:
+            runs.append((address, bytearray(payload)))
+    return _page_runs([(address, bytes(run)) for address, run in runs])
+
+def sector_ranges(runs):
+    """Flash sectors touched by the runs, merged into (address, size) erase ranges."""
+    ranges = []
+    for address, data in runs:
+        start = address - address % FLASH_SECTOR_SIZE
+        end = -(-(address + len(data)) // FLASH_SECTOR_SIZE) * FLASH_SECTOR_SIZE
+        if ranges and start <= ranges[-1][0] + ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][0] + ranges[-1][1]) - ranges[-1][0])
+        else:
+            ranges.append((start, end - start))
+    return ranges
+
+def picoboot_flash_size(device):
+    """
+    Probes the flash size over PICOBOOT: reads past the end of the chip wrap around to its
+    first sector, so the first power of two repeating it is the size. Returns None when
+    that sector is blank and there is nothing to recognise. Call after exit_xip().
+    """
+    first = device.read(RP2_FLASH_BASE, FLASH_SECTOR_SIZE)
+    if first.count(first[:1]) == len(first):
+        return None
+    size = 256 * 1024
+    while size < PICOBOOT_FLASH_WINDOW:
+        if device.read(RP2_FLASH_BASE + size, FLASH_SECTOR_SIZE) == first:
+            return size
+        size *= 2
+    return PICOBOOT_FLASH_WINDOW
+
+def picoboot_flash(device, image, full_erase=False, progress=None, tick=None, cancel=None, verify=True, reboot=True,
+                   flash_size=None):
+    """
+    Writes a UF2 image straight to flash over PICOBOOT: erases the touched sectors
+    (or the whole chip), writes, reads back and reboots. image=None only erases.
+    flash_size is probed when not given; a full erase refuses to run without it.
+    Stops with RuntimeError between transfers once the cancel event is set.
+    Returns bytes written.
+    """
+    def step():
+        if tick:
+            tick()
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError("PICOBOOT transfer cancelled")
+
+    device.exclusive_access()
+    device.exit_xip()
+    flash_size = flash_size or picoboot_flash_size(device)
+    if full_erase and not flash_size:
+        raise RuntimeError("Cannot tell the flash size of this board (its flash looks blank), "
+                           "set it explicitly to erase the full chip")
+    runs = uf2_flash_runs(image, device.chip, flash_size or PICOBOOT_FLASH_WINDOW) if image is not None else []
+    total = sum(len(data) for _, data in runs) or 1
+    if full_erase:
+        erase_ranges = [(RP2_FLASH_BASE, flash_size)]
+    else:
+        erase_ranges = sector_ranges(runs)
+    for address, size in erase_ranges:
+        for start in range(address, address + size, PICOBOOT_TRANSFER_SIZE):
+            device.erase(start, min(PICOBOOT_TRANSFER_SIZE, address + size - start))
+            step()
+
+    done = 0
+    steps = 2 if verify else 1
+    for address, data in runs:
+        view = memoryview(data)
+        for start in range(0, len(view), PICOBOOT_TRANSFER_SIZE):
+            chunk = view[start:start + PICOBOOT_TRANSFER_SIZE]
+            device.write(address + start, chunk)
+            done += len(chunk)
+            step()
+            if progress:
+                progress(done / total / steps)
+    if verify:
+        checked = 0
+        for address, data in runs:
+            for start in range(0, len(data), PICOBOOT_TRANSFER_SIZE):
+                expected = data[start:start + PICOBOOT_TRANSFER_SIZE]
+                actual = device.read(address + start, len(expected))
+                if actual != expected:
+                    bad = next(i for i in range(len(expected)) if actual[i] != expected[i])
+                    raise RuntimeError(f"Read-back mismatch at 0x{address + start + bad:08x}")
+                checked += len(expected)
+                step()
+                if progress:
+                    progress(0.5 + checked / total / 2)
+    if reboot:
+        device.reboot()
+    return sum(len(data) for _, data in runs)
+
+DEFAULT_SMOKE_SNIPPET = "import sys, os\nprint(sys.implementation)\nprint(os.uname().version)\n"
+DEFAULT_SMOKE_EXPECT = r"name='(micropython|circuitpython)'"
+REPL_BANNER = re.compile(rb"(MicroPython|Adafruit CircuitPython) (v?[\w.\-]+)[^\r\n]*")
+
+class ReplSession:
+    """Minimal non-blocking REPL client on a serial port, driven from an asyncio loop."""
+    def __init__(self, port, baudrate=115200):
+        self.serial = serial.Serial(port, baudrate, timeout=0, write_timeout=1)
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.serial.write(data)
+
+    def discard_input(self):
+        self.serial.reset_input_buffer()
+        self.buffer.clear()
+
+    async def read_until(self, marker, timeout):
+        """Returns everything before marker and consumes the marker."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            index = self.buffer.find(marker)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(marker)]
+                return data
+            if loop.time() >= deadline:
+                raise TimeoutError(f"Timed out waiting for {marker!r} from {self.serial.port}")
+            chunk = self.serial.read(self.serial.in_waiting or 1)
+            if chunk:
+                self.buffer += chunk
+            else:
+                await asyncio.sleep(0.01)
+
+    def close(self):
+        self.serial.close()
+
+class ReplSmokeTest:
+    """
+    Post-flash check: waits for the REPL banner on a board's serial port, runs
+    a snippet through the raw REPL and matches its output against a regex.
+    """
+    def __init__(self, snippet=DEFAULT_SMOKE_SNIPPET, expect=DEFAULT_SMOKE_EXPECT, banner_timeout=10, run_timeout=10):
+        self.snippet = snippet
+        self.expect = expect
+        self.banner_timeout = banner_timeout
+        self.run_timeout = run_timeout
+
+    async def run_port(self, port):
+        result = {"port": port, "passed": False, "firmware": None, "version": None,
+                  "output": "", "error": None, "duration": 0.0}
+        start = time.perf_counter()
+        session = None
+        try:
+            if not serial:
+                raise RuntimeError("Serial support requires the 'pyserial' module. Please install with 'pip install pyserial'.")
+            session = ReplSession(port)
+
+            # Stop whatever is running, then Ctrl-B makes the friendly REPL print its banner
+            session.write(b"\r\x03\x03")
+            await asyncio.sleep(0.1)
+            session.discard_input()
+            session.write(b"\x02")
+            banner = await session.read_until(b">>> ", self.banner_timeout)
+            match = REPL_BANNER.search(banner)
+            if match:
+                result["firmware"] = match.group(1).decode()
+                result["version"] = match.group(2).decode()
+
+            session.write(b"\x01")
+            await session.read_until(b"raw REPL; CTRL-B to exit\r\n>", self.banner_timeout)
+            session.write(self.snippet.encode() + b"\x04")
+            await session.read_until(b"OK", self.run_timeout)
+            output = await session.read_until(b"\x04", self.run_timeout)
+            error = await session.read_until(b"\x04", self.run_timeout)
+            session.write(b"\x02")
+
+            result["output"] = output.decode(errors="replace").replace("\r\n", "\n").strip()
+            if error.strip():
+                result["error"] = error.decode(errors="replace").replace("\r\n", "\n").strip()
+            elif not re.search(self.expect, result["output"]):
+                result["error"] = f"Output did not match {self.expect!r}"
+            else:
+                result["passed"] = True
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            if session:
+                session.close()
+            result["duration"] = time.perf_counter() - start
+        return result
+
+    async def run_ports(self, ports):
+        return await asyncio.gather(*(self.run_port(port) for port in ports))
+
+    def run(self, ports):
+        """Smoke tests all ports at once on one event loop. Returns one result per port."""
+        return asyncio.run(self.run_ports(ports))
+
+def match_ports_to_jobs(jobs, ports, pair_leftover=True):
+    """
+    Pairs flashed jobs with serial ports by USB port path. With pair_leftover, leftovers
+    are paired when exactly one job and one port remain. Returns [(job, port or None)].
+    """
+    by_key = {usb_port_key(p["location"]): p for p in ports if usb_port_key(p["location"])}
+    pairs = []
+    used = set()
+    unmatched = []
+    for job in jobs:
+        port = by_key.get(usb_port_key(job.usb_port))
+        if port:
+            pairs.append((job, port["port"]))
+            used.add(port["port"])
+        else:
+            unmatched.append(job)
+    remaining = [p["port"] for p in ports if p["port"] not in used]
+    if pair_leftover and len(unmatched) == 1 and len(remaining) == 1:
+        pairs.append((unmatched[0], remaining[0]))
+    else:
+        pairs.extend((job, None) for job in unmatched)
+    return pairs
+
+def run_smoke_tests(jobs, tester, log=logging.info, enumerate_timeout=15, list_serial_ports=None,
+                    pair_leftover=True):
+    """
+    Waits for the flashed boards' serial ports, smoke tests them concurrently
+    and stores each result in job.smoke_test. Failed tests mark the job failed;
+    boards whose USB port is unknown and could not be paired are skipped.
+    Pass pair_leftover=False when boards outside jobs may still be attached.
+    """
+    list_serial_ports = list_serial_ports or find_pico_serial_ports
+    deadline = time.monotonic() + enumerate_timeout
+    while True:
+        ports = list_serial_ports()
+        pairs = match_ports_to_jobs(jobs, ports, pair_leftover)
+        # Without a USB port, a board can only ever be paired as the leftover
+        if all(port or not (pair_leftover or usb_port_key(job.usb_port)) for job, port in pairs) \
+                or time.monotonic() >= deadline:
+            break
+        time.sleep(0.5)
+
+    testable = [(job, port) for job, port in pairs if port]
+    log(f"Running smoke test on {len(testable)} board(s)...")
+    results = tester.run([port for _, port in testable])
+    for (job, port), result in zip(testable, results):
+        job.smoke_test = result
+    for job, port in pairs:
+        if port:
+            continue
+        if usb_port_key(job.usb_port):
+            job.smoke_test = {"port": None, "passed": False, "error": "No serial port found for this device"}
+        else:
+            job.smoke_test = {"port": None, "passed": None, "skipped": True,
+                              "error": "USB port of the board is unknown, cannot tell which serial port is its own"}
+
+    for job in jobs:
+        result = job.smoke_test
+        if result.get("skipped"):
+            log(f"[{job.drive}] Smoke test skipped: {result['error']}")
+        elif result["passed"]:
+            log(f"[{job.drive}] Smoke test passed on {result['port']}: {result['firmware'] or ''} {result['version'] or ''}".rstrip())
+        else:
+            log(f"[{job.drive}] Smoke test failed: {result['error']}")
+            if job.state != "failed":
+                job.state = "failed"
+                job.error = f"Smoke test failed: {result['error']}"
+    return jobs
+
+LIBRARY_MANIFEST = ".pico_revival_manifest.json"
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+def hash_file(path, st=None):
+    """Returns the SHA-256 of a file, reusing earlier results while its size and mtime are unchanged."""
+    st = st or os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _file_hashes_lock:
+        digest = _file_hashes.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(256 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _file_hashes_lock:
+            _file_hashes[key] = digest
+    return digest
+
+def scan_library(source_dir, dest_prefix):
+    """Returns {device relative path: (source path, size, sha256)} for every file under source_dir."""
+    files = {}
+    pending = [(source_dir, dest_prefix)]
+    while pending:
+        folder, rel = pending.pop()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or entry.name == "__pycache__":
+                    continue
+                target = f"{rel}/{entry.name}"
+                if entry.is_dir():
+                    pending.append((entry.path, target))
+                elif entry.is_file():
+                    st = entry.stat()
+                    files[target] = (entry.path, st.st_size, hash_file(entry.path, st))
+    return files
+
+def load_device_manifest(drive):
+    try:
+        with open(os.path.join(drive, LIBRARY_MANIFEST)) as f:
+            return json.load(f).get("files", {})
+    except (OSError, ValueError):
+        return {}
+
+def flush_drive(drive):
+    """Flushes pending writes to the device once at the end of a sync."""
+    if sys.platform == 'win32':
+        from ctypes import windll
+        volume = "\\\\.\\" + drive.rstrip("\\")
+        # GENERIC_WRITE, FILE_SHARE_READ | FILE_SHARE_WRITE, OPEN_EXISTING
+        handle = windll.kernel32.CreateFileW(volume, 0x40000000, 0x3, None, 3, 0, None)
+        if handle not in (-1, 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+            windll.kernel32.FlushFileBuffers(handle)
+            windll.kernel32.CloseHandle(handle)
+    elif hasattr(os, "sync"):
+        os.sync()
+
+def sync_libraries(sources, drive, log=logging.info, progress=None):
+    """
+    Copies library folders into <drive>/lib, transferring only new or changed
+    files and removing files that no longer exist in the source. A manifest of
+    hashes, sizes and mtimes kept on the device avoids re-reading untouched
+    files; other files are only hashed when their size matches.
+    Returns {"copied", "skipped", "removed", "bytes"}.
+    """
+    wanted = {}
+    for source in sources:
+        wanted.update(scan_library(source, f"lib/{os.path.basename(os.path.normpath(source))}"))
+    managed = tuple(f"lib/{os.path.basename(os.path.normpath(source))}/" for source in sources)
+
+    manifest = load_device_manifest(drive)
+    stats = {"copied": 0, "skipped": 0, "removed": 0, "bytes": 0}
+    to_copy = []
+    for rel, (path, size, digest) in sorted(wanted.items()):
+        dest = os.path.join(drive, *rel.split("/"))
+        known = manifest.get(rel)
+        try:
+            dest_st = os.stat(dest)
+        except OSError:
+            dest_st = None
+        if dest_st is None or dest_st.st_size != size:
+            to_copy.append((rel, path, dest, size))
+        elif known and known["mtime"] == dest_st.st_mtime:
+            # Untouched since we wrote it, trust the recorded hash
+            if known["sha256"] == digest:
+                stats["skipped"] += 1
+            else:
+                to_copy.append((rel, path, dest, size))
+        elif hash_file(dest, dest_st) == digest:
+            stats["skipped"] += 1
+        else:
+            to_copy.append((rel, path, dest, size))
+
+    total = sum(size for *_, size in to_copy) or 1
+    for rel, path, dest, size in to_copy:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Plain copy without per-file fsync, the drive is flushed once at the end
+        with open(path, "rb") as src, open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst, 64 * 1024)
+        stats["copied"] += 1
+        stats["bytes"] += size
+        if progress:
+            progress(stats["bytes"] / total)
+
+    # Remove files under the managed folders that are no longer in the source
+    stale = {rel for rel in manifest if rel.startswith(managed) and rel not in wanted}
+    for prefix in managed:
+        root = os.path.join(drive, *prefix.rstrip("/").split("/"))
+        for folder, _, names in os.walk(root):
+            for name in names:
+                rel = os.path.relpath(os.path.join(folder, name), drive).replace(os.sep, "/")
+                if rel not in wanted:
+                    stale.add(rel)
+    for rel in sorted(stale):
+        try:
+            os.remove(os.path.join(drive, *rel.split("/")))
+            stats["removed"] += 1
+        except FileNotFoundError:
+            pass
+    for prefix in managed:
+        root = os.path.join(drive, *prefix.rstrip("/").split("/"))
+        for folder, dirs, names in os.walk(root, topdown=False):
+            if folder != root and not os.listdir(folder):
+                os.rmdir(folder)
+
+    files = {rel: entry for rel, entry in manifest.items() if not rel.startswith(managed)}
+    for rel, (_, size, digest) in wanted.items():
+        mtime = os.stat(os.path.join(drive, *rel.split("/"))).st_mtime
+        files[rel] = {"size": size, "sha256": digest, "mtime": mtime}
+    if files != manifest:
+        with open(os.path.join(drive, LIBRARY_MANIFEST), "w") as f:
+            json.dump({"version": 1, "files": files}, f, indent=1, sort_keys=True)
+        flush_drive(drive)
+
+    log(f"Library sync: {stats['copied']} copied ({stats['bytes'] / 1024:.0f} KB), "
+        f"{stats['skipped']} unchanged, {stats['removed']} removed")
+    return stats
+
+INVENTORY_FIELDS = ("identity", "drive", "volume", "mode", "hub", "usb_port", "bootloader", "model", "board_id",
+                    "firmware", "firmware_version", "board_name", "chip", "uid", "error", "scanned", "duration_ms")
+BOOT_OUT_RE = re.compile(r"^(?P<firmware>\S.*?) (?P<version>\d+\.\d+\S*)(?: on (?P<date>[\d-]+))?"
+                         r"(?:; (?P<board>.*?)(?: with (?P<chip>\S+))?)?$")
+
+def parse_info_uf2(text):
+    """Parses INFO_UF2.TXT ("UF2 Bootloader v3.0", "Model: ...", "Board-ID: ...") into a dict."""
+    info = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("UF2 Bootloader"):
+            info["bootloader"] = line[len("UF2 Bootloader"):].strip()
+        elif ":" in line:
+            key, _, value = line.partition(":")
+            info[key.strip().lower().replace("-", "_")] = value.strip()
+    return info
+
+def parse_boot_out(text):
+    """Parses CircuitPython's boot_out.txt into firmware, version, board, chip, board id and UID."""
+    lines = text.splitlines()
+    info = {}
+    if lines:
+        match = BOOT_OUT_RE.match(lines[0].strip())
+        if match:
+            info["firmware"] = match.group("firmware")
+            info["firmware_version"] = match.group("version")
+            info["board_name"] = match.group("board")
+            info["chip"] = match.group("chip")
+    for line in lines[1:]:
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+        key = key.strip().lower()
+        if key == "board id":
+            info["board_id"] = value.strip()
+        elif key == "uid":
+            info["uid"] = value.strip()
+    return info
+
+def _read_text(path, limit=4096):
+    with open(path, "r", errors="replace") as f:
+        return f.read(limit)
+
+def read_device_info(drive):
+    """Reads INFO_UF2.TXT and boot_out.txt from one drive. Returns None if it has neither."""
+    start = time.perf_counter()
+    record = {"drive": drive, "volume": get_volume_name(drive)}
+    found = False
+    info_path = os.path.join(drive, "INFO_UF2.TXT")
+    if os.path.exists(info_path):
+        found = True
+        info = parse_info_uf2(_read_text(info_path))
+        record["mode"] = "bootloader"
+        record["bootloader"] = info.get("bootloader")
+        record["model"] = info.get("model")
+        record["board_id"] = info.get("board_id")
+    boot_out = os.path.join(drive, "boot_out.txt")
+    if os.path.exists(boot_out):
+        found = True
+        record.update({k: v for k, v in parse_boot_out(_read_text(boot_out)).items() if v})
+        record.setdefault("mode", "circuitpython")
+    if not found:
+        return None
+    record["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return record
+
+class DeviceInventory:
+    """
+    Parallel scan of INFO_UF2.TXT/boot_out.txt on every attached drive. Records are
+    cached by device identity (UID if the firmware reports one, else USB port, else
+    drive) so boards that were unplugged stay in the inventory with attached=False.
+    """
+    def __init__(self, topology=None):
+        self.topology = topology or UsbTopology()
+        self.records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def scan(self, drives=None, timeout=0.5):
+        """Reads every drive at once; drives that do not answer within timeout are reported as such."""
+        drives = [d if d.endswith(os.sep) else d + os.sep for d in (drives or get_available_drives())]
+        self.topology.refresh()
+        results = {}
+
+        def read(drive):
+            try:
+                results[drive] = read_device_info(drive)
+            except OSError as e:
+                results[drive] = {"drive": drive, "error": str(e)}
+
+        threads = {drive: threading.Thread(target=read, args=(drive,), daemon=True) for drive in drives}
+        for thread in threads.values():
+            thread.start()
+        deadline = time.monotonic() + timeout
+        for drive, thread in threads.items():
+            thread.join(max(deadline - time.monotonic(), 0))
+
+        scanned = time.time()
+        attached = []
+        for drive in drives:
+            if drive not in results:
+                record = {"drive": drive, "error": f"No answer within {timeout:.1f}s"}
+            else:
+                record = results[drive]
+                if record is None:
+                    continue
+            record["hub"] = self.topology.hub_for(drive)
+            record["usb_port"] = self.topology.port_for(drive)
+            record["identity"] = record.get("uid") or record["usb_port"] or drive
+            record["scanned"] = scanned
+            record["attached"] = True
+            attached.append(record)
+
+        with self._lock:
+            for record in self.records.values():
+                record["attached"] = False
+            for record in attached:
+                self.records.pop(record["identity"], None)
+                self.records[record["identity"]] = record
+        return attached
+
+    def export(self, path, attached_only=False):
+        """Writes the inventory as CSV or JSON, chosen by the file extension."""
+        with self._lock:
+            records = [dict(r) for r in self.records.values() if r.get("attached") or not attached_only]
+        if path.lower().endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(records, f, indent=2)
+            return len(records)
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=INVENTORY_FIELDS + ("attached",), extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(records)
+        return len(records)
+
+def describe_device(record):
+    if record.get("error"):
+        return f"{record['drive']}: {record['error']}"
+    parts = [record.get("volume") or "?"]
+    if record.get("model"):
+        parts.append(record["model"])
+    if record.get("bootloader"):
+        parts.append(f"bootloader {record['bootloader']}")
+    if record.get("firmware"):
+        parts.append(f"{record['firmware']} {record.get('firmware_version', '')}".strip())
+    if record.get("board_name"):
+        parts.append(record["board_name"])
+    if record.get("uid"):
+        parts.append(f"UID {record['uid']}")
+    location = f" @ {record['usb_port']}" if record.get("usb_port") else ""
+    return f"{record['drive']}{location}: " + ", ".join(parts)
+
+# UF2 families each chip can boot, in order of preference
+CHIP_FAMILIES = {"RP2040": ("RP2040",), "RP2350": ("RP2350-ARM-S", "RP2350-RISCV", "RP2350-ARM-NS")}
+ROUTING_RULE_KEYS = ("chip", "model", "board_id")
+
+def board_chip(record):
+    """Returns the chip ("RP2040" or "RP2350") of a board in BOOTSEL mode from its INFO_UF2.TXT fields."""
+    text = f"{record.get('board_id') or ''} {record.get('model') or ''}".upper()
+    if "RP2350" in text:
+        return "RP2350"
+    if "RPI-RP2" in text or "RP2040" in text or "RASPBERRY PI RP2" in text:
+        return "RP2040"
+    return None
+
+def image_families(path, family=None):
+    """UF2 family names of a firmware file; raw .bin/.hex/.elf files get the family they will be converted for."""
+    if firmware_name(path).lower().endswith(".uf2"):
+        return parse_uf2(read_firmware(path)).family_names
+    return [UF2_FAMILIES[family or FAMILY_IDS["RP2040"]]]
+
+def load_routing_rules(path):
+    """
+    Loads routing rules from JSON: a list of {"chip"/"model"/"board_id": regex, ..., "firmware": path},
+    tried in order. Relative firmware paths are resolved against the rules file.
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    if not isinstance(rules, list):
+        raise ValueError("Routing rules must be a JSON list")
+    base = os.path.dirname(os.path.abspath(path))
+    for rule in rules:
+        if not rule.get("firmware"):
+            raise ValueError(f"Routing rule {rule} has no firmware")
+        for key in ROUTING_RULE_KEYS:
+            if key in rule:
+                re.compile(rule[key])
+        rule["firmware"] = os.path.join(base, os.path.expanduser(rule["firmware"]))
+    return rules
+
+class FirmwareRouter:
+    """
+    Picks the firmware for each board of a mixed batch. Rules are tried first, in order;
+    a rule applies when all its patterns match the board's chip, model and board id.
+    Otherwise the first candidate image built for the board's chip is used. Boards
+    with no match, or whose matching image is built for another chip, are rejected.
+    """
+    def __init__(self, candidates=(), rules=None, families=image_families):
+        self.candidates = list(dict.fromkeys(candidates))
+        self.rules = rules or []
+        self._families = families
+        self._known = {}
+
+    def families(self, path):
+        if path not in self._known:
+            self._known[path] = self._families(path)
+        return self._known[path]
+
+    def runs_on(self, path, chip):
+        try:
+            return any(family in CHIP_FAMILIES.get(chip, ()) for family in self.families(path))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot route to {path}: {str(e)}")
+            return False
+
+    def route(self, record):
+        """Returns (firmware path, None) for a scanned board, or (None, reason) if it must not be flashed."""
+        if record.get("error"):
+            return None, record["error"]
+        chip = board_chip(record)
+        if not chip:
+            return None, f"unknown board (model {record.get('model')!r}, board id {record.get('board_id')!r})"
+        fields = dict(record, chip=chip)
+        for rule in self.rules:
+            if all(re.search(rule[key], fields.get(key) or "", re.IGNORECASE)
+                   for key in ROUTING_RULE_KEYS if key in rule):
+                path = rule["firmware"]
+                if not os.path.exists(path):
+                    return None, f"firmware {path} of the matching rule not found"
+                if not self.runs_on(path, chip):
+                    return None, (f"{firmware_name(path)} from the matching rule is built for "
+                                  f"{'/'.join(self.families(path))}, board is {chip}")
+                return path, None
+        for path in self.candidates:
+            if self.runs_on(path, chip):
+                return path, None
+        return None, f"no firmware for {chip}"
+
+    def plan(self, drives, records):
+        """
+        Routes every drive before anything is written. Returns ({firmware path: [drives]}, [(drive, reason)]).
+        Drives without a scan record (no INFO_UF2.TXT) are rejected.
+        """
+        by_drive = {os.path.normpath(r["drive"]): r for r in records}
+        routes = {}
+        rejected = []
+        for drive in drives:
+            record = by_drive.get(os.path.normpath(drive))
+            if record is None:
+                rejected.append((drive, "no INFO_UF2.TXT, not a board in BOOTSEL mode"))
+                continue
+            path, reason = self.route(record)
+            if path:
+                routes.setdefault(path, []).append(drive)
+            else:
+                rejected.append((drive, reason))
+        return routes, rejected
+
+ERASE_DIR = os.path.join(os.path.expanduser("~"), ".pico_revival_erase")
+ERASE_PRESETS = OrderedDict([("full", "Full chip (flash_nuke.uf2)"), ("firmware", "Old firmware + filesystem"),
+                             ("filesystem", "Filesystem + boot sector (firmware must be reflashed)")])
+FILESYSTEM_HEADER_SIZE = 2 * FLASH_SECTOR_SIZE  # littlefs superblock pair, FAT boot sector and tables
+
+def _uf2_page(f, index):
+    """Reads block index of a UF2 file as (address, payload), or None past its end."""
+    f.seek(index * UF2_BLOCK_SIZE)
+    block = f.read(UF2_BLOCK_SIZE)
+    if len(block) < UF2_BLOCK_SIZE:
+        return None
+    magic0, magic1, _, address, size, _, _, _ = UF2_HEADER.unpack_from(block)
+    if magic0 != UF2_MAGIC_START0 or magic1 != UF2_MAGIC_START1:
+        raise ValueError(f"Block {index} of CURRENT.UF2 is not a UF2 block")
+    return address, block[32:32 + size]
+
+def _filesystem_size(first, second):
+    """Size in bytes of a littlefs or FAT filesystem from its first two pages, 0 if neither starts here."""
+    if first[8:16] == b"littlefs":
+        block_size, block_count = struct.unpack_from("<II", first, 24)
+        return block_size * block_count
+    if first[:1] in (b"\xeb", b"\xe9") and second[254:256] == b"\x55\xaa" \
+            and (first[54:57] == b"FAT" or first[82:85] == b"FAT"):
+        sector_size, total16 = struct.unpack_from("<H", first, 11)[0], struct.unpack_from("<H", first, 19)[0]
+        return sector_size * (total16 or struct.unpack_from("<I", first, 32)[0])
+    return 0
+
+def read_flash_layout(drive):
+    """
+    Samples CURRENT.UF2 on a BOOTSEL drive, reading the first two pages of every flash
+    sector, and returns {"flash_size", "used": [sector addresses], "filesystem": (start, end) or None}.
+    The filesystem is the first littlefs (MicroPython) or FAT (CircuitPython) volume found.
+    Sectors whose first page is blank count as unused.
+    """
+    with open(os.path.join(drive, "CURRENT.UF2"), "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # Only a page per sector is read, readahead would pull in the whole image
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_RANDOM)
+        first = _uf2_page(f, 0)
+        if first is None:
+            raise ValueError("CURRENT.UF2 is empty")
+        f.seek(0)
+        num_blocks = UF2_HEADER.unpack(f.read(UF2_HEADER.size))[6]
+        base, page_size = first[0], len(first[1])
+        pages_per_sector = FLASH_SECTOR_SIZE // page_size
+        flash_size = num_blocks * page_size
+        used = []
+        filesystem = None
+        for index in range(0, num_blocks, pages_per_sector):
+            page = _uf2_page(f, index)
+            if page is None:
+                break
+            address, payload = page
+            if payload.count(0xFF) == len(payload):
+                continue
+            used.append(address)
+            if filesystem is None:
+                second = _uf2_page(f, index + 1)
+                size = _filesystem_size(payload, second[1] if second else b"")
+                if 0 < size <= base + flash_size - address:
+                    filesystem = (address, address + size)
+    return {"flash_size": flash_size, "used": used, "filesystem": filesystem}
+
+def erase_sectors(layout, preset):
+    """
+    Flash sectors a targeted erase blanks: the used sectors of the filesystem plus its header,
+    with preset "firmware" also every used sector before it. Both presets also blank the first
+    flash sector (boot2 and the firmware's vector table), so the board finds no bootable image and
+    stays in BOOTSEL like after flash_nuke: the old firmware no longer runs and must be reflashed.
+    """
+    sectors = {RP2_FLASH_BASE}
+    filesystem = layout["filesystem"]
+    if filesystem:
+        start, end = filesystem
+        sectors.update(range(start, min(end, start + FILESYSTEM_HEADER_SIZE), FLASH_SECTOR_SIZE))
+        sectors.update(address for address in layout["used"] if start <= address < end)
+    if preset == "firmware":
+        sectors.update(address for address in layout["used"] if not filesystem or address < filesystem[0])
+    return sorted(sectors)
+
+def build_erase_uf2(sectors, family):
+    """
+    UF2 image that blanks each sector with a single 0xFF page: the bootrom erases a whole
+    sector before it programs the first page written into it.
+    """
+    blank = b"\xff" * UF2_PAGE_SIZE
+    return b"".join(uf2_block(address, blank, number, len(sectors), family)
+                    for number, address in enumerate(sectors))
+
+def prepare_erase_images(jobs, preset, log=logging.info, timeout=10.0):
+    """
+    Points the nuke step of each job at an erase image generated from its board's CURRENT.UF2
+    for preset. Drives are read in parallel; jobs whose drive cannot be read keep flash_nuke.uf2.
+    """
+    targets = [job for job in jobs if job.transport == "msc" and (job.kind == "reset" or "nuke" in (job.recipe or ()))]
+    if preset == "full" or not targets:
+        return
+    os.makedirs(ERASE_DIR, exist_ok=True)
+    results = {}
+
+    def prepare(job):
+        try:
+            info = read_device_info(job.drive) or {}
+            family = FAMILY_IDS["ABSOLUTE" if board_chip(info) == "RP2350" else "RP2040"]
+            layout = read_flash_layout(job.drive)
+            sectors = erase_sectors(layout, preset)
+            data = build_erase_uf2(sectors, family)
+            path = os.path.join(ERASE_DIR, f"erase-{hashlib.sha256(data).hexdigest()[:16]}.uf2")
+            if not os.path.exists(path):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+        except (OSError, ValueError, struct.error) as e:
+            results[job.job_id] = str(e)
+            return
+        fs = "no filesystem" if not layout["filesystem"] else \
+            f"filesystem at 0x{layout['filesystem'][0]:08x}-0x{layout['filesystem'][1]:08x}"
+        results[job.job_id] = (path, f"blanking {len(sectors)} of {layout['flash_size'] // FLASH_SECTOR_SIZE} "
+                                     f"sectors ({fs})")
+
+    threads = [threading.Thread(target=prepare, args=(job,), daemon=True) for job in targets]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    for job in targets:
+        result = results.get(job.job_id, f"no answer within {timeout:.0f}s")
+        if isinstance(result, str):
+            log(f"[{job.drive}] Cannot read the flash layout ({result}), erasing the full chip")
+            continue
+        job.nuke_path, message = result
+        job.erase_preset = preset
+        log(f"[{job.drive}] {ERASE_PRESETS[preset]}: {message}")
+
+# Device steps a flash recipe chains, and the host-side work each of them needs first
+RECIPES = {
+    "flash": ("nuke", "firmware"),
+    "flash+sync": ("nuke", "firmware", "sync"),
+    "flash+smoke": ("nuke", "firmware", "smoke"),
+    "full": ("nuke", "firmware", "sync", "smoke"),
+}
+RECIPE_HOST_STEPS = {
+    "nuke": ("load_nuke",),
+    "firmware": ("load_firmware", "verify_firmware", "personalize"),
+    "sync": ("scan_libraries",),
+    "smoke": (),
+}
+
+def compile_recipe(steps):
+    """
+    Compiles recipe steps into a job graph of (node, "host" or "device", dependencies).
+    Device nodes run one after another; host nodes run in order on their own thread and
+    each device node only waits for its own host inputs, so preparing the firmware or
+    hashing libraries happens while the device erases or re-enumerates.
+    """
+    unknown = [step for step in steps if step not in RECIPE_HOST_STEPS]
+    if unknown:
+        raise ValueError(f"Unknown recipe step(s) {', '.join(unknown)}, use {', '.join(RECIPE_HOST_STEPS)}")
+    graph = []
+    previous_host = None
+    previous_device = None
+    for step in steps:
+        for host in RECIPE_HOST_STEPS[step]:
+            graph.append((host, "host", (previous_host,) if previous_host else ()))
+            previous_host = host
+        graph.append((step, "device", RECIPE_HOST_STEPS[step] + ((previous_device,) if previous_device else ())))
+        previous_device = step
+    return graph
+
+def pipeline_summary(trace):
+    """Totals a job trace: host work, the part of it that overlapped device steps, and device waits for the host."""
+    host = [(entry["start"], entry["end"]) for entry in trace if entry["kind"] == "host"]
+    device = [(entry["start"], entry["end"]) for entry in trace if entry["kind"] == "device"]
+    overlap = sum(max(0.0, min(host_end, device_end) - max(host_start, device_start))
+                  for host_start, host_end in host for device_start, device_end in device)
+    return {"host_s": round(sum(end - start for start, end in host), 4), "overlap_s": round(overlap, 4),
+            "waited_s": round(sum(entry["end"] - entry["start"] for entry in trace if entry["kind"] == "wait"), 4)}
+
+def reconnected_drive(job, name, known=()):
+    """
+    Finds the drive a job's board came back as after flashing, by mount point or else by USB port.
+    When no drive's port can be compared, falls back to the only drive of that name not in known,
+    the drives that already had it before the board rebooted.
+    """
+    if get_volume_name(job.drive) == name:
+        return job.drive
+    drives = find_drives(name)
+    key = usb_port_key(job.usb_port)
+    if key:
+        topology = UsbTopology()
+        topology.refresh()
+        ports = {drive: usb_port_key(topology.port_for(drive)) for drive in drives}
+        for drive, port in ports.items():
+            if port == key:
+                return drive
+        if any(ports.values()):
+            return None
+    new = [drive for drive in drives if drive not in known]
+    return new[0] if len(new) == 1 else None
+
+DEVICE_TRACE_FILE = os.path.join(os.path.expanduser("~"), ".pico_revival_device_traces.jsonl")
+DEVICE_TRACE_POLL = 0.05  # Seconds between volume checks while recording, finer than wait_for_volume's
+
+class DeviceIO:
+    """The file and volume operations a USB mass storage flash job performs on its device."""
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def getsize(self, path):
+        return os.path.getsize(path)
+
+    def write_image(self, view, path, progress=None, cancel=None):
+        return write_image(view, path, progress=progress, cancel=cancel)
+
+    def settle(self, drive, seconds):
+        time.sleep(seconds)
+
+    def wait_for_detach(self, drive, timeout, poll=0.1):
+        """Waits for the drive to go away, e.g. when the board reboots. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while get_volume_name(drive) is not None:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def wait_for_volume(self, drive, name, timeout):
+        return wait_for_volume(drive, name, timeout)
+
+    def find_drive(self, name):
+        return find_drive(get_available_drives(), name)
+
+    def finish(self, job):
+        """Called once the job is over, before its done event."""
+        pass
+
+class RecordingDeviceIO(DeviceIO):
+    """
+    Performs real device I/O and records its timeline: per-chunk write latency, when the
+    volume detaches and when it comes back, times relative to the start of the job.
+    The timeline is handed to recorder when the job finishes.
+    """
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.t0 = time.perf_counter()
+        self.events = []
+        self._attached = True
+
+    def _now(self):
+        return round(time.perf_counter() - self.t0, 4)
+
+    def _poll(self, drive):
+        volume = get_volume_name(drive)
+        if volume is None and self._attached:
+            self._attached = False
+            self.events.append({"event": "detach", "t": self._now()})
+        elif volume is not None and not self._attached:
+            self._attached = True
+            self.events.append({"event": "attach", "t": self._now(), "volume": volume})
+        return volume
+
+    def write_image(self, view, path, progress=None, cancel=None):
+        event = {"event": "write", "file": os.path.basename(path), "t": self._now(), "bytes": len(view), "chunks": []}
+        last = time.perf_counter()
+
+        def timed_progress(done):
+            nonlocal last
+            now = time.perf_counter()
+            event["chunks"].append(round(now - last, 5))
+            last = now
+            if progress:
+                progress(done)
+        try:
+            return write_image(view, path, progress=timed_progress, cancel=cancel)
+        except Exception as e:
+            event["error"] = str(e)
+            raise
+        finally:
+            # Whatever comes after the last chunk is the closing fsync
+            event["fsync"] = round(time.perf_counter() - last, 5)
+            self.events.append(event)
+
+    def settle(self, drive, seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            self._poll(drive)
+            time.sleep(min(DEVICE_TRACE_POLL, max(0.0, deadline - time.perf_counter())))
+
+    def wait_for_detach(self, drive, timeout, poll=DEVICE_TRACE_POLL):
+        deadline = time.perf_counter() + timeout
+        while self._poll(drive) is not None:
+            if time.perf_counter() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def wait_for_volume(self, drive, name, timeout):
+        deadline = time.perf_counter() + timeout
+        while True:
+            if self._poll(drive) == name:
+                return True
+            if time.perf_counter() >= deadline:
+                self.events.append({"event": "timeout", "t": self._now(), "volume": name})
+                return False
+            time.sleep(DEVICE_TRACE_POLL)
+
+    def timeline(self, job):
+        """The recorded timeline of job, with the erase time after each nuke write picked out."""
+        erase = None
+        for index, event in enumerate(self.events):
+            if event["event"] == "write" and event["file"] == "flash_nuke.uf2":
+                end = event["t"] + sum(event["chunks"]) + event["fsync"]
+                attach = next((e for e in self.events[index + 1:] if e["event"] == "attach"), None)
+                erase = round(attach["t"] - end, 4) if attach else None
+        return {"device": job.usb_port or job.drive, "hub": job.hub, "label": job.label, "state": job.state,
+                "recorded": time.time(), "erase_s": erase, "events": self.events}
+
+    def finish(self, job):
+        try:
+            self.recorder.save(job, self)
+        except OSError as e:
+            logging.error(f"Could not save the device trace of job {job.job_id}: {str(e)}")
+
+class DeviceTraceRecorder:
+    """Appends the device timeline of every recorded job as one JSON line to path."""
+    def __init__(self, path=DEVICE_TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def device(self, job):
+        # PICOBOOT jobs do not go through the drive, there is nothing to record
+        return RecordingDeviceIO(self) if job.transport == "msc" and job.kind != "sync" else None
+
+    def save(self, job, device):
+        line = json.dumps(device.timeline(job)) + "\n"
+        with self._lock:
+            # One write per line on an append-mode file, so worker processes can share it
+            with open(self.path, "a") as f:
+                f.write(line)
+
+def load_device_traces(path):
+    """Reads the timelines recorded into path, skipping jobs that never reached the device."""
+    timelines = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                timeline = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {str(e)}")
+            if any(event["event"] == "write" for event in timeline.get("events", ())):
+                timelines.append(timeline)
+    if not timelines:
+        raise ValueError(f"{path} holds no recorded device writes")
+    return timelines
+
+class ReplayDeviceIO(DeviceIO):
+    """
+    Simulated device that plays back a recorded timeline: each write takes the recorded
+    per-chunk latencies (failing where the recording failed) and the volume detaches and
+    reappears as long after it as it did on the real board. speed > 1 replays faster.
+    Writes beyond the recorded ones repeat the last.
+    """
+    def __init__(self, timeline, drive, speed=1.0):
+        self.drive = drive
+        self.speed = speed
+        self.writes = []
+        events = timeline["events"]
+        for index, event in enumerate(events):
+            if event["event"] != "write":
+                continue
+            end = event["t"] + sum(event["chunks"]) + event.get("fsync", 0.0)
+            step = {"chunks": event["chunks"] or [0.0], "bytes": event["bytes"], "fsync": event.get("fsync", 0.0),
+                    "error": event.get("error"), "detach": None, "attach": None, "volume": None}
+            for later in events[index + 1:]:
+                if later["event"] == "write":
+                    break
+                if later["event"] == "detach" and step["detach"] is None:
+                    step["detach"] = max(0.0, later["t"] - end)
+                elif later["event"] == "attach":
+                    step["attach"], step["volume"] = max(0.0, later["t"] - end), later["volume"]
+                    break
+            self.writes.append(step)
+        self.volume = "RPI-RP2"
+        self.files = {}
+        self._written = 0
+        self._detach_at = self._attach_at = None
+        self._next_volume = None
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def _current(self):
+        now = time.perf_counter()
+        if self._attach_at is not None and now >= self._attach_at:
+            self.volume, self.files = self._next_volume, {}
+            self._detach_at = self._attach_at = None
+        elif self._detach_at is not None and now >= self._detach_at:
+            self.volume, self.files = None, {}
+            self._detach_at = None
+        return self.volume
+
+    def exists(self, path):
+        if self._current() is None:
+            return False
+        return os.path.normpath(path) == os.path.normpath(self.drive) or path in self.files
+
+    def getsize(self, path):
+        if self._current() is None or path not in self.files:
+            raise FileNotFoundError(path)
+        return self.files[path]
+
+    def write_image(self, view, path, progress=None, cancel=None):
+        if self._current() is None:
+            raise FileNotFoundError(path)
+        step = self.writes[min(self._written, len(self.writes) - 1)]
+        self._written += 1
+        chunks = step["chunks"]
+        written = 0
+        for index, chunk in enumerate(iter_image_chunks(view)):
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError(f"Write to {path} cancelled")
+            if step["error"] and index == len(chunks):
+                raise OSError(step["error"])
+            self._sleep(chunks[index % len(chunks)] * len(chunk) / (64 * 1024))
+            written += len(chunk)
+            if progress:
+                progress(written)
+        self._sleep(step["fsync"])
+        self.files[path] = written
+        now = time.perf_counter()
+        if step["detach"] is not None:
+            self._detach_at = now + step["detach"] / self.speed
+        if step["attach"] is not None:
+            self._attach_at, self._next_volume = now + step["attach"] / self.speed, step["volume"]
+        elif step["detach"] is not None:
+            self._next_volume = None  # The board never came back in the recording
+        return written
+
+    def settle(self, drive, seconds):
+        self._sleep(seconds)
+
+    def wait_for_detach(self, drive, timeout, poll=0.1):
+        if self._current() is None:
+            return True
+        if self._detach_at is not None and self._detach_at - time.perf_counter() <= timeout / self.speed:
+            time.sleep(max(0.0, self._detach_at - time.perf_counter()))
+            return self._current() is None
+        self._sleep(timeout)
+        return self._current() is None
+
+    def wait_for_volume(self, drive, name, timeout):
+        if self._current() == name:
+            return True
+        if self._attach_at is not None and self._next_volume == name:
+            wait = self._attach_at - time.perf_counter()
+            if wait <= timeout / self.speed:
+                time.sleep(max(0.0, wait))
+                return self._current() == name
+        self._sleep(timeout)
+        return self._current() == name
+
+    def find_drive(self, name):
+        return self.drive if self._current() == name else None
+
+class FlashJob:
+    """State of one flash or reset operation on a single device."""
+    _ids = itertools.count(1)
+
+    FIELDS = ("job_id", "batch_id", "kind", "drive", "hub", "usb_port", "label", "firmware_path", "firmware_sha256",
+              "firmware_family", "base_address", "flash_size",
+              "nuke_path", "erase_preset", "personalization", "personalization_id", "library_paths", "expect_volume", "nuke_settle", "firmware_settle", "reconnect_timeout", "stall_timeout",
+              "transport", "recipe", "smoke_check", "trace", "state", "progress", "phases", "error", "smoke_test", "sync_stats", "started", "finished")
+
+    def __init__(self, kind, drive, label, firmware_path=None, nuke_path=None, expect_volume=None, batch_id=None,
+                 hub=None, usb_port=None, library_paths=None, personalization=None, firmware_family=None,
+                 base_address=None, transport="msc", recipe=None, smoke_check=None):
+        self.job_id = next(FlashJob._ids)
+        self.batch_id = batch_id or self.job_id
+        self.kind = kind  # "flash", "reset" or "sync"
+        self.drive = drive
+        self.hub = hub  # Upstream USB hub, None if unknown
+        self.usb_port = usb_port  # USB port path such as "1-1.2", None if unknown
+        self.label = label
+        self.firmware_path = firmware_path
+        self.firmware_sha256 = None
+        self.firmware_family = firmware_family  # UF2 family ID used to convert .bin/.hex/.elf files
+        self.base_address = base_address  # Flash address for raw .bin files
+        self.flash_size = None  # Flash size in bytes for PICOBOOT, None to probe the board
+        self.nuke_path = nuke_path
+        self.erase_preset = "full"  # What nuke_path erases, see ERASE_PRESETS
+        self.personalization = personalization["patches"] if personalization else None
+        self.personalization_id = personalization["id"] if personalization else None
+        self.library_paths = library_paths or []
+        self.expect_volume = expect_volume
+        self.transport = transport  # "msc" copies UF2 files to the drive, "picoboot" writes flash over USB directly
+        self.recipe = list(recipe) if recipe else None  # Device steps of a flash job, see RECIPES
+        self.smoke_check = smoke_check  # (snippet, expected output regex) for a recipe's smoke step
+
+        # Device timing, in seconds
+        self.nuke_settle = 10
+        self.firmware_settle = 5
+        self.reconnect_timeout = 20
+        self.stall_timeout = 15  # A device write making no progress for this long is abandoned
+
+        self.state = "queued"  # queued, running, succeeded, warning, failed
+        self.progress = 0.0
+        self.phases = {}
+        self.error = None
+        self.smoke_test = None  # Result of the post-flash REPL check, if it ran
+        self.sync_stats = None
+        self.trace = None  # Host and device step timings of a flash recipe
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls.__new__(cls)
+        for name in cls.FIELDS:
+            setattr(job, name, data.get(name))
+        return job
+
+    def apply_event(self, event, data):
+        """Mirrors an event reported by a worker onto this job."""
+        if event == "state":
+            self.state = data
+        elif event == "progress":
+            self.progress = data
+        elif event == "done":
+            for name in ("state", "progress", "phases", "error", "smoke_test", "sync_stats", "trace", "started",
+                         "finished"):
+                setattr(self, name, data[name])
+
+    @property
+    def is_finished(self):
+        return self.state in ("succeeded", "warning", "failed")
+
+    @contextmanager
+    def phase(self, name, report):
+        """Times a named step of the job and reports it."""
+        report(self.job_id, "phase", name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+def load_job_images(job, cache, roles=("nuke", "firmware")):
+    """Fetches the images a job needs from the firmware cache, keyed by role."""
+    images = {}
+    if job.nuke_path and "nuke" in roles:
+        if not os.path.exists(job.nuke_path):
+            raise FileNotFoundError("Nuke firmware (flash_nuke.uf2) is missing.")
+        images["nuke"] = cache.get(job.nuke_path)
+    if job.kind == "flash" and "firmware" in roles:
+        if not job.firmware_path or not os.path.exists(job.firmware_path):
+            raise FileNotFoundError(f"{job.label} firmware file not found.")
+        images["firmware"] = cache.get(job.firmware_path, job.firmware_family, job.base_address)
+        job.firmware_sha256 = images["firmware"].sha256
+    return images
+
+def fail_job(job, error, report):
+    job.state = "failed"
+    job.error = str(error)
+    job.finished = time.time()
+    report(job.job_id, "done", job.to_dict())
+
+def run_flash_job(job, images, report, scheduler=None, watchdog=DEVICE_WATCHDOG, profiler=None, loader=None,
+                  device=None, verify_images=False):
+    """
+    Runs one job against its drive. images maps "nuke"/"firmware" to buffers; missing ones
+    come from loader(role) while the device is busy with earlier steps of the job's recipe.
+    report(job_id, event, data) receives log, state, phase, progress and done events.
+    Writes go through scheduler, if given, to respect its per-hub limits, and all
+    device I/O runs under watchdog so a hung device fails its job instead of the batch.
+    With a profiler, the job and its I/O threads are profiled and a report is written.
+    device is the DeviceIO drive operations go through, to record or replay their timing.
+    verify_images re-hashes the firmware against job.firmware_sha256, for buffers that
+    crossed a process boundary; in-process images are the cached bytes that hash came from.
+    """
+    device = device or DeviceIO()
+    profile = profiler.job(job) if profiler else None
+    traced = profile.traced if profile else (lambda func: func)
+    if profile:
+        profile.start()
+    job.state = "running"
+    job.started = time.time()
+    report(job.job_id, "state", job.state)
+
+    def log(message):
+        report(job.job_id, "log", message)
+
+    def set_progress(value):
+        # Report in 1% steps so chunked writes don't flood the event queue
+        if value < 1.0 and value - job.progress < 0.01:
+            return
+        job.progress = value
+        report(job.job_id, "progress", value)
+
+    def throughput_meter(total):
+        """Returns a callback taking bytes done that reports the transfer rate a few times a second."""
+        start = last = time.perf_counter()
+
+        def measure(done):
+            nonlocal last
+            now = time.perf_counter()
+            if (now - last >= 0.25 or done >= total) and now > start:
+                last = now
+                report(job.job_id, "throughput", done / (now - start))
+        return measure
+
+    def io(operation, func, *args, deadline=None):
+        """Runs a short blocking device call under the watchdog."""
+        return watchdog.run(job.drive, operation, traced(lambda tick, cancel: func(*args)),
+                            deadline=deadline or job.stall_timeout)
+
+    def wait_volume(name):
+        return io(f"waiting for {name}", device.wait_for_volume, job.drive, name, job.reconnect_timeout,
+                  deadline=job.reconnect_timeout + job.stall_timeout)
+
+    def erase(phase, name):
+        """Waits out the erase the nuke image started and for the board to return as name, timing both."""
+        with job.phase(phase, report):
+            if job.erase_preset == "full":
+                device.settle(job.drive, job.nuke_settle)
+            else:
+                # A targeted erase takes a fraction of the settle time, so wait for the reboot itself
+                io("waiting for reboot", device.wait_for_detach, job.drive, job.nuke_settle,
+                   deadline=job.nuke_settle + job.stall_timeout)
+            found = wait_volume(name)
+        log(f"Erase ({ERASE_PRESETS[job.erase_preset]}) took {job.phases['write_nuke'] + job.phases[phase]:.1f}s")
+        return found
+
+    def write(role, filename, start, end):
+        view = images[role]
+        with job.phase(f"write_{role}", report):
+            slot = scheduler.slot(job.hub, len(view)) if scheduler else nullcontext()
+            with slot:
+                def copy(tick, cancel):
+                    measure = throughput_meter(len(view))
+
+                    def progress(done):
+                        tick()
+                        measure(done)
+                        set_progress(start + (end - start) * done / len(view))
+                    return device.write_image(view, os.path.join(job.drive, filename), progress=progress,
+                                              cancel=cancel)
+                watchdog.run(job.drive, f"writing {filename}", traced(copy), stall_timeout=job.stall_timeout)
+        if scheduler:
+            report(job.job_id, "hubs", scheduler.stats())
+        return len(view)
+
+    def program(image, full_erase, start, end):
+        """Erases and writes flash over PICOBOOT, verifying by read-back instead of waiting for a volume."""
+        with job.phase("picoboot", report):
+            slot = scheduler.slot(job.hub, len(image) if image is not None else 0) if scheduler else nullcontext()
+            with slot:
+                def flash(tick, cancel):
+                    size = len(image) if image is not None else 0
+                    measure = throughput_meter(size)
+
+                    def progress(done):
+                        tick()
+                        if size:
+                            measure(done * size)
+                        set_progress(start + (end - start) * done)
+                    device = open_picoboot(job.usb_port)
+                    try:
+                        return picoboot_flash(device, image, full_erase, progress, tick, cancel,
+                                              flash_size=job.flash_size)
+                    finally:
+                        device.close()
+                written = watchdog.run(job.drive, "PICOBOOT programming", traced(flash),
+                                       stall_timeout=job.stall_timeout)
+        if scheduler:
+            report(job.job_id, "hubs", scheduler.stats())
+        return written
+
+    def sync_to(drive, start, end):
+        with job.phase("sync", report):
+            def sync(tick, cancel):
+                def progress(value):
+                    tick()
+                    set_progress(start + (end - start) * value)
+
+                def sync_log(message):
+                    tick()
+                    log(message)
+                return sync_libraries(job.library_paths, drive, sync_log, progress)
+            job.sync_stats = watchdog.run(job.drive, "library sync", traced(sync), stall_timeout=job.stall_timeout)
+
+    try:
+        watchdog.check(job.drive)
+        if job.kind == "sync":
+            if not io("checking drive", device.exists, job.drive):
+                raise RuntimeError(f"Drive {job.drive} not found")
+            sync_to(job.drive, 0.0, 1.0)
+            job.state = "succeeded"
+        elif job.transport == "picoboot" and job.kind == "reset":
+            program(None, True, 0.0, 1.0)
+            log("Flash erased over PICOBOOT, device rebooted")
+            job.state = "succeeded"
+        elif job.kind == "reset":
+            dest_path = os.path.join(job.drive, "flash_nuke.uf2")
+            if not io("checking drive", device.exists, job.drive):
+                raise RuntimeError(f"Drive {job.drive} not found")
+            written = write("nuke", "flash_nuke.uf2", 0.0, 0.5)
+            if not io("checking file", device.exists, dest_path):
+                raise RuntimeError("File transfer failed - file not found on destination drive")
+            if written != io("checking file", device.getsize, dest_path):
+                raise RuntimeError("File transfer failed - size mismatch")
+            log("Reset file transferred successfully. Waiting for drive to reconnect...")
+
+            found = erase("reconnect", job.expect_volume)
+            if found:
+                log(f"Reset completed successfully - {job.expect_volume} drive detected")
+                job.state = "succeeded"
+            else:
+                job.error = f"{job.expect_volume} drive not detected after reset"
+                job.state = "warning"
+        else:
+            graph = compile_recipe(job.recipe or (("nuke", "firmware") if "nuke" in images or job.nuke_path
+                                                  else ("firmware",)))
+            steps = [node for node, kind, _ in graph if kind == "device"]
+            t0 = time.perf_counter()
+            done = {node: threading.Event() for node, _, _ in graph}
+            host_errors = []
+            trace = []
+            known_drives = []  # CIRCUITPY drives attached before the firmware step
+
+            def timed(node, kind, func):
+                start = time.perf_counter() - t0
+                try:
+                    return func()
+                finally:
+                    trace.append({"step": node, "kind": kind, "start": round(start, 4),
+                                  "end": round(time.perf_counter() - t0, 4)})
+
+            def load(role):
+                if role not in images:
+                    if not loader:
+                        raise RuntimeError(f"No {role} image for this job")
+                    images[role] = loader(role)
+
+            def verify_firmware():
+                if verify_images and job.firmware_sha256 \
+                        and hashlib.sha256(images["firmware"]).hexdigest() != job.firmware_sha256:
+                    raise RuntimeError("Firmware buffer does not match its recorded hash")
+
+            def personalize():
+                if job.personalization:
+                    block_index = cached_block_index(job.firmware_sha256, images["firmware"])
+                    images["firmware"] = personalize_uf2(images["firmware"], job.personalization, block_index)
+                    log(f"Personalized image with record {job.personalization_id}")
+
+            def scan_libraries():
+                # Hashes the library sources now so the sync step only compares against the device
+                for source in job.library_paths:
+                    scan_library(source, f"lib/{os.path.basename(os.path.normpath(source))}")
+
+            host_steps = {"load_nuke": lambda: load("nuke"), "load_firmware": lambda: load("firmware"),
+                          "verify_firmware": verify_firmware, "personalize": personalize,
+                          "scan_libraries": scan_libraries}
+
+            def run_host():
+                for node, kind, _ in graph:
+                    if kind != "host":
+                        continue
+                    try:
+                        if not host_errors:
+                            with job.phase(node, report):
+                                timed(node, "host", host_steps[node])
+                    except Exception as e:
+                        host_errors.append(e)
+                    finally:
+                        done[node].set()
+
+            def nuke():
+                if job.transport == "picoboot":
+                    return  # The firmware step erases the whole chip instead
+                write("nuke", "flash_nuke.uf2", 0.0, 0.1)
+                if job.erase_preset == "full":
+                    log(f"Nuke UF2 transferred, waiting {job.nuke_settle} seconds for device to reset...")
+                else:
+                    log("Erase UF2 transferred, waiting for device to reset...")
+                if not erase("erase", "RPI-RP2"):
+                    raise RuntimeError("After nuke, the device didn't reappear as RPI-RP2. Can't flash new firmware.")
+                set_progress(0.3)
+
+            def firmware():
+                last = steps[-1] == "firmware"
+                if "sync" in steps:
+                    known_drives.extend(io("listing drives", find_drives, "CIRCUITPY"))
+                if job.transport == "picoboot":
+                    written = program(images["firmware"], "nuke" in steps, 0.0, 1.0 if last else 0.9)
+                    log(f"{job.label} written over PICOBOOT ({written} bytes verified), device rebooted")
+                    if last:
+                        return
+                    with job.phase("reconnect", report):
+                        time.sleep(job.firmware_settle)
+                    return
+
+                # Converted .bin/.hex/.elf images must land on the drive as .uf2
+                write("firmware", os.path.splitext(firmware_name(job.firmware_path))[0] + ".uf2", 0.3, 0.9)
+                log(f"{job.label} copied successfully. Waiting {job.firmware_settle} seconds for device to reconnect...")
+                with job.phase("reconnect", report):
+                    device.settle(job.drive, job.firmware_settle)
+                    found = True
+                    if job.expect_volume:
+                        log(f"Checking for {job.expect_volume} drive...")
+                        found = wait_volume(job.expect_volume) \
+                            or bool(io("finding drive", device.find_drive, job.expect_volume))
+                if found:
+                    log(f"{job.label} flashed successfully!")
+                elif last:
+                    job.error = f"{job.expect_volume} drive not detected. Please check the connection."
+                    job.state = "warning"
+                else:
+                    raise RuntimeError(f"{job.expect_volume} drive not detected after flashing, "
+                                       f"cannot continue with {', '.join(steps[steps.index('firmware') + 1:])}")
+
+            def sync():
+                # Reading the USB topology may take up to its own timeout without the board being stuck
+                drive = io("finding drive", reconnected_drive, job, "CIRCUITPY", known_drives,
+                           deadline=USB_TOPOLOGY_TIMEOUT + job.stall_timeout)
+                if not drive:
+                    raise RuntimeError("CIRCUITPY drive not found for library sync")
+                sync_to(drive, 0.9, 0.97)
+
+            def smoke():
+                tester = ReplSmokeTest(*job.smoke_check) if job.smoke_check else ReplSmokeTest()
+                with job.phase("smoke_test", report):
+                    # Other boards of the batch may still be attached, so only a port match counts
+                    run_smoke_tests([job], tester, log=log, pair_leftover=False)
+
+            device_steps = {"nuke": nuke, "firmware": firmware, "sync": sync, "smoke": smoke}
+
+            log(f"Flashing {job.label} onto the Pico...")
+            threading.Thread(target=traced(run_host), name=f"host steps {job.drive}", daemon=True).start()
+            for node, kind, deps in graph:
+                if kind != "device":
+                    continue
+                if not all(done[dep].is_set() for dep in deps):
+                    timed(node, "wait", lambda: [done[dep].wait() for dep in deps])
+                if host_errors:
+                    raise host_errors[0]
+                timed(node, "device", device_steps[node])
+                done[node].set()
+                if job.state != "running":
+                    break
+
+            job.trace = dict(pipeline_summary(trace), steps=sorted(trace, key=lambda entry: entry["start"]))
+            log(f"Pipeline: {job.trace['host_s']:.2f}s of host work, {job.trace['overlap_s']:.2f}s of it "
+                f"overlapped device steps; devices waited {job.trace['waited_s']:.2f}s for host work")
+            if job.state == "running":
+                job.state = "succeeded"
+        set_progress(1.0)
+    except Exception as e:
+        job.state = "failed"
+        job.error = str(e)
+        logging.error(f"Job {job.job_id} on {job.drive} failed: {str(e)}")
+
+    job.finished = time.time()
+    if profile:
+        try:
+            log(f"Profile written to {profile.finish()}")
+        except OSError as e:
+            logging.error(f"Could not write profile of job {job.job_id}: {str(e)}")
+    device.finish(job)
+    report(job.job_id, "done", job.to_dict())
+
+class ThreadedFlashBackend:
+    """Runs each flash job on its own thread inside this process."""
+    name = "thread"
+
+    def __init__(self, cache, report, hub_limit=None):
+        self.cache = cache
+        self.report = report
+        self.scheduler = HubScheduler(hub_limit)
+        self.profiler = None
+        self.recorder = None
+
+    def submit(self, jobs):
+        for job in jobs:
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _device(self, job):
+        """The DeviceIO a job's drive operations go through, None for the plain one."""
+        return self.recorder.device(job) if self.recorder else None
+
+    def _run(self, job):
+        try:
+            if job.kind == "flash" and (not job.firmware_path or not os.path.exists(job.firmware_path)):
+                raise FileNotFoundError(f"{job.label} firmware file not found.")
+            images = {role: image.view() for role, image in load_job_images(job, self.cache, ("nuke",)).items()}
+        except Exception as e:
+            fail_job(job, e, self.report)
+            return
+        # The firmware is loaded while the device erases
+        run_flash_job(job, images, self.report, self.scheduler, profiler=self.profiler,
+                      loader=lambda role: load_job_images(job, self.cache, (role,))[role].view(),
+                      device=self._device(job))
+
+    def set_hub_limit(self, limit):
+        self.scheduler.set_limit(limit)
+
+    def set_profiler(self, profiler):
+        """Profiles jobs submitted from now on with profiler, or stops profiling with None."""
+        self.profiler = profiler
+
+    def set_recorder(self, recorder):
+        """Records the device timeline of jobs submitted from now on with recorder, or stops with None."""
+        self.recorder = recorder
+
+    def hub_stats(self):
+        return self.scheduler.stats()
+
+    def shutdown(self):
+        pass
+
+def _flash_worker_process(tasks, events, threads, hub_limit, profile_dir=None, trace_path=None):
+    """Entry point of a flashing worker process. Runs jobs from its queue until it receives None."""
+    slots = threading.BoundedSemaphore(threads)
+    scheduler = HubScheduler(hub_limit)
+    profiler = Profiler(profile_dir).start() if profile_dir else None
+    recorder = DeviceTraceRecorder(trace_path) if trace_path else None
+
+    def report(job_id, event, data):
+        events.put((job_id, event, data))
+
+    def run(job, segments):
+        attached = []
+        views = []
+        try:
+            for role, (name, size) in segments.items():
+                shm = shared_memory.SharedMemory(name=name)
+                attached.append(shm)
+                views.append(shm.buf[:size])
+            run_flash_job(job, dict(zip(segments, views)), report, scheduler, profiler=profiler,
+                          device=recorder.device(job) if recorder else None, verify_images=True)
+        except Exception as e:
+            fail_job(job, e, report)
+        finally:
+            for view in views:
+                view.release()
+            for shm in attached:
+                shm.close()
+            slots.release()
+
+    while True:
+        slots.acquire()
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == "hub_limit":
+            scheduler.set_limit(task[1])
+            slots.release()
+            continue
+        if task[0] == "profile":
+            if profiler:
+                profiler.stop()
+            profiler = Profiler(task[1]).start() if task[1] else None
+            slots.release()
+            continue
+        if task[0] == "record":
+            recorder = DeviceTraceRecorder(task[1]) if task[1] else None
+            slots.release()
+            continue
+        job_dict, segments = task
+        threading.Thread(target=run, args=(FlashJob.from_dict(job_dict), segments)).start()
+
+class ProcessFlashBackend:
+    """
+    Runs flash jobs in a pool of worker processes. This process acts as the
+    coordinator: it loads each image once, publishes it through shared memory,
+    assigns each device to a worker and streams worker events back to the
+    report callback. All devices behind one USB hub go to the same worker so
+    that its hub scheduler sees every write on that hub.
+    """
+    name = "process"
+
+    def __init__(self, cache, report, workers=None, threads_per_worker=32, hub_limit=None):
+        self.cache = cache
+        self.report = report
+        self.workers = workers or min(8, os.cpu_count() or 2)
+        self.threads_per_worker = threads_per_worker
+        self.hub_limit = hub_limit
+        self.profile_dir = None  # Base folder for profiles written by the workers, None when not profiling
+        self.trace_path = None  # File the workers append device timelines to, None when not recording
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = []
+        self._events = None
+        self._processes = []
+        self._pump = None
+        self._jobs = {}
+        self._load = []
+        self._job_worker = {}
+        self._hub_worker = {}
+        self._hub_stats = {}
+        self._segments = {}  # sha256 -> [SharedMemory, users]
+        self._job_segments = {}
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._events = self._ctx.Queue()
+        for _ in range(self.workers):
+            queue = self._ctx.Queue()
+            process = self._ctx.Process(target=_flash_worker_process,
+                                        args=(queue, self._events, self.threads_per_worker, self.hub_limit,
+                                              self.profile_dir, self.trace_path),
+                                        daemon=True)
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+            self._load.append(0)
+        self._pump = threading.Thread(target=self._pump_events, daemon=True)
+        self._pump.start()
+
+    def _assign(self, job):
+        """Picks the worker for a job: the hub's worker if it has one, else the least loaded."""
+        if job.hub is not None and job.hub in self._hub_worker:
+            worker = self._hub_worker[job.hub]
+        else:
+            worker = min(range(self.workers), key=lambda i: self._load[i])
+            if job.hub is not None:
+                self._hub_worker[job.hub] = worker
+        self._load[worker] += 1
+        self._job_worker[job.job_id] = worker
+        return worker
+
+    def submit(self, jobs):
+        if not self._processes:
+            self._start()
+        for job in jobs:
+            try:
+                images = load_job_images(job, self.cache)
+            except Exception as e:
+                fail_job(job, e, self.report)
+                continue
+            with self._lock:
+                segments = {role: self._share(image) for role, image in images.items()}
+                self._job_segments[job.job_id] = [image.sha256 for image in images.values()]
+                self._jobs[job.job_id] = job
+                worker = self._assign(job)
+            self._queues[worker].put((job.to_dict(), segments))
+
+    def _share(self, image):
+        entry = self._segments.get(image.sha256)
+        if entry is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(image.size, 1))
+            shm.buf[:image.size] = image.data
+            entry = self._segments[image.sha256] = [shm, 0]
+        entry[1] += 1
+        return entry[0].name, image.size
+
+    def _release(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            worker = self._job_worker.pop(job_id, None)
+            if worker is not None:
+                self._load[worker] -= 1
+            for sha in self._job_segments.pop(job_id, []):
+                entry = self._segments[sha]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._segments[sha]
+                    entry[0].close()
+                    entry[0].unlink()
+
+    def _pump_events(self):
+        while True:
+            item = self._events.get()
+            if item is None:
+                break
+            job_id, event, data = item
+            if event == "hubs":
+                with self._lock:
+                    self._hub_stats.update(data)
+            job = self._jobs.get(job_id)
+            if job:
+                job.apply_event(event, data)
+            if event == "done":
+                self._release(job_id)
+            self.report(job_id, event, data)
+
+    def set_hub_limit(self, limit):
+        self.hub_limit = limit
+        for queue in self._queues:
+            queue.put(("hub_limit", limit))
+
+    def set_profiler(self, profiler):
+        """Has every worker profile its jobs into a subfolder of profiler's folder, or stop with None."""
+        self.profile_dir = profiler.directory if profiler else None
+        for queue in self._queues:
+            queue.put(("profile", self.profile_dir))
+
+    def set_recorder(self, recorder):
+        """Has every worker append device timelines to recorder's file, or stop with None."""
+        self.trace_path = recorder.path if recorder else None
+        for queue in self._queues:
+            queue.put(("record", self.trace_path))
+
+    def hub_stats(self):
+        with self._lock:
+            return dict(self._hub_stats)
+
+    def shutdown(self):
+        if not self._processes:
+            return
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        self._queues = []
+        self._load = []
+        self._hub_worker.clear()
+        self._events.put(None)
+        self._pump.join(timeout=5)
+        with self._lock:
+            for shm, _ in self._segments.values():
+                shm.close()
+                shm.unlink()
+            self._segments.clear()
+            self._job_segments.clear()
+
+class ReplayFlashBackend(ThreadedFlashBackend):
+    """
+    Runs flash jobs against simulated devices replaying recorded timelines, so scheduler
+    and engine changes can be benchmarked without hardware. Jobs take the timelines in
+    turn, along with the hub the recording was made on unless they have their own.
+    """
+    name = "replay"
+
+    def __init__(self, cache, report, timelines, hub_limit=None, speed=1.0):
+        super().__init__(cache, report, hub_limit=hub_limit)
+        self.timelines = timelines
+        self.speed = speed
+        self._assigned = {}  # job id -> timeline
+        self._submitted = 0
+        self._lock = threading.Lock()
+
+    def submit(self, jobs):
+        replayable = []
+        for job in jobs:
+            if job.transport != "msc" or job.kind == "sync" or {"sync", "smoke"} & set(job.recipe or ()):
+                fail_job(job, RuntimeError("Only nuke and firmware steps over the drive can be replayed"),
+                         self.report)
+                continue
+            with self._lock:
+                timeline = self.timelines[self._submitted % len(self.timelines)]
+                self._submitted += 1
+                self._assigned[job.job_id] = timeline
+            if job.hub is None:
+                job.hub = timeline.get("hub")
+            replayable.append(job)
+        super().submit(replayable)
+
+    def _device(self, job):
+        with self._lock:
+            timeline = self._assigned.pop(job.job_id)
+        return ReplayDeviceIO(timeline, job.drive, self.speed)
+
+def create_flash_backend(name, cache, report, workers=None, hub_limit=None):
+    if name == "process":
+        return ProcessFlashBackend(cache, report, workers=workers, hub_limit=hub_limit)
+    return ThreadedFlashBackend(cache, report, hub_limit=hub_limit)
+
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".pico_revival_profiles")
+PROFILE_SAMPLE_INTERVAL = 0.01  # Seconds between stack samples
+PROFILE_TOP_N = 25
+
+def collapse_stack(frame):
+    """Formats a frame and its callers as a collapsed stack ("outer;...;inner") for flame graph tools."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class StackSampler:
+    """
+    Samples the stacks of registered threads at a fixed interval and counts them per
+    key. Cost stays flat however busy the threads are, which makes it cheap enough
+    to leave on at a production station.
+    """
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._threads = {}  # thread ident -> key
+        self._counts = {}  # key -> {stack: samples}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+
+    def watch(self, key, ident=None):
+        with self._lock:
+            self._threads[ident or threading.get_ident()] = key
+
+    def unwatch(self, ident=None):
+        with self._lock:
+            self._threads.pop(ident or threading.get_ident(), None)
+
+    def take(self, key):
+        """Returns and forgets the stack counts collected for key."""
+        with self._lock:
+            return self._counts.pop(key, {})
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, key in self._threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counts = self._counts.setdefault(key, {})
+                        stack = collapse_stack(frame)
+                        counts[stack] = counts.get(stack, 0) + 1
+            del frames
+
+def write_collapsed(path, counts):
+    with open(path, "w") as f:
+        for stack, samples in sorted(counts.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {samples}\n")
+
+class JobProfile:
+    """cProfile, stack samples and traced memory of one job, including its device I/O helper threads."""
+    def __init__(self, profiler, job):
+        self.profiler = profiler
+        self.job = job
+        self.key = f"job-{job.job_id}"
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._main = None
+        self._memory = None
+        self._started = None
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active cProfile; the stack samples still cover this thread
+            return None
+        return profile
+
+    def _disable(self, profile):
+        if profile:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def start(self):
+        """Starts profiling the calling (job) thread."""
+        self._started = time.perf_counter()
+        if tracemalloc.is_tracing():
+            self._memory = tracemalloc.get_traced_memory()
+        self.profiler.sampler.watch(self.key)
+        self._main = self._enable()
+
+    def traced(self, func):
+        """Wraps func so that the helper thread it runs on is profiled as part of this job."""
+        def run(*args, **kwargs):
+            self.profiler.sampler.watch(self.key)
+            profile = self._enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._disable(profile)
+                self.profiler.sampler.unwatch()
+        return run
+
+    def finish(self):
+        """Stops profiling and writes the job's top-N and collapsed-stack reports. Returns the report path."""
+        self._disable(self._main)
+        self.profiler.sampler.unwatch()
+        elapsed = time.perf_counter() - self._started
+        job = self.job
+        base = os.path.join(self.profiler.directory, self.key)
+        write_collapsed(base + ".collapsed", self.profiler.sampler.take(self.key))
+
+        with open(base + ".txt", "w") as f:
+            f.write(f"Job {job.job_id} ({job.kind}) on {job.drive}: {job.state}"
+                    + (f" - {job.error}" if job.error else "") + "\n")
+            f.write(f"Wall time {elapsed:.3f}s; phases: "
+                    + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in job.phases.items()) + "\n\n")
+            with self._lock:
+                profiles = list(self._profiles)
+            if profiles:
+                stats = pstats.Stats(*profiles, stream=f)
+                stats.dump_stats(base + ".pstats")
+                f.write(f"Top {self.profiler.top} functions by cumulative time\n")
+                stats.sort_stats("cumulative").print_stats(self.profiler.top)
+                f.write(f"Top {self.profiler.top} functions by own time\n")
+                stats.sort_stats("tottime").print_stats(self.profiler.top)
+            if self._memory is not None and tracemalloc.is_tracing():
+                # Snapshots cost ~0.1 s each, so allocation sites are reported once per session in memory.txt
+                current, peak = tracemalloc.get_traced_memory()
+                f.write(f"Traced memory (whole process): {self._memory[0] / 1048576:.1f} MB at start, "
+                        f"{current / 1048576:.1f} MB at end, {peak / 1048576:.1f} MB peak\n")
+        return base + ".txt"
+
+class Profiler:
+    """
+    Profiling mode: each flash, reset and sync job gets cProfile statistics, stack
+    samples and traced memory, written as <dir>/job-<id>.txt (top-N),
+    .collapsed (for flamegraph.pl or speedscope) and .pstats (for snakeviz).
+    Allocation growth over the whole session goes to <dir>/memory.txt on stop.
+    """
+    def __init__(self, directory=PROFILE_DIR, interval=PROFILE_SAMPLE_INTERVAL, top=PROFILE_TOP_N,
+                 trace_memory=True):
+        self.directory = os.path.join(directory, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}")
+        self.top = top
+        self.trace_memory = trace_memory
+        self.sampler = StackSampler(interval)
+        self._started_tracemalloc = False
+        self._snapshot = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(1)  # One frame per allocation keeps the tracing overhead down
+            self._started_tracemalloc = True
+        if tracemalloc.is_tracing():
+            self._snapshot = tracemalloc.take_snapshot()
+        self.sampler.start()
+        return self
+
+    def stop(self):
+        self.sampler.stop()
+        if self._snapshot is not None and tracemalloc.is_tracing():
+            try:
+                with open(os.path.join(self.directory, "memory.txt"), "w") as f:
+                    current, peak = tracemalloc.get_traced_memory()
+                    f.write(f"Traced memory: {current / 1048576:.1f} MB now, {peak / 1048576:.1f} MB peak\n")
+                    f.write(f"Top {self.top} allocation sites by growth while profiling\n")
+                    for stat in tracemalloc.take_snapshot().compare_to(self._snapshot, "lineno")[:self.top]:
+                        f.write(f"  {stat}\n")
+            except OSError as e:
+                logging.error(f"Could not write memory profile: {str(e)}")
+            self._snapshot = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def job(self, job):
+        return JobProfile(self, job)
+
+HISTORY_DB = os.path.join(os.path.expanduser("~"), ".pico_revival_history.db")
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    batch_id INTEGER,
+    kind TEXT NOT NULL,
+    device_id TEXT,
+    drive TEXT,
+    hub TEXT,
+    usb_port TEXT,
+    label TEXT,
+    firmware_path TEXT,
+    firmware_sha256 TEXT,
+    personalization_id TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    phases TEXT,
+    smoke_test TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_device ON jobs (device_id, finished);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+CREATE INDEX IF NOT EXISTS jobs_hub ON jobs (hub, finished);
+CREATE INDEX IF NOT EXISTS jobs_firmware ON jobs (firmware_sha256, finished);
+"""
+
+def job_device_id(job):
+    """Best available identity of the board a job ran on: its personalization id, USB port or drive."""
+    return job.personalization_id or job.usb_port or job.drive
+
+class FlashHistory:
+    """
+    SQLite (WAL) log of finished jobs. record() only queues a snapshot; a background
+    thread inserts them in batches so the flashing path never waits on the disk.
+    """
+    def __init__(self, path=HISTORY_DB, batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        with self._connect() as conn:
+            conn.executescript(HISTORY_SCHEMA)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(self, job):
+        """Queues a finished job for insertion."""
+        duration = job.finished - job.started if job.started and job.finished else None
+        self._queue.put((
+            job.batch_id, job.kind, job_device_id(job), job.drive, job.hub, job.usb_port, job.label,
+            job.firmware_path, job.firmware_sha256, job.personalization_id, job.state, job.error,
+            job.started, job.finished, duration, json.dumps(job.phases),
+            json.dumps(job.smoke_test) if job.smoke_test else None,
+        ))
+
+    def _write_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            rows = []
+            try:
+                rows.append(self._queue.get())
+                deadline = time.monotonic() + self.flush_interval
+                while len(rows) < self.batch_size:
+                    rows.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                pass
+            if None in rows:
+                running = False
+                rows = [row for row in rows if row is not None]
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO jobs (batch_id, kind, device_id, drive, hub, usb_port, label, firmware_path, "
+                            "firmware_sha256, personalization_id, state, error, started, finished, duration, phases, "
+                            "smoke_test) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                except sqlite3.Error as e:
+                    logging.error(f"Could not write flash history: {str(e)}")
+            for _ in rows:
+                self._queue.task_done()
+        self._queue.task_done()
+        conn.close()
+
+    def flush(self):
+        """Blocks until every queued record has been written."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+    def query(self, sql, params=()):
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql, params)]
+
+    def recent(self, limit=100, device_id=None):
+        """Most recent jobs, optionally for one device."""
+        if device_id:
+            return self.query("SELECT * FROM jobs WHERE device_id = ? ORDER BY finished DESC LIMIT ?",
+                              (device_id, limit))
+        return self.query("SELECT * FROM jobs ORDER BY finished DESC LIMIT ?", (limit,))
+
+    def last_firmware(self, device_id):
+        """The last firmware successfully flashed onto a device, or None."""
+        rows = self.query("SELECT * FROM jobs WHERE device_id = ? AND kind = 'flash' AND state != 'failed' "
+                          "ORDER BY finished DESC LIMIT 1", (device_id,))
+        return rows[0] if rows else None
+
+    def failure_rates(self, group_by="hub", since=None):
+        """Job counts and failure rate per hub or firmware since a timestamp (default: midnight today)."""
+        column = {"hub": "hub", "firmware": "firmware_sha256", "device": "device_id"}[group_by]
+        if since is None:
+            since = time.mktime(time.localtime()[:3] + (0, 0, 0, 0, 0, -1))
+        return self.query(
+            f"SELECT {column} AS key, COUNT(*) AS jobs, SUM(state = 'failed') AS failed, "
+            f"AVG(state = 'failed') AS failure_rate, MAX(label) AS label FROM jobs "
+            f"WHERE finished >= ? GROUP BY {column} ORDER BY failure_rate DESC, jobs DESC", (since,))
+
+API_HOST = "127.0.0.1"
+API_PORT = 8765
+API_MAX_BODY = 1024 * 1024
+API_TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".pico_revival_api_token")
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+                404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 409: "Conflict",
+                415: "Unsupported Media Type", 500: "Internal Server Error"}
+
+class ControlApiServer:
+    """
+    Localhost HTTP API running its own asyncio loop on a background thread.
+    list_devices() and start_jobs(request) may block and run in the loop's executor;
+    publish() and track() feed job snapshots and server-sent events and never block
+    the caller. Requests must carry "Authorization: Bearer <token>" and a localhost
+    Host header, so web pages open in the operator's browser cannot reach it.
+    """
+    label = "HTTP API"
+
+    def __init__(self, list_devices, start_jobs, host=API_HOST, port=API_PORT, keep_finished=1000, token=None):
+        self.list_devices = list_devices
+        self.start_jobs = start_jobs
+        self.host = host
+        self.port = port
+        self.keep_finished = keep_finished
+        self.token = token or secrets.token_urlsafe(24)  # Per session, see write_token()
+        self.jobs = OrderedDict()  # job_id -> latest job snapshot
+        self._subscribers = set()
+        self._event_ids = itertools.count(1)
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Starts serving; raises OSError if the port cannot be bound."""
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle, self.host, self.port))
+                self.port = self._server.sockets[0].getsockname()[1]
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                self._loop.close()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        logging.info(f"{self.label} listening on http://{self.host}:{self.port}")
+
+    def write_token(self, path=API_TOKEN_FILE):
+        """Saves the session token where local line controllers can read it, readable by this user only."""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token + "\n")
+        return path
+
+    def stop(self):
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def track(self, snapshot):
+        """Registers a new job so it can be queried before its first event."""
+        self._call(self._update, snapshot["job_id"], "job", snapshot)
+
+    def publish(self, job_id, event, data):
+        """Forwards a job event to the snapshots and every event stream."""
+        self._call(self._update, job_id, event, data)
+
+    def _call(self, func, *args):
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _update(self, job_id, event, data):
+        snapshot = self.jobs.setdefault(job_id, {"job_id": job_id})
+        if event in ("job", "done", "batch_done"):
+            snapshot.update(data)
+        elif event == "state":
+            snapshot["state"] = data
+        elif event == "progress":
+            snapshot["progress"] = data
+        elif event == "phase":
+            snapshot["phase"] = data
+        if event == "done":
+            self._trim()
+
+        message = (next(self._event_ids), job_id, snapshot.get("batch_id"), event, data)
+        for subscriber in list(self._subscribers):
+            if subscriber.full():
+                subscriber.get_nowait()  # Drop the oldest event for clients that fall behind
+            subscriber.put_nowait(message)
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.get("finished")]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self.jobs[job_id]
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 30)
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 30)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length") or 0)
+            if length > API_MAX_BODY:
+                await self._respond(writer, 413, {"error": "Request body too large"})
+                return
+            body = await reader.readexactly(length) if length else b""
+            rejected = self._check(method, headers)
+            if rejected:
+                await self._respond(writer, *rejected)
+                return
+            await self._route(method, target, body, writer)
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            await self._respond(writer, 400, {"error": "Malformed request"})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error(f"HTTP API error: {str(e)}")
+            await self._respond(writer, 500, {"error": str(e)})
+        finally:
+            writer.close()
+
+    def _check(self, method, headers):
+        """Returns (status, error payload) for requests that must not reach _route, else None."""
+        # A Host other than our own means DNS rebinding or a proxy, not a local client
+        if headers.get("host", "").lower() not in (f"127.0.0.1:{self.port}", f"localhost:{self.port}"):
+            return 403, {"error": "Requests must be addressed to 127.0.0.1 or localhost"}
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not secrets.compare_digest(token.strip(), self.token):
+            return 401, {"error": f"Missing or wrong API token, see {API_TOKEN_FILE}"}
+        # Browsers only send application/json cross-origin after a CORS preflight, which we never allow
+        if method == "POST" and headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+            return 415, {"error": "Use Content-Type: application/json"}
+        return None
+
+    async def _route(self, method, target, body, writer):
+        url = urlparse(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+        loop = asyncio.get_running_loop()
+
+        if parts == ["devices"]:
+            if method != "GET":
+                return await self._respond(writer, 405, {"error": "Use GET"})
+            devices = await loop.run_in_executor(None, self.list_devices)
+            return await self._respond(writer, 200, {"devices": devices})
+
+        if parts == ["jobs"]:
+            if method == "GET":
+                return await self._respond(writer, 200, {"jobs": list(self.jobs.values())})
+            if method != "POST":
+                return await self._respond(writer, 405, {"error": "Use GET or POST"})
+            try:
+                request = json.loads(body or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("Request body must be a JSON object")
+                jobs = await loop.run_in_executor(None, self.start_jobs, request)
+            except (ValueError, KeyError) as e:
+                return await self._respond(writer, 400, {"error": str(e)})
+            except (FileNotFoundError, RuntimeError) as e:
+                return await self._respond(writer, 409, {"error": str(e)})
+            return await self._respond(writer, 202, {"jobs": jobs})
+
+        if len(parts) == 2 and parts[0] == "jobs":
+            if method != "GET":
+                return await self._respond(writer, 405, {"error": "Use GET"})
+            job = self.jobs.get(int(parts[1]))
+            if not job:
+                return await self._respond(writer, 404, {"error": f"No job {parts[1]}"})
+            return await self._respond(writer, 200, job)
+
+        if parts == ["events"]:
+            job_id = int(query["job"]) if "job" in query else None
+            batch_id = int(query["batch"]) if "batch" in query else None
+            return await self._stream_events(writer, job_id, batch_id)
+
+        await self._respond(writer, 404, {"error": f"Unknown endpoint {url.path}"})
+
+    async def _respond(self, writer, status, payload):
+        body = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _stream_events(self, writer, job_id=None, batch_id=None):
+        """Streams job events as server-sent events, optionally for one job or batch."""
+        subscriber = asyncio.Queue(maxsize=1000)
+        self._subscribers.add(subscriber)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        try:
+            # Start with the current state so late subscribers do not miss finished jobs
+            for job in list(self.jobs.values()):
+                if (job_id is None or job["job_id"] == job_id) and (batch_id is None or job.get("batch_id") == batch_id):
+                    writer.write(f"event: job\ndata: {json.dumps(job)}\n\n".encode())
+            await writer.drain()
+            while True:
+                try:
+                    event_id, job, batch, event, data = await asyncio.wait_for(subscriber.get(), 15)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                    await writer.drain()
+                    continue
+                if (job_id is not None and job != job_id) or (batch_id is not None and batch != batch_id):
+                    continue
+                payload = json.dumps({"job_id": job, "batch_id": batch, "data": data})
+                writer.write(f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n".encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._subscribers.discard(subscriber)
+
+class PeerCacheServer(ControlApiServer):
+    """
+    Serves a PeerStore to other stations over HTTP: GET /peer/v1/index lists the
+    content hashes held here, GET /peer/v1/objects/<sha256> returns one of them.
+    """
+    label = "Peer cache"
+
+    def __init__(self, store, host="0.0.0.0", port=PEER_PORT):
+        super().__init__(None, None, host=host, port=port)
+        self.store = store
+        self.served = 0  # Bytes sent to peers
+
+    def _check(self, method, headers):
+        # Read-only and content-addressed, and peers reach it by their own LAN address
+        return None
+
+    async def _route(self, method, target, body, writer):
+        path = urlparse(target).path.rstrip("/")
+        if method != "GET":
+            return await self._respond(writer, 405, {"error": "Use GET"})
+        loop = asyncio.get_running_loop()
+        if path == "/peer/v1/index":
+            # Hashing new library files blocks, keep it off the loop
+            objects = await loop.run_in_executor(None, self.store.objects)
+            return await self._respond(writer, 200, {"objects": objects})
+        parts = path.split("/")
+        if len(parts) == 5 and parts[:4] == ["", "peer", "v1", "objects"] and SHA256_RE.match(parts[4]):
+            file_path = await loop.run_in_executor(None, self.store.path, parts[4])
+            if not file_path:
+                return await self._respond(writer, 404, {"error": f"No object {parts[4]}"})
+            with open(file_path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                             f"Content-Length: {size}\r\nConnection: close\r\n\r\n".encode())
+                while True:
+                    chunk = await loop.run_in_executor(None, f.read, PEER_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+                    self.served += len(chunk)
+            return
+        await self._respond(writer, 404, {"error": f"Unknown endpoint {path}"})
+
+class JobSignals(QObject):
+    """Carries job events from worker threads to the GUI thread."""
+    event = pyqtSignal(int, str, object)
+    batch_done = pyqtSignal(object)
+
+class EventLoopLagMonitor(QObject):
+    """
+    Measures Qt event-loop lag: how much later than scheduled a repeating timer
+    on the GUI thread fires. Lags above stall_ms are logged as UI stalls.
+    """
+    def __init__(self, interval_ms=50, stall_ms=100, parent=None):
+        super().__init__(parent)
+        self.interval = interval_ms / 1000
+        self.stall = stall_ms / 1000
+        self.lags = deque(maxlen=20000)
+        self.stalls = []  # (time, lag in seconds)
+        self._last = None
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self._tick)
+
+    def start(self):
+        self._last = time.perf_counter()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def _tick(self):
+        now = time.perf_counter()
+        lag = max(0.0, now - self._last - self.interval)
+        self._last = now
+        self.lags.append(lag)
+        if lag >= self.stall:
+            self.stalls.append((time.time(), lag))
+            logging.warning(f"GUI event loop stalled for {lag * 1000:.0f} ms")
+
+    def stats(self):
+        lags = sorted(self.lags)
+        if not lags:
+            return {"samples": 0, "mean_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0, "stalls": len(self.stalls)}
+        return {"samples": len(lags), "mean_ms": sum(lags) / len(lags) * 1000,
+                "p99_ms": lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, "max_ms": lags[-1] * 1000,
+                "stalls": len(self.stalls)}
+
 class PicoFlasher(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -632,13 +5326,79 @@ class PicoFlasher(QMainWindow):
         # For custom firmware
         self.custom_firmware_path = None
 
+        # (family, base address) used to convert non-UF2 firmware, keyed by firmware type
+        self.firmware_options = {}
+
+        # Library folders synced to CIRCUITPY/lib besides adafruit_hid
+        self.extra_library_paths = []
+
+        # Per-device data patched into each flashed image, if loaded
+        self.personalization = None
+
+        # Rules picking the firmware per board for mixed RP2040/RP2350 batches, if loaded
+        self.routing_rules = []
+
+        # Steps run on each board when flashing, see RECIPES
+        self.flash_recipe = "flash"
+        self.erase_preset = "full"
+
+        # Firmware images are read from disk once and shared by all jobs
+        self.firmware_cache = FirmwareCache()
+
+        # Flash jobs run on a backend and report back through job_signals
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()  # Jobs are also submitted from worker and HTTP API threads
+        self.job_signals = JobSignals()
+        self.job_signals.event.connect(self.on_job_event)
+        self.job_signals.batch_done.connect(self.on_batch_done)
+        self.smoke_test = ReplSmokeTest()
+        self.api_server = None  # Local HTTP control API, if enabled
+        self.profiler = None  # Profiling mode, if enabled
+        self.lag_monitor = None
+        self.trace_recorder = None  # Device timing recorder, if enabled
+        try:
+            self.history = FlashHistory()
+        except sqlite3.Error as e:
+            logging.error(f"Flash history unavailable: {str(e)}")
+            self.history = None
+        self.usb_topology = UsbTopology()
+        self.inventory = DeviceInventory(self.usb_topology)
+        self.hub_limit = None  # Writes per USB hub, None tunes it from measured throughput
+        self.device_model = DeviceTableModel(parent=self)
+        self.flash_backend = ThreadedFlashBackend(self.firmware_cache, self.report_job_event)
+
+        # Lets helper threads log and refresh the drive list on the GUI thread
+        self.ui_signals = WorkerSignals()
+        self.ui_signals.message.connect(self.log_to_console)
+        self.ui_signals.finished.connect(self.refresh_drives)
+
         # Download source and extraction folder
         self.download_url = "https://www.tstp.xyz/downloads/tools/TSTP-Pico_Revival.rar"
         self.extract_folder = r"C:\TSTP\TSTP-Pico_Revival"
 
+        # Index of the UF2 images in the firmware library folders, kept current by a watcher
+        self.firmware_index = FirmwareIndex(directories=[os.path.dirname(os.path.abspath(__file__)), self.extract_folder])
+        self.index_watcher = QFileSystemWatcher(self)
+        self.index_watcher.directoryChanged.connect(lambda _: self.index_timer.start())
+        self.index_timer = QTimer(self)
+        self.index_timer.setSingleShot(True)
+        self.index_timer.setInterval(500)  # Let copies finish before rescanning
+        self.index_timer.timeout.connect(self.rescan_firmware_index)
+
+        # Background conditional update checks for the bundle and firmware manifests
+        self.update_checker = UpdateChecker()
+        self.update_timer = QTimer(self)
+        self.update_timer.timeout.connect(lambda: self.run_in_thread(self.check_for_updates))
+        self.update_timer.start(UPDATE_CHECK_INTERVAL * 1000)
+        self.peer_server = None  # Serves the peer store to other stations, if the LAN peer cache is on
+
         self.setup_menu()
         self.setup_ui()
-        
+
+        # The peer cache stays on across restarts, the first download may already come from a peer
+        if "peer_cache" in self.update_checker.state:
+            self.peer_cache_action.setChecked(True)
+
         # Attempt to find or download the required files
         self.check_and_download_files()
 
@@ -652,6 +5412,7 @@ class PicoFlasher(QMainWindow):
         menubar.setStyleSheet("QMenuBar {background-color: #333333;} QMenuBar::item:selected {background-color: #0d47a1;}")
 
         file_menu = menubar.addMenu('File')
+        tools_menu = menubar.addMenu('Tools')
         help_menu = menubar.addMenu('Help')
 
         # File menu actions
@@ -659,11 +5420,125 @@ class PicoFlasher(QMainWindow):
         select_files_action.triggered.connect(self.select_all_files)
         file_menu.addAction(select_files_action)
 
+        add_firmware_folder_action = QAction('Add Firmware Folder...', self)
+        add_firmware_folder_action.triggered.connect(self.add_firmware_folder)
+        file_menu.addAction(add_firmware_folder_action)
+
         exit_action = QAction('Exit', self)
         exit_action.triggered.connect(self.close)
         file_menu.addAction(exit_action)
 
+        # Tools menu actions
+        self.process_workers_action = QAction('Use Worker Processes', self)
+        self.process_workers_action.setCheckable(True)
+        self.process_workers_action.toggled.connect(
+            lambda checked: self.set_flash_backend("process" if checked else "thread"))
+        tools_menu.addAction(self.process_workers_action)
+
+        reboot_action = QAction('Reboot Boards to Bootloader', self)
+        reboot_action.triggered.connect(lambda: self.run_in_thread(self.reboot_boards_to_bootloader))
+        tools_menu.addAction(reboot_action)
+
+        self.auto_bootsel_action = QAction('Reboot Boards to Bootloader Before Flashing', self)
+        self.auto_bootsel_action.setCheckable(True)
+        self.auto_bootsel_action.toggled.connect(lambda _: self.update_button_states())
+        tools_menu.addAction(self.auto_bootsel_action)
+
+        self.picoboot_action = QAction('Flash over USB (PICOBOOT) Without Mounting', self)
+        self.picoboot_action.setCheckable(True)
+        self.picoboot_action.setEnabled(usb is not None)
+        self.picoboot_action.toggled.connect(lambda _: self.update_button_states())
+        tools_menu.addAction(self.picoboot_action)
+
+        sync_action = QAction('Sync Libraries to CIRCUITPY', self)
+        sync_action.triggered.connect(lambda: self.run_in_thread(self.sync_libraries_to_devices))
+        tools_menu.addAction(sync_action)
+
+        add_library_action = QAction('Add Library Folder...', self)
+        add_library_action.triggered.connect(self.add_library_folder)
+        tools_menu.addAction(add_library_action)
+
+        personalize_action = QAction('Load Personalization Records...', self)
+        personalize_action.triggered.connect(self.select_personalization)
+        tools_menu.addAction(personalize_action)
+
+        self.route_action = QAction('Route Firmware by Board (RP2040/RP2350)', self)
+        self.route_action.setCheckable(True)
+        tools_menu.addAction(self.route_action)
+
+        routing_rules_action = QAction('Load Firmware Routing Rules...', self)
+        routing_rules_action.triggered.connect(self.select_routing_rules)
+        tools_menu.addAction(routing_rules_action)
+
+        clear_personalize_action = QAction('Clear Personalization Records', self)
+        clear_personalize_action.triggered.connect(self.clear_personalization)
+        tools_menu.addAction(clear_personalize_action)
+
+        self.smoke_test_action = QAction('Smoke Test After Flashing', self)
+        self.smoke_test_action.setCheckable(True)
+        tools_menu.addAction(self.smoke_test_action)
+
+        smoke_snippet_action = QAction('Smoke Test Snippet...', self)
+        smoke_snippet_action.triggered.connect(self.select_smoke_test)
+        tools_menu.addAction(smoke_snippet_action)
+
+        recipe_action = QAction('Flash Recipe...', self)
+        recipe_action.triggered.connect(self.select_flash_recipe)
+        tools_menu.addAction(recipe_action)
+
+        erase_preset_action = QAction('Erase Preset...', self)
+        erase_preset_action.triggered.connect(self.select_erase_preset)
+        tools_menu.addAction(erase_preset_action)
+
+        hub_limit_action = QAction('Writes per USB Hub...', self)
+        hub_limit_action.triggered.connect(self.select_hub_limit)
+        tools_menu.addAction(hub_limit_action)
+
+        compress_action = QAction('Compress Firmware Store', self)
+        compress_action.triggered.connect(lambda: self.run_in_thread(self.compress_firmware_store))
+        tools_menu.addAction(compress_action)
+
+        self.api_action = QAction('Local HTTP API', self)
+        self.api_action.setCheckable(True)
+        self.api_action.toggled.connect(self.set_api_enabled)
+        tools_menu.addAction(self.api_action)
+
+        self.peer_cache_action = QAction('LAN Peer Cache', self)
+        self.peer_cache_action.setCheckable(True)
+        self.peer_cache_action.toggled.connect(self.set_peer_cache_enabled)
+        tools_menu.addAction(self.peer_cache_action)
+
+        inventory_action = QAction('Scan Device Inventory', self)
+        inventory_action.triggered.connect(lambda: self.run_in_thread(self.scan_inventory))
+        tools_menu.addAction(inventory_action)
+
+        export_inventory_action = QAction('Export Device Inventory...', self)
+        export_inventory_action.triggered.connect(self.export_inventory)
+        tools_menu.addAction(export_inventory_action)
+
+        history_action = QAction('Flash History', self)
+        history_action.triggered.connect(self.show_history)
+        tools_menu.addAction(history_action)
+
+        self.profiling_action = QAction('Profiling Mode', self)
+        self.profiling_action.setCheckable(True)
+        self.profiling_action.toggled.connect(self.set_profiling_enabled)
+        tools_menu.addAction(self.profiling_action)
+
+        self.record_trace_action = QAction('Record Device Timings', self)
+        self.record_trace_action.setCheckable(True)
+        self.record_trace_action.toggled.connect(self.set_trace_recording)
+        tools_menu.addAction(self.record_trace_action)
+
+        diagnostics_action = QAction('Diagnostics', self)
+        diagnostics_action.triggered.connect(self.show_diagnostics)
+        tools_menu.addAction(diagnostics_action)
+
         # Help menu actions
+        update_action = QAction('Check for Updates', self)
+        update_action.triggered.connect(lambda: self.run_in_thread(self.check_for_updates))
+        help_menu.addAction(update_action)
+
         tutorial_action = QAction('Tutorial', self)
         tutorial_action.triggered.connect(self.show_tutorial)
         help_menu.addAction(tutorial_action)
@@ -802,6 +5677,16 @@ class PicoFlasher(QMainWindow):
 
         main_layout.addWidget(button_container)
 
+        # One row per device with its current job
+        self.device_table = QTableView()
+        self.device_table.setModel(self.device_model)
+        self.device_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.device_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.device_table.verticalHeader().setVisible(False)
+        self.device_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.device_table.horizontalHeader().setStretchLastSection(True)
+        main_layout.addWidget(self.device_table)
+
         # Console output
         self.console = QTextEdit()
         self.console.setReadOnly(True)
@@ -834,50 +5719,42 @@ class PicoFlasher(QMainWindow):
                 self.log_to_console(f"{device_type} not found!")
                 return
 
-            self.log_to_console(f"Resetting {friendly_name} using flash_nuke.uf2...")
-            if not self.flash_nuke_path or not os.path.exists(self.flash_nuke_path):
-                raise FileNotFoundError("Nuke firmware (flash_nuke.uf2) is missing.")
-            
+            self.log_to_console(f"Resetting {friendly_name} ({ERASE_PRESETS[self.erase_preset]})...")
+            self.submit_jobs(self.build_reset_jobs(device_type, friendly_name, [drive]))
+
+        except Exception as e:
+            self.log_to_console(f"Error during {friendly_name} reset: {str(e)}")
+            logging.error(f"Reset error: {str(e)}")
+
+    def build_reset_jobs(self, device_type, friendly_name, drives):
+        """Creates one flash_nuke reset job per drive."""
+        if not self.flash_nuke_path or not os.path.exists(self.flash_nuke_path):
+            raise FileNotFoundError("Nuke firmware (flash_nuke.uf2) is missing.")
+
+        self.usb_topology.refresh()
+        batch_id = None
+        jobs = []
+        for drive in drives:
             # Ensure drive exists and is writable
             if not os.path.exists(drive):
                 raise RuntimeError(f"Drive {drive} not found")
-                
+
             dest_path = os.path.join(drive, "flash_nuke.uf2")
-            
+
             # Try to open file for writing first to verify permissions
             try:
                 with open(dest_path, 'wb') as _:
                     pass
             except PermissionError:
                 raise RuntimeError(f"Cannot write to {drive}. Please check permissions.")
-                
-            # Copy the file with verification
-            shutil.copy2(self.flash_nuke_path, dest_path)
-            
-            # Verify the file was copied
-            if not os.path.exists(dest_path):
-                raise RuntimeError("File transfer failed - file not found on destination drive")
-                
-            if os.path.getsize(self.flash_nuke_path) != os.path.getsize(dest_path):
-                raise RuntimeError("File transfer failed - size mismatch")
-                
-            self.log_to_console("Reset file transferred successfully. Waiting for drive to reconnect...")
 
-            # Give it a moment, then refresh
-            time.sleep(10)
-            self.refresh_drives()
-            
-            # Check if drive is still active
-            if self.find_drive(self.get_available_drives(), device_type):
-                self.log_to_console(f"Reset completed successfully - {device_type} drive detected")
-                QTimer.singleShot(0, lambda: QMessageBox.information(self, "Success", f"{friendly_name} reset completed successfully!"))
-            else:
-                self.log_to_console(f"Warning: {device_type} drive not detected after reset")
-                QTimer.singleShot(0, lambda: QMessageBox.warning(self, "Warning", f"{device_type} drive not detected after reset. Please check the connection."))
-
-        except Exception as e:
-            self.log_to_console(f"Error during {friendly_name} reset: {str(e)}")
-            logging.error(f"Reset error: {str(e)}")
+            job = FlashJob("reset", drive, friendly_name, nuke_path=self.flash_nuke_path, expect_volume=device_type,
+                           batch_id=batch_id, hub=self.usb_topology.hub_for(drive),
+                           usb_port=self.usb_topology.port_for(drive))
+            batch_id = job.batch_id
+            jobs.append(job)
+        prepare_erase_images(jobs, self.erase_preset, log=self.ui_signals.message.emit)
+        return jobs
 
     def check_and_download_files(self):
         """
@@ -886,9 +5763,7 @@ class PicoFlasher(QMainWindow):
         and extract to self.extract_folder.
         """
         # First check if we already have what we need
-        if os.path.exists(os.path.join(self.extract_folder, "flash_nuke.uf2")) \
-           and os.path.exists(os.path.join(self.extract_folder, "RPI_PICO-20241129-v1.24.1.uf2")) \
-           and os.path.exists(os.path.join(self.extract_folder, "adafruit-circuitpython-raspberry_pi_pico-en_US-9.2.1.uf2")):
+        if self.bundle_present():
             self.log_to_console("All required firmware files found locally.")
             # Proceed to find them
             self.find_required_files()
@@ -934,9 +5809,32 @@ class PicoFlasher(QMainWindow):
         self.download_signals.error.connect(self.on_download_error)
         self.download_signals.finished.connect(self.on_download_finished)
 
-        worker = DownloadWorker(self.download_url, self.extract_folder, self.download_signals)
+        worker = DownloadWorker(self.download_url, self.extract_folder, self.download_signals,
+                                peers=self.update_checker.peers, store=self.update_checker.store)
         worker.start()
 
+    def bundle_present(self):
+        """True if the files extracted from the download bundle are in self.extract_folder."""
+        return all(any(os.path.exists(os.path.join(self.extract_folder, name + suffix))
+                       for suffix in ("",) + COMPRESSED_SUFFIXES) for name in (
+            "flash_nuke.uf2", "RPI_PICO-20241129-v1.24.1.uf2",
+            "adafruit-circuitpython-raspberry_pi_pico-en_US-9.2.1.uf2"))
+
+    def check_for_updates(self):
+        """Asks the server whether the bundle or any manifest firmware changed and downloads only those."""
+        try:
+            self.ui_signals.message.emit("Checking for firmware updates...")
+            updated = self.update_checker.check(self.download_url, self.extract_folder,
+                                                bundle_present=self.bundle_present(),
+                                                log=self.ui_signals.message.emit)
+            if not updated:
+                self.ui_signals.message.emit("No firmware updates available.")
+        except requests.exceptions.RequestException as e:
+            self.ui_signals.message.emit(f"Update check failed: {str(e)}")
+        except Exception as e:
+            self.ui_signals.message.emit(f"Error updating firmware: {str(e)}")
+            logging.error(f"Update error: {str(e)}")
+
     def on_download_error(self, msg):
         self.log_to_console(f"Download error: {msg}")
 
@@ -949,33 +5847,75 @@ class PicoFlasher(QMainWindow):
         """(Deprecated) Moved logic to find_required_files()."""
 
     def find_required_files(self):
-        """Locate the firmware files in self.extract_folder or script path."""
-        search_paths = [
-            os.path.dirname(os.path.abspath(__file__)),
-            self.extract_folder,
-        ]
-
-        for path in search_paths:
-            if os.path.exists(os.path.join(path, "flash_nuke.uf2")) and not self.flash_nuke_path:
-                self.flash_nuke_path = os.path.join(path, "flash_nuke.uf2")
+        """Locate the firmware files in the firmware index, preferring the bundled releases."""
+        self.rescan_firmware_index()
 
-            if os.path.exists(os.path.join(path, "RPI_PICO-20241129-v1.24.1.uf2")) and not self.micropython_path:
-                self.micropython_path = os.path.join(path, "RPI_PICO-20241129-v1.24.1.uf2")
+        def indexed(name, kind):
+            entry = self.firmware_index.find(name) or next(iter(self.firmware_index.images(kind)), None)
+            return entry["path"] if entry else None
 
-            if os.path.exists(os.path.join(path, "adafruit-circuitpython-raspberry_pi_pico-en_US-9.2.1.uf2")) and not self.circuitpython_path:
-                self.circuitpython_path = os.path.join(path, "adafruit-circuitpython-raspberry_pi_pico-en_US-9.2.1.uf2")
+        if not self.flash_nuke_path:
+            self.flash_nuke_path = indexed("flash_nuke.uf2", "nuke")
+        if not self.micropython_path:
+            self.micropython_path = indexed("RPI_PICO-20241129-v1.24.1.uf2", "micropython")
+        if not self.circuitpython_path:
+            self.circuitpython_path = indexed("adafruit-circuitpython-raspberry_pi_pico-en_US-9.2.1.uf2", "circuitpython")
 
+        for path in self.firmware_index.directories:
             if os.path.exists(os.path.join(path, "adafruit_hid")) and not self.adafruit_hid_path:
                 self.adafruit_hid_path = os.path.join(path, "adafruit_hid")
 
         self.update_button_states()
         self.log_missing_files()
 
+    def rescan_firmware_index(self):
+        """Incrementally rescans the firmware folders and watches every folder it visited."""
+        changed, directories = self.firmware_index.scan()
+        watched = set(self.index_watcher.directories())
+        new_dirs = [d for d in directories if d not in watched]
+        if new_dirs:
+            self.index_watcher.addPaths(new_dirs)
+        if changed:
+            logging.info(f"Firmware index updated ({changed} change(s), {len(self.firmware_index.entries)} image(s))")
+
+    def compress_firmware_store(self):
+        """Compresses the uncompressed UF2 images in the download folder to save disk space."""
+        folder = os.path.join(os.path.abspath(self.extract_folder), "")
+        entries = [e for e in self.firmware_index.images()
+                   if not e.get("compression") and e["path"].startswith(folder)]
+        if not entries:
+            self.ui_signals.message.emit("No uncompressed firmware to compress.")
+            return
+        saved = 0
+        for entry in entries:
+            try:
+                path = compress_firmware(entry["path"])
+                saved += entry["size"] - os.path.getsize(path)
+                self.ui_signals.message.emit(f"Compressed {entry['name']} "
+                                             f"({os.path.getsize(path) / entry['size'] * 100:.0f}% of original)")
+            except Exception as e:
+                self.ui_signals.message.emit(f"Error compressing {entry['name']}: {str(e)}")
+                logging.error(f"Compression error: {str(e)}")
+        self.ui_signals.message.emit(f"Firmware store compressed, {saved / 1048576:.1f} MB saved.")
+
+    def add_firmware_folder(self):
+        """Adds a folder to the firmware library and indexes its UF2 images."""
+        folder = QFileDialog.getExistingDirectory(self, "Select Firmware Folder")
+        if not folder:
+            return
+        self.firmware_index.add_directory(folder)
+        self.rescan_firmware_index()
+        count = sum(1 for e in self.firmware_index.images() if e["path"].startswith(os.path.join(os.path.abspath(folder), "")))
+        self.log_to_console(f"Firmware folder added: {folder} ({count} UF2 image(s))")
+
     def update_button_states(self):
         # Check if RPI-RP2 drive is selected
         current_drive = self.drive_combo.currentText()
         is_rp2_drive = "RPI-RP2" in current_drive
 
+        # Boards running from flash can be rebooted into RPI-RP2 mode right before flashing
+        is_rp2_drive = is_rp2_drive or self.auto_bootsel_action.isChecked() or self.picoboot_action.isChecked()
+
         # Only enable buttons if RPI-RP2 drive is selected AND required files exist
         can_flash_micro = bool(self.flash_nuke_path and self.micropython_path and is_rp2_drive)
         can_flash_circuit = bool(self.flash_nuke_path and self.circuitpython_path and is_rp2_drive)
@@ -1071,13 +6011,7 @@ class PicoFlasher(QMainWindow):
         self.check_drive()
 
     def get_volume_name(self, drive):
-        if sys.platform == 'win32':
-            import win32api
-            try:
-                return win32api.GetVolumeInformation(drive + "\\")[0]
-            except:
-                return None
-        return None
+        return get_volume_name(drive)
 
     def check_drive(self):
         current_drive = self.drive_combo.currentData()
@@ -1100,35 +6034,41 @@ class PicoFlasher(QMainWindow):
             self.status_label.setText("Please select a valid drive")
 
             # Disable firmware buttons if not RPI-RP2
-            self.micropython_button.setEnabled(False)
-            self.circuitpython_button.setEnabled(False)
-            self.flash_custom_fw_button.setEnabled(False)
+            self.update_button_states()
 
     def get_available_drives(self):
         """Returns a list of available drives on Windows."""
-        if sys.platform == 'win32':
-            from ctypes import windll
-            drives = []
-            bitmask = windll.kernel32.GetLogicalDrives()
-            for letter in range(65, 91):
-                if bitmask & 1:
-                    drives.append(chr(letter) + ":")
-                bitmask >>= 1
-            return drives
-        return []
+        return get_available_drives()
 
     def find_drive(self, drives, name):
         """Find a drive by volume name among the currently available drives."""
-        for drive in drives:
-            volume_name = self.get_volume_name(drive)
-            if volume_name == name:
-                return drive + "\\"
-        return None
+        return find_drive(drives, name)
 
     def select_custom_firmware(self, firmware_type):
-        """Select a custom .uf2 firmware file for micro, circuit, or a completely custom firmware."""
-        file_path, _ = QFileDialog.getOpenFileName(self, "Select Firmware File", "", "UF2 Files (*.uf2)")
+        """Select a firmware for micro, circuit, or custom from the firmware index, or browse for a file."""
+        kind = {"micro": "micropython", "circuit": "circuitpython"}.get(firmware_type)
+        entries = [e for e in self.firmware_index.images(kind) if e["kind"] != "nuke"]
+        browse = "Browse..."
+        file_path = None
+        if entries:
+            items = [describe_index_entry(e) for e in entries] + [browse]
+            choice, ok = QInputDialog.getItem(self, "Select Firmware", "Firmware from your library:", items, 0, False)
+            if not ok:
+                return
+            if choice != browse:
+                file_path = entries[items.index(choice)]["path"]
+        if not file_path:
+            file_path, _ = QFileDialog.getOpenFileName(self, "Select Firmware File", "",
+                                                       "Firmware Files (*.uf2 *.uf2.zst *.uf2.xz *.bin *.hex *.elf);;"
+                                                       "UF2 Files (*.uf2)")
+            if file_path and file_path.lower().endswith(".uf2") and \
+                    self.firmware_index.add_directory(os.path.dirname(file_path)):
+                self.rescan_firmware_index()
         if file_path:
+            options = self.select_conversion_options(file_path)
+            if options is None:
+                return
+            self.firmware_options[firmware_type] = options
             if firmware_type == "micro":
                 self.micropython_path = file_path
                 self.log_to_console("MicroPython firmware selected.")
@@ -1140,74 +6080,1204 @@ class PicoFlasher(QMainWindow):
                 self.log_to_console("Custom firmware selected.")
             self.update_button_states()
 
+    def select_conversion_options(self, file_path):
+        """Asks for the UF2 family (and base address for .bin files) of a non-UF2 firmware file."""
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext == ".uf2":
+            return (None, None)
+        families = [name for name in FAMILY_IDS if name not in ("ABSOLUTE", "DATA")]
+        name, ok = QInputDialog.getItem(self, "Convert to UF2", f"Target chip for {os.path.basename(file_path)}:",
+                                        families, 0, False)
+        if not ok:
+            return None
+        base_address = None
+        if ext == ".bin":
+            text, ok = QInputDialog.getText(self, "Convert to UF2", "Flash address of the binary:",
+                                            text=f"0x{RP2_FLASH_BASE:08X}")
+            if not ok:
+                return None
+            try:
+                base_address = int(text, 0)
+            except ValueError:
+                self.log_to_console(f"Invalid flash address: {text}")
+                return None
+        self.log_to_console(f"{os.path.basename(file_path)} will be converted to UF2 for {name}.")
+        return (FAMILY_IDS[name], base_address)
+
+    def reboot_boards_to_bootloader(self):
+        """Reboots every Pico that shows up as a CDC serial port into BOOTSEL mode."""
+        try:
+            ports = find_pico_serial_ports()
+            if not ports:
+                self.ui_signals.message.emit("No Pico serial ports found.")
+                return []
+            self.ui_signals.message.emit(f"Rebooting {len(ports)} board(s) into bootloader mode...")
+            return reboot_to_bootloader(ports, log=self.ui_signals.message.emit)
+        except Exception as e:
+            self.ui_signals.message.emit(f"Error rebooting to bootloader: {str(e)}")
+            logging.error(f"Bootloader reboot error: {str(e)}")
+            return []
+        finally:
+            self.ui_signals.finished.emit()
+
     def flash_firmware(self, firmware_type):
-        """Flashes MicroPython, CircuitPython, or a custom firmware onto the Pico."""
+        """Flashes MicroPython, CircuitPython, or a custom firmware onto every attached Pico."""
+        try:
+            if self.auto_bootsel_action.isChecked():
+                self.reboot_boards_to_bootloader()
+
+            transport = "picoboot" if self.picoboot_action.isChecked() else "msc"
+            if transport == "picoboot":
+                drives = [d["drive"] for d in find_picoboot_devices()]
+                if not drives:
+                    self.log_to_console("No Pico in BOOTSEL mode found on USB!")
+                    return
+            else:
+                drives = find_drives("RPI-RP2")
+                if not drives:
+                    self.log_to_console("Pico (RPI-RP2) not found!")
+                    return
+
+            if self.route_action.isChecked() or self.routing_rules:
+                self.submit_jobs(self.build_routed_jobs(firmware_type, drives, transport))
+            else:
+                self.submit_jobs(self.build_flash_jobs(firmware_type, drives, transport=transport))
+
+        except Exception as e:
+            self.log_to_console(f"Error during flashing: {str(e)}")
+            logging.error(f"Flashing error: {str(e)}")
+
+    def selected_firmware(self, firmware_type):
+        return {"micro": self.micropython_path, "circuit": self.circuitpython_path}.get(
+            firmware_type, self.custom_firmware_path)
+
+    def build_flash_jobs(self, firmware_type, drives, firmware_path=None, transport="msc", batch_id=None):
+        """
+        Creates one flash job per drive for micro, circuit or custom firmware, or for firmware_path.
+        With transport="picoboot" the drives are usb:<port> names from find_picoboot_devices.
+        """
+        if not self.flash_nuke_path or not os.path.exists(self.flash_nuke_path):
+            raise FileNotFoundError("Nuke firmware (flash_nuke.uf2) is missing. Cannot flash safely.")
+
+        family, base_address = self.firmware_options.get(firmware_type, (None, None))
+        if firmware_path:
+            firmware_name = os.path.basename(firmware_path)
+            if firmware_path != self.selected_firmware(firmware_type):
+                family, base_address = None, None
+        elif firmware_type == "micro":
+            firmware_path = self.micropython_path
+            firmware_name = "MicroPython"
+        elif firmware_type == "circuit":
+            firmware_path = self.circuitpython_path
+            firmware_name = "CircuitPython"
+        else:
+            # Custom firmware
+            firmware_path = self.custom_firmware_path
+            firmware_name = "Custom Firmware"
+
+        if not firmware_path or not os.path.exists(firmware_path):
+            raise FileNotFoundError(f"{firmware_name} firmware file not found.")
+
+        firmware_image = self.firmware_cache.get(firmware_path, family, base_address)
+        self.ui_signals.message.emit(f"Flashing {firmware_name} ({firmware_image.describe()}) onto {len(drives)} Pico(s)...")
+
+        recipe = RECIPES[self.flash_recipe]
+        expect_volume = "CIRCUITPY" if firmware_type == "circuit" or "sync" in recipe else None
+        library_paths = []
+        if "sync" in recipe:
+            library_paths = [path for path in [self.adafruit_hid_path] + self.extra_library_paths
+                             if path and os.path.isdir(path)]
+            if not library_paths:
+                raise FileNotFoundError("The flash recipe syncs libraries but no library folder is available.")
+
+        self.usb_topology.refresh()
+        jobs = []
+        for drive in drives:
+            if transport == "picoboot":
+                usb_port = drive[len(PICOBOOT_DRIVE_PREFIX):] if drive.startswith(PICOBOOT_DRIVE_PREFIX) else drive
+                drive, hub = PICOBOOT_DRIVE_PREFIX + usb_port, usb_parent_hub(usb_port)
+            else:
+                usb_port, hub = self.usb_topology.port_for(drive), self.usb_topology.hub_for(drive)
+            job = FlashJob("flash", drive, firmware_name, firmware_path=firmware_path,
+                           nuke_path=self.flash_nuke_path, expect_volume=expect_volume,
+                           batch_id=batch_id, hub=hub, usb_port=usb_port, firmware_family=family,
+                           base_address=base_address, transport=transport, library_paths=library_paths, recipe=recipe,
+                           smoke_check=(self.smoke_test.snippet, self.smoke_test.expect))
+            batch_id = job.batch_id
+            jobs.append(job)
+        prepare_erase_images(jobs, self.erase_preset, log=self.ui_signals.message.emit)
+        return jobs
+
+    def build_routed_jobs(self, firmware_type, drives, transport="msc"):
+        """
+        Flash jobs for a mixed batch: every board gets the selected firmware or another indexed
+        image of the same kind built for its chip, or the image a routing rule names. Boards
+        that cannot be routed are reported and left alone; nothing is written before all are routed.
+        """
+        kind = {"micro": "micropython", "circuit": "circuitpython"}.get(firmware_type, "custom")
+        candidates = [self.selected_firmware(firmware_type)] + [e["path"] for e in self.firmware_index.images(kind)]
+        family = self.firmware_options.get(firmware_type, (None, None))[0]
+        router = FirmwareRouter([path for path in candidates if path], self.routing_rules,
+                                families=lambda path: image_families(
+                                    path, family if path == self.selected_firmware(firmware_type) else None))
+        if transport == "picoboot":
+            records = [{"drive": d["drive"], "board_id": d["chip"]} for d in find_picoboot_devices()]
+        else:
+            records = self.inventory.scan(drives)
+        routes, rejected = router.plan(drives, records)
+        for drive, reason in rejected:
+            self.ui_signals.message.emit(f"Not flashing {drive}: {reason}")
+        if not routes:
+            raise RuntimeError("No board could be matched to a firmware image.")
+
+        jobs = []
+        for path, group in routes.items():
+            self.ui_signals.message.emit(f"{firmware_name(path)} -> {len(group)} board(s)")
+            jobs += self.build_flash_jobs(firmware_type, group, path, transport,
+                                          batch_id=jobs[0].batch_id if jobs else None)
+        return jobs
+
+    def select_routing_rules(self):
+        """Loads rules that pick the firmware per board model, board id or chip."""
+        path, _ = QFileDialog.getOpenFileName(self, "Select Firmware Routing Rules", "", "JSON Files (*.json)")
+        if not path:
+            return
+        try:
+            self.routing_rules = load_routing_rules(path)
+            self.log_to_console(f"{len(self.routing_rules)} firmware routing rule(s) loaded.")
+        except (OSError, ValueError, re.error) as e:
+            self.log_to_console(f"Error loading routing rules: {str(e)}")
+
+    def select_personalization(self):
+        """Loads per-device records that are patched into the firmware of each flashed board."""
+        path, _ = QFileDialog.getOpenFileName(self, "Select Personalization Records", "", "JSON Files (*.json)")
+        if not path:
+            return
         try:
-            rp2_drive = self.find_drive(self.get_available_drives(), "RPI-RP2")
-            if not rp2_drive:
-                self.log_to_console("Pico (RPI-RP2) not found!")
+            self.personalization = PersonalizationRecords(path)
+            self.log_to_console(f"Personalization records loaded: {self.personalization.remaining} unused.")
+        except Exception as e:
+            self.log_to_console(f"Error loading personalization records: {str(e)}")
+
+    def clear_personalization(self):
+        self.personalization = None
+        self.log_to_console("Personalization records cleared.")
+
+    def add_library_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select library folder")
+        if folder and folder not in self.extra_library_paths:
+            self.extra_library_paths.append(folder)
+            self.log_to_console(f"Library folder {os.path.basename(folder)} added to sync.")
+
+    def sync_libraries_to_devices(self):
+        """Syncs adafruit_hid and any added library folders to every attached CIRCUITPY drive."""
+        try:
+            drives = find_drives("CIRCUITPY")
+            if not drives:
+                self.log_to_console("CIRCUITPY drive not found!")
                 return
+            self.submit_jobs(self.build_sync_jobs(drives))
+        except Exception as e:
+            self.log_to_console(f"Error during library sync: {str(e)}")
+            logging.error(f"Library sync error: {str(e)}")
+
+    def build_sync_jobs(self, drives):
+        """Creates one library sync job per CIRCUITPY drive."""
+        sources = [path for path in [self.adafruit_hid_path] + self.extra_library_paths
+                   if path and os.path.isdir(path)]
+        if not sources:
+            raise FileNotFoundError("No library folders to sync. Please select the adafruit_hid folder.")
+
+        self.usb_topology.refresh()
+        self.ui_signals.message.emit(f"Syncing {', '.join(os.path.basename(s) for s in sources)} to {len(drives)} device(s)...")
+        batch_id = None
+        jobs = []
+        for drive in drives:
+            job = FlashJob("sync", drive, "Library", library_paths=sources, batch_id=batch_id,
+                           hub=self.usb_topology.hub_for(drive), usb_port=self.usb_topology.port_for(drive))
+            batch_id = job.batch_id
+            jobs.append(job)
+        return jobs
+
+    def submit_jobs(self, jobs):
+        """Personalizes flash jobs, registers jobs and hands them to the active flash backend."""
+        if self.personalization:
+            self.personalization.assign([job for job in jobs if job.kind == "flash"])
+        with self.jobs_lock:
+            for job in jobs:
+                self.jobs[job.job_id] = job
+        for job in jobs:
+            if self.api_server:
+                self.api_server.track(job.to_dict())
+        if threading.current_thread() is threading.main_thread():
+            self.device_model.add_jobs(jobs)
+        else:
+            QTimer.singleShot(0, self, lambda: self.device_model.add_jobs(jobs))
+        self.flash_backend.submit(jobs)
+
+    def report_job_event(self, job_id, event, data):
+        """Report callback of the flash backends, called from worker threads."""
+        self.device_model.post(job_id, event, data)
+        # The device grid polls progress itself; only the HTTP API needs every event delivered
+        if event in ("progress", "phase", "throughput", "hubs") and not self.api_server:
+            return
+        self.job_signals.event.emit(job_id, event, data)
+
+    def set_flash_backend(self, name):
+        """Switches between threaded and multi-process flashing for future jobs."""
+        with self.jobs_lock:
+            running = any(not job.is_finished for job in self.jobs.values())
+        if running:
+            self.log_to_console("Cannot switch flashing backend while jobs are running.")
+            self.process_workers_action.blockSignals(True)
+            self.process_workers_action.setChecked(self.flash_backend.name == "process")
+            self.process_workers_action.blockSignals(False)
+            return
+        self.flash_backend.shutdown()
+        self.flash_backend = create_flash_backend(name, self.firmware_cache, self.report_job_event,
+                                                  hub_limit=self.hub_limit)
+        if self.profiler:
+            self.flash_backend.set_profiler(self.profiler)
+        if self.trace_recorder:
+            self.flash_backend.set_recorder(self.trace_recorder)
+        self.log_to_console(f"Flashing backend set to {name}.")
+
+    def select_hub_limit(self):
+        """Asks for the number of concurrent writes allowed per USB hub (0 = automatic)."""
+        limit, ok = QInputDialog.getInt(self, "Writes per USB Hub",
+                                        "Concurrent writes per USB hub (0 = tune automatically):",
+                                        self.hub_limit or 0, 0, 32)
+        if not ok:
+            return
+        self.hub_limit = limit or None
+        self.flash_backend.set_hub_limit(self.hub_limit)
+        self.log_to_console(f"Writes per USB hub set to {limit or 'automatic'}.")
+
+    def select_flash_recipe(self):
+        """Chooses the steps run on each board when flashing, e.g. nuke -> firmware -> sync -> smoke test."""
+        names = list(RECIPES)
+        labels = [f"{name}: {' -> '.join(RECIPES[name])}" for name in names]
+        label, ok = QInputDialog.getItem(self, "Flash Recipe", "Steps run on each board:", labels,
+                                         names.index(self.flash_recipe), False)
+        if ok:
+            self.flash_recipe = names[labels.index(label)]
+            self.log_to_console(f"Flash recipe set to {label}.")
+
+    def select_erase_preset(self):
+        """Chooses what is erased before flashing or on reset: the full chip or only what the old firmware used."""
+        names = list(ERASE_PRESETS)
+        labels = list(ERASE_PRESETS.values())
+        label, ok = QInputDialog.getItem(self, "Erase Preset", "Erase before flashing and on reset:", labels,
+                                         names.index(self.erase_preset), False)
+        if ok:
+            self.erase_preset = names[labels.index(label)]
+            self.log_to_console(f"Erase preset set to {label}.")
+
+    def select_smoke_test(self):
+        """Edits the snippet run over the REPL after flashing and the regex its output must match."""
+        snippet, ok = QInputDialog.getMultiLineText(self, "Smoke Test Snippet",
+                                                    "Python code to run on each board:", self.smoke_test.snippet)
+        if not ok:
+            return
+        expect, ok = QInputDialog.getText(self, "Smoke Test Snippet",
+                                          "Regular expression the output must match:", text=self.smoke_test.expect)
+        if not ok:
+            return
+        try:
+            re.compile(expect)
+        except re.error as e:
+            QMessageBox.warning(self, "Warning", f"Invalid regular expression: {str(e)}")
+            return
+        self.smoke_test.snippet = snippet if snippet.endswith("\n") else snippet + "\n"
+        self.smoke_test.expect = expect
+        self.log_to_console("Smoke test snippet updated.")
+
+    def set_api_enabled(self, enabled, port=API_PORT):
+        """Starts or stops the localhost HTTP control API."""
+        if enabled and not self.api_server:
+            server = ControlApiServer(self.api_list_devices, self.api_start_jobs, port=port)
+            try:
+                server.start()
+            except OSError as e:
+                self.log_to_console(f"Could not start HTTP API on port {port}: {str(e)}")
+                self.api_action.blockSignals(True)
+                self.api_action.setChecked(False)
+                self.api_action.blockSignals(False)
+                return
+            with self.jobs_lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                server.track(job.to_dict())
+            self.api_server = server
+            try:
+                token_path = server.write_token()
+            except OSError as e:
+                token_path = None
+                self.log_to_console(f"Could not save the HTTP API token: {str(e)}")
+            self.log_to_console(f"HTTP API listening on http://{server.host}:{server.port}"
+                                + (f", token in {token_path}" if token_path else ""))
+        elif not enabled and self.api_server:
+            self.api_server.stop()
+            self.api_server = None
+            self.log_to_console("HTTP API stopped.")
+
+    def set_peer_cache_enabled(self, enabled):
+        """
+        Turns the LAN peer cache on or off. While on, this station serves its downloads and
+        firmware library to other stations and fetches updates from them before the origin.
+        """
+        if enabled and not self.peer_server:
+            settings = self.update_checker.state.get("peer_cache")
+            if settings is None:
+                text, ok = QInputDialog.getText(self, "LAN Peer Cache",
+                                                "Other stations (host:port, comma separated, empty to only serve):")
+                if not ok:
+                    self.peer_cache_action.blockSignals(True)
+                    self.peer_cache_action.setChecked(False)
+                    self.peer_cache_action.blockSignals(False)
+                    return
+                settings = {"peers": [peer.strip() for peer in text.split(",") if peer.strip()], "port": PEER_PORT}
+            store = PeerStore(files=lambda: [entry["path"] for entry in self.firmware_index.images()])
+            server = PeerCacheServer(store, port=settings.get("port", PEER_PORT))
+            try:
+                server.start()
+            except OSError as e:
+                self.log_to_console(f"Could not start the peer cache on port {server.port}: {str(e)}")
+                self.peer_cache_action.blockSignals(True)
+                self.peer_cache_action.setChecked(False)
+                self.peer_cache_action.blockSignals(False)
+                return
+            self.peer_server = server
+            self.update_checker.store = store
+            self.update_checker.peers = PeerClient(settings["peers"]) if settings["peers"] else None
+            self.update_checker.state["peer_cache"] = settings
+            self.update_checker.save()
+            peers = ", ".join(settings["peers"]) or "none, serving only"
+            self.log_to_console(f"Peer cache serving on port {server.port}, peers: {peers}")
+        elif not enabled and self.peer_server:
+            self.peer_server.stop()
+            self.peer_server = None
+            self.update_checker.store = self.update_checker.peers = None
+            self.update_checker.state.pop("peer_cache", None)
+            self.update_checker.save()
+            self.log_to_console("Peer cache stopped.")
+
+    def set_profiling_enabled(self, enabled, directory=PROFILE_DIR):
+        """
+        Turns profiling mode on or off. While on, every job writes a profile report and
+        the GUI thread's stacks and event-loop lag are recorded until it is turned off.
+        """
+        if enabled and not self.profiler:
+            profiler = Profiler(directory)
+            try:
+                profiler.start()
+            except OSError as e:
+                self.log_to_console(f"Could not start profiling: {str(e)}")
+                self.profiling_action.blockSignals(True)
+                self.profiling_action.setChecked(False)
+                self.profiling_action.blockSignals(False)
+                return
+            profiler.sampler.watch("ui")
+            self.lag_monitor = EventLoopLagMonitor(parent=self)
+            self.lag_monitor.start()
+            self.profiler = profiler
+            self.flash_backend.set_profiler(profiler)
+            self.log_to_console(f"Profiling mode on, reports are written to {profiler.directory}")
+        elif not enabled and self.profiler:
+            self.flash_backend.set_profiler(None)
+            self.lag_monitor.stop()
+            try:
+                write_collapsed(os.path.join(self.profiler.directory, "ui.collapsed"),
+                                self.profiler.sampler.take("ui"))
+                with open(os.path.join(self.profiler.directory, "ui-lag.json"), "w") as f:
+                    json.dump({"stats": self.lag_monitor.stats(),
+                               "stalls": [{"time": at, "lag_ms": lag * 1000} for at, lag in self.lag_monitor.stalls]},
+                              f, indent=2)
+            except OSError as e:
+                logging.error(f"Could not write UI profile: {str(e)}")
+            self.profiler.stop()
+            self.log_to_console(f"Profiling mode off, reports are in {self.profiler.directory}")
+            self.profiler = None
+            self.lag_monitor = None
+
+    def set_trace_recording(self, enabled):
+        """Starts or stops appending the device timeline of every job to the device trace file."""
+        self.trace_recorder = DeviceTraceRecorder() if enabled else None
+        self.flash_backend.set_recorder(self.trace_recorder)
+        if enabled:
+            self.log_to_console(f"Recording device timings to {self.trace_recorder.path}")
+        else:
+            self.log_to_console("Device timing recording off.")
 
-            if not self.flash_nuke_path or not os.path.exists(self.flash_nuke_path):
-                raise FileNotFoundError("Nuke firmware (flash_nuke.uf2) is missing. Cannot flash safely.")
+    def api_list_devices(self):
+        """Lists attached drives and Pico serial ports for the HTTP API."""
+        self.usb_topology.refresh()
+        devices = [{"drive": drive, "volume": get_volume_name(drive), "hub": self.usb_topology.hub_for(drive),
+                    "usb_port": self.usb_topology.port_for(drive)} for drive in get_available_drives()]
+        ports = find_pico_serial_ports() if serial else []
+        return {"drives": devices, "serial_ports": ports}
 
-            if firmware_type == "micro":
-                firmware_path = self.micropython_path
-                firmware_name = "MicroPython"
-            elif firmware_type == "circuit":
-                firmware_path = self.circuitpython_path
-                firmware_name = "CircuitPython"
+    def api_start_jobs(self, request):
+        """
+        Creates and submits jobs for an HTTP API request such as
+        {"kind": "flash", "firmware": "micropython", "drives": [...]}; returns their snapshots.
+        """
+        kind = request.get("kind", "flash")
+        drives = request.get("drives")
+        if kind == "flash":
+            if request.get("bootsel"):
+                self.reboot_boards_to_bootloader()
+            firmware_type = {"micropython": "micro", "circuitpython": "circuit"}.get(
+                request.get("firmware", "micro"), request.get("firmware", "micro"))
+            if firmware_type not in ("micro", "circuit", "custom"):
+                raise ValueError(f"Unknown firmware {firmware_type}, use micropython, circuitpython or custom")
+            transport = request.get("transport", "msc")
+            if transport == "picoboot":
+                drives = drives or [device["drive"] for device in find_picoboot_devices()]
+            elif transport == "msc":
+                drives = drives or find_drives("RPI-RP2")
             else:
-                # Custom firmware
-                firmware_path = self.custom_firmware_path
-                firmware_name = "Custom Firmware"
-
-            if not firmware_path or not os.path.exists(firmware_path):
-                raise FileNotFoundError(f"{firmware_name} .uf2 file not found.")
-
-            self.log_to_console(f"Flashing {firmware_name} onto the Pico...")
-            shutil.copy2(self.flash_nuke_path, os.path.join(rp2_drive, "flash_nuke.uf2"))
-            self.log_to_console("Nuke UF2 transferred, waiting 10 seconds for device to reset...")
-            time.sleep(10)
-
-            # Refresh drives to see if still RPI-RP2 or it reconnected
-            self.refresh_drives()
-            rp2_drive = self.find_drive(self.get_available_drives(), "RPI-RP2")
-            if not rp2_drive:
-                raise RuntimeError("After nuke, the device didn't reappear as RPI-RP2. Can't flash new firmware.")
-
-            shutil.copy2(firmware_path, os.path.join(rp2_drive, os.path.basename(firmware_path)))
-            self.log_to_console(f"{firmware_name} copied successfully. Waiting 5 seconds for device to reconnect...")
-            time.sleep(5)
-
-            if firmware_type == "circuit":
-                # Check for CIRCUITPY
-                logging.info("Checking for CIRCUITPY drive...")
-                self.log_to_console("Checking for CIRCUITPY drive...")
-                if self.find_drive(self.get_available_drives(), "CIRCUITPY"):
-                    logging.info("CircuitPython flashed successfully!")
-                    self.log_to_console("CircuitPython flashed successfully!")
-                    # Run message box in main thread
-                    QTimer.singleShot(0, lambda: QMessageBox.information(self, "Success", "CircuitPython has been flashed successfully!"))
-                else:
-                    self.log_to_console("CIRCUITPY drive not detected. Please check the connection.")
-                    QTimer.singleShot(0, lambda: QMessageBox.warning(self, "Warning", "CIRCUITPY drive not detected. Please check the connection."))
+                raise ValueError(f"Unknown transport {transport}, use msc or picoboot")
+            if not drives:
+                raise RuntimeError("Pico (RPI-RP2) not found!")
+            if request.get("route"):
+                jobs = self.build_routed_jobs(firmware_type, drives, transport)
             else:
-                self.log_to_console(f"{firmware_name} flashed successfully!")
-                QTimer.singleShot(0, lambda: QMessageBox.information(self, "Success", f"{firmware_name} has been flashed successfully!"))
+                jobs = self.build_flash_jobs(firmware_type, drives, request.get("path"), transport)
+        elif kind == "reset":
+            volume = request.get("volume", "RPI-RP2")
+            if volume not in ("RPI-RP2", "CIRCUITPY"):
+                raise ValueError("volume must be RPI-RP2 or CIRCUITPY")
+            drives = drives or find_drives(volume)
+            if not drives:
+                raise RuntimeError(f"{volume} not found!")
+            jobs = self.build_reset_jobs(volume, "Reset Pico" if volume == "RPI-RP2" else "Reset CircuitPython", drives)
+        elif kind == "sync":
+            drives = drives or find_drives("CIRCUITPY")
+            if not drives:
+                raise RuntimeError("CIRCUITPY drive not found!")
+            jobs = self.build_sync_jobs(drives)
+        else:
+            raise ValueError(f"Unknown job kind {kind}, use flash, reset or sync")
+        self.submit_jobs(jobs)
+        return [job.to_dict() for job in jobs]
 
-            # Finally refresh drives one more time
-            self.refresh_drives()
+    def scan_inventory(self):
+        """Reads bootloader, board and firmware details from every attached device."""
+        try:
+            start = time.perf_counter()
+            records = self.inventory.scan()
+            elapsed = time.perf_counter() - start
+            if not records:
+                self.ui_signals.message.emit("No Pico devices found.")
+                return
+            for record in records:
+                self.ui_signals.message.emit(describe_device(record))
+            self.ui_signals.message.emit(f"Inventory: {len(records)} device(s) scanned in {elapsed * 1000:.0f} ms.")
+        except Exception as e:
+            self.ui_signals.message.emit(f"Error scanning devices: {str(e)}")
+            logging.error(f"Inventory error: {str(e)}")
 
+    def export_inventory(self):
+        """Saves the device inventory as CSV or JSON."""
+        if not self.inventory.records:
+            self.log_to_console("Inventory is empty, run Tools > Scan Device Inventory first.")
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Export Device Inventory", "inventory.csv",
+                                              "CSV Files (*.csv);;JSON Files (*.json)")
+        if not path:
+            return
+        try:
+            count = self.inventory.export(path)
+            self.log_to_console(f"Exported {count} device(s) to {path}")
+        except OSError as e:
+            self.log_to_console(f"Error exporting inventory: {str(e)}")
+
+    def show_history(self):
+        if not self.history:
+            self.log_to_console("Flash history is unavailable, see pico_flasher.log.")
+            return
+        self.history.flush()
+        dialog = HistoryDialog(self.history)
+        dialog.exec_()
+
+    def show_diagnostics(self):
+        dialog = DiagnosticsDialog(self)
+        dialog.exec_()
+
+    def on_job_event(self, job_id, event, data):
+        """Handles job events in the GUI thread."""
+        if self.api_server and event != "hubs":
+            self.api_server.publish(job_id, event, data)
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+        if not job:
+            return
+        if event == "log":
+            self.log_to_console(f"[{job.drive}] {data}")
+        elif event == "done":
+            job.apply_event(event, data)
+            if job.state == "failed":
+                self.log_to_console(f"[{job.drive}] Error during {job.label} {job.kind}: {job.error}")
+            elif job.state == "warning":
+                self.log_to_console(f"[{job.drive}] Warning: {job.error}")
+            self.on_job_finished(job)
+
+    def on_job_finished(self, job):
+        with self.jobs_lock:
+            batch = [j for j in self.jobs.values() if j.batch_id == job.batch_id]
+            if not all(j.is_finished for j in batch):
+                return
+            # Unregister now: with the threaded backend every job may already be finished when the
+            # first done event arrives, and the later ones must not complete the batch again
+            for j in batch:
+                del self.jobs[j.job_id]
+
+        # Jobs whose recipe has a smoke step were already tested
+        flashed = [j for j in batch if j.kind == "flash" and j.state == "succeeded" and "smoke" not in (j.recipe or ())]
+        if flashed and self.smoke_test_action.isChecked():
+            self.run_in_thread(self.smoke_test_batch, batch, flashed)
+            return
+        self.on_batch_done(batch)
+
+    def smoke_test_batch(self, batch, flashed):
+        """Runs the post-flash REPL smoke test on the boards that flashed successfully."""
+        try:
+            run_smoke_tests(flashed, self.smoke_test, log=self.ui_signals.message.emit)
         except Exception as e:
-            self.log_to_console(f"Error during flashing: {str(e)}")
-            logging.error(f"Flashing error: {str(e)}")
+            self.ui_signals.message.emit(f"Error during smoke test: {str(e)}")
+            logging.error(f"Smoke test error: {str(e)}")
+        self.job_signals.batch_done.emit(batch)
+
+    def on_batch_done(self, batch):
+        if self.history:
+            for j in batch:
+                self.history.record(j)
+        if self.api_server:
+            for j in batch:
+                self.api_server.publish(j.job_id, "batch_done", j.to_dict())
+        job = batch[0]
+        failed = [j for j in batch if j.state != "succeeded"]
+        if job.kind == "reset":
+            title = f"{job.label} reset"
+        else:
+            title = f"{job.label} flash"
+        if not failed:
+            if len(batch) == 1:
+                message = f"{title} completed successfully!"
+            else:
+                message = f"{title} completed successfully on {len(batch)} devices!"
+            QMessageBox.information(self, "Success", message)
+        else:
+            details = "\n".join(f"{j.drive}: {j.error}" for j in failed)
+            QMessageBox.warning(self, "Warning", f"{title} had problems on {len(failed)} of {len(batch)} device(s):\n{details}")
+
+        self.refresh_drives()
+
+    def diagnostics_html(self):
+        """Renders backend, cache and per-hub utilisation figures for the diagnostics dialog."""
+        cache = self.firmware_cache.stats()
+        with self.jobs_lock:
+            running = sum(1 for job in self.jobs.values() if not job.is_finished)
+        html = [
+            "<h3>Flashing</h3>",
+            f"<p>Backend: {self.flash_backend.name} &nbsp; Running jobs: {running} &nbsp; "
+            f"Writes per hub: {self.hub_limit or 'automatic'}</p>",
+            "<h3>Firmware Cache</h3>",
+            f"<p>{cache['images']} image(s), {cache['bytes'] / 1048576:.1f} of {cache['max_bytes'] / 1048576:.0f} MB, "
+            f"{cache['hits']} hits / {cache['misses']} misses</p>",
+            "<h3>USB Hubs</h3>",
+        ]
+        hubs = self.flash_backend.hub_stats()
+        if not hubs:
+            html.append("<p>No hub activity yet.</p>")
+        else:
+            html.append("<table cellpadding='4'><tr><th>Hub</th><th>Active / Limit</th><th>Waiting</th>"
+                        "<th>Peak</th><th>Writes</th><th>MB/s</th><th>Utilisation</th></tr>")
+            for hub, stats in sorted(hubs.items()):
+                html.append(
+                    f"<tr><td>{hub}</td><td>{stats['active']} / {stats['limit']}</td><td>{stats['waiting']}</td>"
+                    f"<td>{stats['peak']}</td><td>{stats['writes']}</td><td>{stats['throughput'] / 1048576:.2f}</td>"
+                    f"<td>{stats['utilisation'] * 100:.0f}%</td></tr>")
+            html.append("</table>")
+        if self.lag_monitor:
+            lag = self.lag_monitor.stats()
+            html.append("<h3>Profiling</h3>")
+            html.append(f"<p>Event loop lag: mean {lag['mean_ms']:.1f} ms, p99 {lag['p99_ms']:.1f} ms, "
+                        f"max {lag['max_ms']:.1f} ms, {lag['stalls']} stall(s) over "
+                        f"{self.lag_monitor.stall * 1000:.0f} ms</p><p>Reports: {self.profiler.directory}</p>")
+        stuck = DEVICE_WATCHDOG.stuck()
+        if stuck:
+            html.append("<h3>Stuck Devices</h3><ul>")
+            for entry in stuck:
+                html.append(f"<li>{entry['drive']}: {entry['operation']} hung for {entry['age']:.0f}s</li>")
+            html.append("</ul>")
+        return "".join(html)
+
+    def closeEvent(self, event):
+        self.set_profiling_enabled(False)
+        self.flash_backend.shutdown()
+        if self.api_server:
+            self.api_server.stop()
+        if self.peer_server:
+            self.peer_server.stop()
+        if self.history:
+            self.history.close()
+        super().closeEvent(event)
+
+def cli_flash(args):
+    """Flashes a firmware image onto every attached RPI-RP2 drive without the GUI."""
+    cache = FirmwareCache()
+    if args.bootsel:
+        cli_bootsel(args)
+    if args.transport == "picoboot":
+        if not usb:
+            print("PICOBOOT needs pyusb and libusb. Please install with 'pip install pyusb'.")
+            return 1
+        if args.erase != "full":
+            print("--erase only applies to the mass storage transport, PICOBOOT always erases the full chip.")
+            return 1
+        drives = [drive if drive.startswith(PICOBOOT_DRIVE_PREFIX) else PICOBOOT_DRIVE_PREFIX + drive
+                  for drive in args.drive or [device["drive"] for device in find_picoboot_devices()]]
+        if not drives:
+            print("No Pico in BOOTSEL mode found on USB!")
+            return 1
+    else:
+        drives = args.drive or find_drives("RPI-RP2")
+        if not drives:
+            print("Pico (RPI-RP2) not found!")
+            return 1
+
+    firmware = {drive: args.firmware[0] for drive in drives}
+    rejected = []
+    if len(args.firmware) > 1 or args.rules:
+        try:
+            rules = load_routing_rules(args.rules) if args.rules else None
+        except (OSError, ValueError, re.error) as e:
+            print(f"Error loading routing rules: {str(e)}")
+            return 1
+        router = FirmwareRouter(args.firmware, rules,
+                                families=lambda path: image_families(path, FAMILY_IDS[args.family]))
+        if args.transport == "picoboot":
+            scanned = [{"drive": d["drive"], "board_id": d["chip"]} for d in find_picoboot_devices()]
+        else:
+            scanned = DeviceInventory().scan(drives)
+        routes, rejected = router.plan(drives, scanned)
+        for drive, reason in rejected:
+            print(f"[{drive}] not flashed: {reason}")
+        if not routes:
+            return 1
+        firmware = {drive: path for path, group in routes.items() for drive in group}
+        drives = [drive for drive in drives if drive in firmware]
+
+    personalization = None
+    if args.personalize:
+        try:
+            personalization = PersonalizationRecords(args.personalize)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading personalization records: {str(e)}")
+            return 1
+        if personalization.remaining < len(drives):
+            print(f"Not enough personalization records: {len(drives)} needed, {personalization.remaining} left")
+            return 1
+
+    recipe = [step for step in RECIPES[args.recipe] if step != "nuke" or args.nuke or args.erase != "full"]
+    if "sync" in recipe and not args.library:
+        print("The recipe syncs libraries, add at least one --library folder.")
+        return 1
+    expect_volume = args.expect_volume or ("CIRCUITPY" if "sync" in recipe else None)
+    smoke_check = None
+    if "smoke" in recipe:
+        snippet = DEFAULT_SMOKE_SNIPPET
+        if args.smoke_snippet:
+            with open(args.smoke_snippet) as f:
+                snippet = f.read()
+        smoke_check = (snippet, args.smoke_expect)
+
+    topology = UsbTopology()
+    topology.refresh()
+    jobs = {}
+    batch_id = None
+    for drive in drives:
+        if args.transport == "picoboot":
+            usb_port = drive[len(PICOBOOT_DRIVE_PREFIX):] if drive.startswith(PICOBOOT_DRIVE_PREFIX) else drive
+            drive, hub = PICOBOOT_DRIVE_PREFIX + usb_port, usb_parent_hub(usb_port)
+        else:
+            usb_port, hub = topology.port_for(drive), topology.hub_for(drive)
+        job = FlashJob("flash", drive, os.path.basename(firmware[drive]), firmware_path=firmware[drive],
+                       nuke_path=args.nuke, expect_volume=expect_volume, batch_id=batch_id,
+                       hub=hub, usb_port=usb_port, firmware_family=FAMILY_IDS[args.family],
+                       base_address=args.base_address,
+                       transport=args.transport, library_paths=args.library, recipe=recipe, smoke_check=smoke_check)
+        job.flash_size = args.flash_size
+        batch_id = job.batch_id
+        jobs[job.job_id] = job
+
+    prepare_erase_images(list(jobs.values()), args.erase, log=print)
+    unprepared = [job.drive for job in jobs.values() if "nuke" in recipe and not job.nuke_path]
+    if unprepared:
+        print(f"No erase image for {', '.join(unprepared)}, pass --nuke to fall back to flash_nuke.uf2.")
+        return 1
+    if personalization:
+        try:
+            personalization.assign(list(jobs.values()))
+        except (OSError, RuntimeError) as e:
+            print(f"Error taking personalization records: {str(e)}")
+            return 1
+
+    all_done = threading.Event()
+    lock = threading.Lock()
+    pending = set(jobs)
+
+    def report(job_id, event, data):
+        job = jobs[job_id]
+        if event == "log":
+            print(f"[{job.drive}] {data}")
+        elif event == "done":
+            job.apply_event(event, data)
+            print(f"[{job.drive}] {job.state}" + (f": {job.error}" if job.error else ""))
+            with lock:
+                pending.discard(job_id)
+                if not pending:
+                    all_done.set()
+
+    backend = create_flash_backend(args.backend, cache, report, workers=args.workers, hub_limit=args.per_hub or None)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile).start()
+        backend.set_profiler(profiler)
+        print(f"Profiling jobs into {profiler.directory}")
+    if args.record_trace:
+        backend.set_recorder(DeviceTraceRecorder(args.record_trace))
+        print(f"Recording device timings to {args.record_trace}")
+    try:
+        backend.submit(list(jobs.values()))
+        all_done.wait()
+        flashed = [job for job in jobs.values() if job.state == "succeeded" and "smoke" not in recipe]
+        if args.smoke_test and flashed:
+            snippet = DEFAULT_SMOKE_SNIPPET
+            if args.smoke_snippet:
+                with open(args.smoke_snippet) as f:
+                    snippet = f.read()
+            run_smoke_tests(flashed, ReplSmokeTest(snippet, args.smoke_expect), log=print)
+        history = FlashHistory()
+        for job in jobs.values():
+            history.record(job)
+        history.close()
+        erase_times = {}
+        for job in jobs.values():
+            if "write_nuke" in job.phases and "erase" in job.phases:
+                erase_times.setdefault(job.erase_preset, []).append(job.phases["write_nuke"] + job.phases["erase"])
+        for preset, times in erase_times.items():
+            print(f"Erase ({ERASE_PRESETS[preset]}): mean {sum(times) / len(times):.1f}s, "
+                  f"max {max(times):.1f}s over {len(times)} board(s)")
+        for hub, stats in sorted(backend.hub_stats().items()):
+            print(f"Hub {hub}: {stats['writes']} writes, peak {stats['peak']}/{stats['limit']} concurrent, "
+                  f"{stats['throughput'] / 1048576:.2f} MB/s, {stats['utilisation'] * 100:.0f}% busy")
+    finally:
+        backend.shutdown()
+        if profiler:
+            profiler.stop()
+    return 0 if all(job.state == "succeeded" for job in jobs.values()) and not rejected else 1
+
+def cli_replay(args):
+    """Replays recorded device timelines through the flash engine on simulated boards and reports timings."""
+    try:
+        timelines = load_device_traces(args.trace)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error loading device traces: {str(e)}")
+        return 1
+    cache = FirmwareCache()
+    recipe = [step for step in RECIPES["flash"] if step != "nuke" or args.nuke]
+    jobs = {}
+    batch_id = None
+    for index in range(args.boards or len(timelines)):
+        job = FlashJob("flash", f"replay{index}", os.path.basename(args.firmware), firmware_path=args.firmware,
+                       nuke_path=args.nuke, expect_volume=args.expect_volume, batch_id=batch_id, recipe=recipe)
+        batch_id = job.batch_id
+        jobs[job.job_id] = job
+
+    all_done = threading.Event()
+    lock = threading.Lock()
+    pending = set(jobs)
+
+    def report(job_id, event, data):
+        if event != "done":
+            return
+        jobs[job_id].apply_event(event, data)
+        with lock:
+            pending.discard(job_id)
+            if not pending:
+                all_done.set()
+
+    backend = ReplayFlashBackend(cache, report, timelines, hub_limit=args.per_hub or None, speed=args.speed)
+    start = time.perf_counter()
+    backend.submit(list(jobs.values()))
+    all_done.wait()
+    # Simulated time, comparable across runs at different speeds
+    wall = (time.perf_counter() - start) * args.speed
+    phases = {}
+    for job in jobs.values():
+        for name, seconds in job.phases.items():
+            phases.setdefault(name, []).append(seconds * args.speed)
+    result = {
+        "timelines": len(timelines), "boards": len(jobs), "speed": args.speed, "wall_s": round(wall, 3),
+        "states": {state: sum(job.state == state for job in jobs.values())
+                   for state in sorted({job.state for job in jobs.values()})},
+        "phases": {name: {"mean_s": round(sum(values) / len(values), 3), "max_s": round(max(values), 3)}
+                   for name, values in sorted(phases.items())},
+        "hubs": backend.hub_stats(),
+    }
+    print(f"Replayed {len(timelines)} recorded device(s) onto {len(jobs)} simulated board(s) "
+          f"in {wall:.2f}s simulated time")
+    for state, count in result["states"].items():
+        print(f"  {state}: {count}")
+    for name, stats in result["phases"].items():
+        print(f"  {name}: mean {stats['mean_s']:.3f}s, max {stats['max_s']:.3f}s")
+    for job in jobs.values():
+        if job.error:
+            print(f"  [{job.drive}] {job.state}: {job.error}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+def cli_inventory(args):
+    """Scans every attached device and prints or exports the inventory."""
+    inventory = DeviceInventory()
+    start = time.perf_counter()
+    records = inventory.scan(args.drive, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    for record in records:
+        print(describe_device(record))
+    print(f"{len(records)} device(s) scanned in {elapsed * 1000:.0f} ms")
+    for path in (args.csv, args.json):
+        if path:
+            try:
+                inventory.export(path)
+            except OSError as e:
+                print(f"Error exporting inventory: {str(e)}")
+                return 1
+    return 0
+
+def cli_history(args):
+    """Prints flash history: recent jobs, the last firmware on a device, or failure rates."""
+    history = FlashHistory()
+    try:
+        if args.failures:
+            since = time.time() - args.hours * 3600 if args.hours else None
+            for row in history.failure_rates(args.failures, since):
+                print(f"{row['key'] or 'unknown':<40} {row['jobs']:>5} jobs {row['failed']:>5} failed "
+                      f"{row['failure_rate'] * 100:>5.1f}%")
+            return 0
+        if args.device and args.last_firmware:
+            row = history.last_firmware(args.device)
+            if not row:
+                print(f"No firmware recorded for {args.device}")
+                return 1
+            print(f"{row['label']} sha256 {row['firmware_sha256']} "
+                  f"({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['finished']))})")
+            return 0
+        for row in history.recent(args.limit, args.device):
+            finished = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row["finished"])) if row["finished"] else "-"
+            print(f"{finished} {row['device_id']:<16} {row['kind']:<6} {row['state']:<9} {row['label']}"
+                  + (f": {row['error']}" if row["error"] else ""))
+        return 0
+    finally:
+        history.close()
+
+def cli_sync(args):
+    """Syncs library folders to every attached CIRCUITPY drive without the GUI."""
+    drives = args.drive or find_drives("CIRCUITPY")
+    if not drives:
+        print("CIRCUITPY drive not found!")
+        return 1
+
+    results = {}
+
+    def sync(drive):
+        try:
+            results[drive] = sync_libraries(args.library, drive, log=lambda message: print(f"[{drive}] {message}"))
+        except Exception as e:
+            print(f"[{drive}] Error during library sync: {str(e)}")
+
+    threads = [threading.Thread(target=sync, args=(drive,)) for drive in drives]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return 0 if len(results) == len(drives) else 1
+
+def cli_bootsel(args):
+    """Reboots Pico serial ports into BOOTSEL mode and lists the drives that reappeared."""
+    ports = [{"port": port} for port in args.port] if args.port else find_pico_serial_ports()
+    if not ports:
+        print("No Pico serial ports found.")
+        return 1
+    drives = reboot_to_bootloader(ports, method=args.method, log=print)
+    for drive in drives:
+        print(drive)
+    return 0 if len(drives) == len(ports) else 1
+
+def cli_index(args):
+    """Adds folders to the firmware library, rescans it and lists the indexed UF2 images."""
+    index = FirmwareIndex()
+    for folder in args.folder or []:
+        index.add_directory(folder)
+    start = time.monotonic()
+    changed, directories = index.scan()
+    for entry in index.images(args.kind):
+        start_addr = f"0x{entry['flash_start']:08x}" if entry["flash_start"] is not None else "-"
+        print(f"{entry['kind']:<14} {describe_index_entry(entry)} @ {start_addr}\n  {entry['path']}")
+    print(f"{len(index.entries)} image(s) in {len(directories)} folder(s), {changed} change(s), "
+          f"scanned in {time.monotonic() - start:.2f}s")
+    return 0
+
+def cli_update(args):
+    """Runs one conditional update check of the firmware bundle and manifests."""
+    peers = PeerClient(args.peer) if args.peer else None
+    store = PeerStore(args.peer_store or PEER_STORE_DIR) if args.peer or args.peer_store else None
+    checker = UpdateChecker(bandwidth_limit=args.limit * 1024, peers=peers, store=store)
+    for manifest_url in args.manifest or []:
+        if manifest_url not in checker.manifests:
+            checker.manifests.append(manifest_url)
+    present = not args.force and os.path.isdir(args.dest) and any(
+        name.lower().endswith(".uf2") for name in os.listdir(args.dest))
+    start = time.time()
+    try:
+        updated = checker.check(args.url, args.dest, bundle_present=present)
+    except (requests.exceptions.RequestException, OSError, ValueError, RuntimeError) as e:
+        print(f"Update check failed: {str(e)}")
+        return 1
+    print(f"{len(updated)} artifact(s) updated")
+    for url, meta in checker.state["urls"].items():
+        if meta.get("peer") and meta.get("checked", 0) >= start:
+            print(f"  {os.path.basename(urlparse(url).path)} came from peer {meta['peer']}")
+    return 0
+
+def cli_peer(args):
+    """Serves the peer store and firmware library to other stations until interrupted."""
+    index = FirmwareIndex()
+    index.scan(index.directories + args.folder)
+    store = PeerStore(args.store, files=lambda: [entry["path"] for entry in index.images()])
+    server = PeerCacheServer(store, host=args.host, port=args.port)
+    try:
+        server.start()
+    except OSError as e:
+        print(f"Could not start the peer cache on port {args.port}: {str(e)}")
+        return 1
+    print(f"Serving {len(store.objects())} object(s) on http://{server.host}:{server.port}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    print(f"Served {server.served / 1048576:.1f} MB")
+    return 0
+
+def cli_compress(args):
+    """Compresses the UF2 images in the given folders and reports decompression throughput."""
+    paths = []
+    for folder in args.folder:
+        for dirpath, _, names in os.walk(folder):
+            paths.extend(os.path.join(dirpath, name) for name in names if name.lower().endswith(".uf2"))
+    total_before = total_after = 0
+    for path in sorted(paths):
+        size = os.path.getsize(path)
+        try:
+            compressed = compress_firmware(path, args.method, args.level)
+        except (OSError, RuntimeError, lzma.LZMAError) as e:
+            print(f"Error compressing {path}: {str(e)}")
+            return 1
+        after = os.path.getsize(compressed)
+        total_before += size
+        total_after += after
+        line = f"{os.path.basename(compressed)}: {size / 1024:.0f} KB -> {after / 1024:.0f} KB"
+        if args.benchmark:
+            line += f", decompresses at {benchmark_decompression(compressed) / 1048576:.0f} MB/s"
+        print(line)
+    if total_before:
+        print(f"{len(paths)} image(s), {total_before / 1048576:.1f} MB -> {total_after / 1048576:.1f} MB")
+    return 0
+
+def cli_convert(args):
+    """Converts a .bin, .hex or .elf file into a .uf2 file."""
+    output = args.output or os.path.splitext(args.input)[0] + ".uf2"
+    start = time.monotonic()
+    try:
+        stream = convert_to_uf2(args.input, FAMILY_IDS[args.family], args.base_address)
+        with open(output, "wb") as f:
+            for chunk in stream.iter_chunks():
+                f.write(chunk)
+    except (OSError, ValueError) as e:
+        print(f"Error converting {args.input}: {str(e)}")
+        return 1
+    print(f"Wrote {output}: {stream.num_blocks} blocks for {args.family} in {time.monotonic() - start:.2f}s")
+    return 0
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Raspberry Pi Pico Revival Tool")
+    parser.add_argument("--api", type=int, nargs="?", const=API_PORT, metavar="PORT",
+                        help=f"Start the GUI with the localhost HTTP API enabled (default port {API_PORT})")
+    parser.add_argument("--profile", nargs="?", const=PROFILE_DIR, metavar="DIR",
+                        help=f"Start the GUI in profiling mode (default folder {PROFILE_DIR})")
+    commands = parser.add_subparsers(dest="command")
+
+    flash = commands.add_parser("flash", help="Flash a UF2 image onto all attached Picos")
+    flash.add_argument("firmware", nargs="+",
+                       help="Path to the .uf2 firmware (.bin, .hex and .elf are converted); give one per chip "
+                            "to route each board to the image built for it")
+    flash.add_argument("--rules", help="JSON routing rules picking the firmware by chip, model or board id")
+    flash.add_argument("--family", choices=list(FAMILY_IDS), default="RP2040",
+                       help="UF2 family to convert .bin/.hex/.elf firmware for")
+    flash.add_argument("--base-address", type=lambda text: int(text, 0),
+                       help="Flash address of a .bin firmware (default: 0x10000000)")
+    flash.add_argument("--nuke", help="Path to flash_nuke.uf2 to erase first")
+    flash.add_argument("--erase", choices=list(ERASE_PRESETS), default="full",
+                       help="Erase the full chip with --nuke, or only the old firmware and/or filesystem found in "
+                            "CURRENT.UF2 (falls back to --nuke where it cannot be read). Both targeted presets "
+                            "also blank the boot sector, so the old firmware no longer boots")
+    flash.add_argument("--drive", action="append",
+                       help="Drive to flash (default: every RPI-RP2 drive, or usb:<port> with --transport picoboot)")
+    flash.add_argument("--transport", choices=("msc", "picoboot"), default="msc",
+                       help="Copy the UF2 to the drive (msc) or write flash directly over USB (picoboot, needs pyusb)")
+    flash.add_argument("--flash-size", type=lambda text: int(text, 0),
+                       help="Flash size in bytes for --transport picoboot, e.g. 0x800000 (default: probe each board)")
+    flash.add_argument("--expect-volume", help="Volume expected after flashing, e.g. CIRCUITPY")
+    flash.add_argument("--recipe", choices=list(RECIPES), default="flash",
+                       help="Steps run on each board: " + "; ".join(f"{name} = {' -> '.join(steps)}"
+                                                                    for name, steps in RECIPES.items()))
+    flash.add_argument("--library", action="append", default=[],
+                       help="Library folder synced to CIRCUITPY/lib by the sync step of a recipe")
+    flash.add_argument("--backend", choices=("thread", "process"), default="thread")
+    flash.add_argument("--workers", type=int, help="Number of worker processes for the process backend")
+    flash.add_argument("--per-hub", type=int, default=0,
+                       help="Concurrent writes per USB hub (default: tune from measured throughput)")
+    flash.add_argument("--bootsel", action="store_true",
+                       help="Reboot boards running from flash into the bootloader first")
+    flash.add_argument("--port", action="append", help="Serial port to reboot with --bootsel (default: all Picos)")
+    flash.add_argument("--method", choices=("auto", "touch", "repl"), default="auto",
+                       help="How --bootsel reboots boards")
+    flash.add_argument("--personalize", metavar="RECORDS",
+                       help="JSON file of per-device records to patch into each board's image")
+    flash.add_argument("--smoke-test", action="store_true",
+                       help="Run a REPL smoke test on each board after flashing")
+    flash.add_argument("--smoke-snippet", help="File with the Python code to run for the smoke test")
+    flash.add_argument("--smoke-expect", default=DEFAULT_SMOKE_EXPECT,
+                       help="Regular expression the smoke test output must match")
+    flash.add_argument("--profile", nargs="?", const=PROFILE_DIR, metavar="DIR",
+                       help=f"Write a profile report for every job (default folder {PROFILE_DIR})")
+    flash.add_argument("--record-trace", nargs="?", const=DEVICE_TRACE_FILE, metavar="FILE",
+                       help=f"Append each board's device timings to FILE for replay (default {DEVICE_TRACE_FILE})")
+    flash.set_defaults(func=cli_flash)
+
+    replay = commands.add_parser("replay", help="Benchmark the flash engine against recorded device timings")
+    replay.add_argument("trace", help="Device trace file recorded with flash --record-trace")
+    replay.add_argument("--firmware", required=True, help="UF2 image to flash onto the simulated boards")
+    replay.add_argument("--nuke", help="Path to flash_nuke.uf2 to erase first")
+    replay.add_argument("--expect-volume", help="Volume expected after flashing, e.g. CIRCUITPY")
+    replay.add_argument("--boards", type=int, help="Simulated boards (default: one per recorded device)")
+    replay.add_argument("--per-hub", type=int, default=0,
+                        help="Concurrent writes per USB hub (default: tune from measured throughput)")
+    replay.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded")
+    replay.add_argument("--json", help="Write the timings to this JSON file")
+    replay.set_defaults(func=cli_replay)
+
+    inventory = commands.add_parser("inventory", help="Read bootloader, board and firmware details from all devices")
+    inventory.add_argument("--drive", action="append", help="Drive to scan (default: every drive)")
+    inventory.add_argument("--timeout", type=float, default=0.5, help="Seconds to wait for slow devices")
+    inventory.add_argument("--csv", help="Export the inventory to this CSV file")
+    inventory.add_argument("--json", help="Export the inventory to this JSON file")
+    inventory.set_defaults(func=cli_inventory)
+
+    history = commands.add_parser("history", help="Query the flash history database")
+    history.add_argument("--device", help="USB port, drive or personalization id of a board")
+    history.add_argument("--last-firmware", action="store_true", help="Show only the last firmware on --device")
+    history.add_argument("--failures", choices=("hub", "firmware", "device"),
+                         help="Failure rate grouped by hub, firmware or device")
+    history.add_argument("--hours", type=float, help="Window for --failures (default: since midnight)")
+    history.add_argument("--limit", type=int, default=50, help="Number of recent jobs to list")
+    history.set_defaults(func=cli_history)
+
+    sync = commands.add_parser("sync", help="Sync library folders to CIRCUITPY/lib on all attached boards")
+    sync.add_argument("library", nargs="+", help="Library folder, e.g. adafruit_hid")
+    sync.add_argument("--drive", action="append", help="Drive to sync (default: every CIRCUITPY drive)")
+    sync.set_defaults(func=cli_sync)
+
+    bootsel = commands.add_parser("bootsel", help="Reboot Picos into the bootloader over their serial ports")
+    bootsel.add_argument("--port", action="append", help="Serial port to reboot (default: all Picos)")
+    bootsel.add_argument("--method", choices=("auto", "touch", "repl"), default="auto",
+                         help="1200-baud touch, REPL command, or touch with REPL fallback")
+    bootsel.set_defaults(func=cli_bootsel)
+
+    index = commands.add_parser("index", help="Index the UF2 images in the firmware library folders")
+    index.add_argument("folder", nargs="*", help="Folder to add to the firmware library")
+    index.add_argument("--kind", choices=("micropython", "circuitpython", "nuke", "custom"),
+                       help="Only list images of this kind")
+    index.set_defaults(func=cli_index)
+
+    update = commands.add_parser("update", help="Download only the firmware that changed on the server")
+    update.add_argument("--url", default="https://www.tstp.xyz/downloads/tools/TSTP-Pico_Revival.rar",
+                        help="Firmware bundle URL")
+    update.add_argument("--dest", default=r"C:\TSTP\TSTP-Pico_Revival", help="Folder to download into")
+    update.add_argument("--manifest", action="append",
+                        help="Firmware manifest URL to track (remembered for later checks)")
+    update.add_argument("--limit", type=int, default=UPDATE_BANDWIDTH_LIMIT // 1024,
+                        help="Bandwidth limit in KB/s, 0 for unlimited")
+    update.add_argument("--force", action="store_true", help="Download the bundle even if it did not change")
+    update.add_argument("--peer", action="append",
+                        help=f"Station to fetch changed artifacts from before the origin, host[:port] "
+                             f"(default port {PEER_PORT})")
+    update.add_argument("--peer-store", help=f"Folder keeping downloads for peers (default {PEER_STORE_DIR})")
+    update.set_defaults(func=cli_update)
+
+    peer = commands.add_parser("peer", help="Serve downloaded artifacts and the firmware library to other stations")
+    peer.add_argument("folder", nargs="*", help="Firmware folder to serve besides the indexed ones")
+    peer.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    peer.add_argument("--port", type=int, default=PEER_PORT)
+    peer.add_argument("--store", default=PEER_STORE_DIR, help="Peer store folder")
+    peer.set_defaults(func=cli_peer)
+
+    compress = commands.add_parser("compress", help="Compress the UF2 images in a firmware folder")
+    compress.add_argument("folder", nargs="+", help="Folder whose .uf2 files are compressed in place")
+    compress.add_argument("--method", choices=("zstd", "xz"),
+                          help="Compression to use (default: zstd if installed, otherwise xz)")
+    compress.add_argument("--level", type=int, help="Compression level")
+    compress.add_argument("--benchmark", action="store_true", help="Measure decompression throughput")
+    compress.set_defaults(func=cli_compress)
+
+    convert = commands.add_parser("convert", help="Convert a .bin, .hex or .elf file to UF2")
+    convert.add_argument("input", help="Firmware file to convert")
+    convert.add_argument("-o", "--output", help="UF2 file to write (default: input name with .uf2)")
+    convert.add_argument("--family", choices=list(FAMILY_IDS), default="RP2040")
+    convert.add_argument("--base-address", type=lambda text: int(text, 0),
+                         help="Flash address of a .bin input (default: 0x10000000)")
+    convert.set_defaults(func=cli_convert)
+
+    return parser
 
 def main():
+    args = build_arg_parser().parse_args()
+    if args.command:
+        sys.exit(args.func(args))
+
     app = QApplication(sys.argv)
     window = PicoFlasher()
+    if args.api:
+        window.set_api_enabled(True, args.api)
+        window.api_action.blockSignals(True)
+        window.api_action.setChecked(window.api_server is not None)
+        window.api_action.blockSignals(False)
+    if args.profile:
+        window.set_profiling_enabled(True, args.profile)
+        window.profiling_action.blockSignals(True)
+        window.profiling_action.setChecked(window.profiler is not None)
+        window.profiling_action.blockSignals(False)
     window.show()
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
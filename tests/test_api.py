@@ -0,0 +1,56 @@
+import pytest
+import requests
+
+import main
+
+
+@pytest.fixture
+def server():
+    started = []
+
+    def start_jobs(request):
+        started.append(request)
+        return [{"job_id": 1}]
+
+    api = main.ControlApiServer(lambda: [{"drive": "E:"}], start_jobs, port=0, token="secret")
+    api.start()
+    api.started = started
+    yield api
+    api.stop()
+
+
+def url(api, path):
+    return f"http://127.0.0.1:{api.port}{path}"
+
+
+def test_requests_need_the_token(server):
+    assert requests.get(url(server, "/devices")).status_code == 401
+    assert requests.get(url(server, "/devices"), headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = requests.get(url(server, "/devices"), headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.json() == {"devices": [{"drive": "E:"}]}
+
+
+def test_foreign_host_rejected(server):
+    headers = {"Authorization": "Bearer secret", "Host": f"attacker.example:{server.port}"}
+    assert requests.get(url(server, "/jobs"), headers=headers).status_code == 403
+
+
+def test_post_requires_json_content_type(server):
+    headers = {"Authorization": "Bearer secret"}
+    response = requests.post(url(server, "/jobs"), data='{"kind": "reset"}',
+                             headers=dict(headers, **{"Content-Type": "text/plain"}))
+    assert response.status_code == 415
+    assert server.started == []
+
+    response = requests.post(url(server, "/jobs"), json={"kind": "reset"}, headers=headers)
+    assert response.status_code == 202
+    assert server.started == [{"kind": "reset"}]
+
+
+def test_token_file_private(server, tmp_path):
+    path = server.write_token(str(tmp_path / "token"))
+    with open(path) as f:
+        assert f.read().strip() == "secret"
+    if main.sys.platform != "win32":
+        assert main.os.stat(path).st_mode & 0o077 == 0
@@ -0,0 +1,83 @@
+import pytest
+
+import main
+
+
+def test_rp2350_boot_rom_not_guessed_as_arduino():
+    assert main.guess_serial_firmware(0x2E8A, 0x000F) == "Unknown"
+    assert main.guess_serial_firmware(0x2E8A, 0x000A) == "Arduino"
+    assert main.guess_serial_firmware(0x2E8A, 0x0005) == "MicroPython"
+    assert main.guess_serial_firmware(0x239A, 0x80F4) == "CircuitPython"
+
+
+class FakeBoard:
+    """
+    pty stand-in for a Pico's CDC port: reboots to BOOTSEL when the host opens it at
+    1200 baud or sends a bootloader command, and then shows up as a new RPI-RP2 drive.
+    """
+    def __init__(self, termios):
+        import pty
+        import tty
+        self.termios = termios
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        self.port = main.os.ttyname(self.slave)
+        self.received = b""
+        self.rebooted = None
+        self.drives = []
+        self._stop = main.threading.Event()
+        self._thread = main.threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        import select
+        while not self._stop.is_set() and not self.rebooted:
+            if self.termios.tcgetattr(self.slave)[4] == self.termios.B1200:
+                self._reboot("touch")
+            elif select.select([self.master], [], [], 0.02)[0]:
+                self.received += main.os.read(self.master, 1024)
+                if b"machine.bootloader()\r" in self.received:
+                    self._reboot("repl")
+
+    def _reboot(self, how):
+        self.rebooted = how
+        self.drives.append("/media/RPI-RP2/")
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(2)
+        main.os.close(self.master)
+        main.os.close(self.slave)
+
+
+@pytest.fixture
+def board():
+    termios = pytest.importorskip("termios")
+    pytest.importorskip("pty")
+    if not main.serial:
+        pytest.skip("pyserial is not installed")
+    board = FakeBoard(termios)
+    yield board
+    board.close()
+
+
+def test_touch_reboots_board(board):
+    drives = main.reboot_to_bootloader([{"port": board.port, "firmware": "MicroPython"}], method="touch",
+                                       timeout=5, log=lambda message: None, list_drives=lambda: list(board.drives))
+    assert board.rebooted == "touch"
+    assert drives == ["/media/RPI-RP2/"]
+
+
+def test_repl_command_reboots_board(board):
+    drives = main.reboot_to_bootloader([{"port": board.port, "firmware": "MicroPython"}], method="repl",
+                                       timeout=5, log=lambda message: None, list_drives=lambda: list(board.drives))
+    assert board.rebooted == "repl"
+    assert board.received.startswith(b"\r\x03\x03\x02")
+    assert drives == ["/media/RPI-RP2/"]
+
+
+def test_auto_falls_back_to_repl_when_port_stays(board):
+    board.termios = type("NoTouch", (), {"tcgetattr": staticmethod(lambda fd: [0] * 7), "B1200": -1})
+    assert main.enter_bootloader(board.port, "MicroPython", "auto", disappear_timeout=0.3) == "repl"
+    assert main.wait_for_new_drives([], 1, 2, lambda: list(board.drives), poll=0.05) == ["/media/RPI-RP2/"]
+    assert board.rebooted == "repl"
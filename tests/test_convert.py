@@ -0,0 +1,138 @@
+import os
+import struct
+
+import pytest
+
+import main
+
+
+def blocks(image):
+    """Decodes a UF2 image into (header fields, payload) per block."""
+    data = image.tobytes() if hasattr(image, "tobytes") else image
+    assert len(data) % main.UF2_BLOCK_SIZE == 0
+    result = []
+    for offset in range(0, len(data), main.UF2_BLOCK_SIZE):
+        header = main.UF2_HEADER.unpack_from(data, offset)
+        assert header[:2] == (main.UF2_MAGIC_START0, main.UF2_MAGIC_START1)
+        assert struct.unpack_from("<I", data, offset + main.UF2_BLOCK_SIZE - 4)[0] == main.UF2_MAGIC_END
+        size = header[4]
+        result.append((header, bytes(data[offset + 32:offset + 32 + size])))
+    return result
+
+
+def flash_contents(image):
+    """Maps every written address to its byte."""
+    contents = {}
+    for header, payload in blocks(image):
+        for i, byte in enumerate(payload):
+            contents[header[3] + i] = byte
+    return contents
+
+
+def hex_record(kind, address, data):
+    record = bytes([len(data), address >> 8 & 0xFF, address & 0xFF, kind]) + data
+    return ":" + (record + bytes([-sum(record) & 0xFF])).hex().upper()
+
+
+def elf(segments):
+    """Minimal 32-bit little-endian ELF with one PT_LOAD per (vaddr, paddr, data)."""
+    phoff = 52
+    offset = phoff + 32 * len(segments)
+    header = b"\x7fELF" + bytes([1, 1, 1]) + bytes(9) + struct.pack(
+        "<HHIIIIIHHHHHH", 2, 40, 1, segments[0][0], phoff, 0, 0x5000200, 52, 32, len(segments), 0, 0, 0)
+    program_headers = b""
+    contents = b""
+    for vaddr, paddr, data in segments:
+        program_headers += struct.pack("<8I", 1, offset + len(contents), vaddr, paddr, len(data), len(data), 5, 4)
+        contents += data
+    return header + program_headers + contents
+
+
+def test_bin_at_custom_base_round_trips(tmp_path):
+    payload = os.urandom(1000)
+    path = tmp_path / "app.bin"
+    path.write_bytes(payload)
+
+    image = main.convert_to_uf2(str(path), base_address=0x10004000)
+    decoded = blocks(image)
+
+    assert len(decoded) == 4 == image.num_blocks
+    assert len(image) == len(image.tobytes())
+    for number, (header, _) in enumerate(decoded):
+        _, _, flags, address, size, block_no, num_blocks, family = header
+        assert flags == main.UF2_FLAG_FAMILY_ID_PRESENT
+        assert (address, size, block_no, num_blocks) == (0x10004000 + number * 256, 256, number, 4)
+        assert family == main.FAMILY_IDS["RP2040"]
+    assert b"".join(payload for _, payload in decoded) == payload + b"\xff" * 24
+
+
+def test_bin_defaults_to_flash_base(tmp_path):
+    path = tmp_path / "app.bin"
+    path.write_bytes(b"\x01" * 256)
+    assert blocks(main.convert_to_uf2(str(path)))[0][0][3] == main.RP2_FLASH_BASE
+
+
+@pytest.mark.parametrize("family", ["RP2350-ARM-S", "RP2350-RISCV"])
+def test_rp2350_family_ids(tmp_path, family):
+    path = tmp_path / "app.bin"
+    path.write_bytes(os.urandom(600))
+    image = main.convert_to_uf2(str(path), main.FAMILY_IDS[family])
+    assert {header[7] for header, _ in blocks(image)} == {main.FAMILY_IDS[family]}
+    assert main.parse_uf2(image.tobytes()).families == {main.FAMILY_IDS[family]}
+
+
+def test_intel_hex_extended_linear_address(tmp_path):
+    low = bytes(range(16))
+    high = bytes(range(16, 48))
+    lines = [
+        hex_record(0x04, 0, b"\x10\x00"),  # Upper address 0x1000xxxx
+        hex_record(0x00, 0x0000, low),
+        hex_record(0x04, 0, b"\x10\x01"),  # Upper address 0x1001xxxx
+        hex_record(0x00, 0x0100, high[:16]),
+        hex_record(0x00, 0x0110, high[16:]),
+        hex_record(0x01, 0, b""),
+    ]
+    path = tmp_path / "app.hex"
+    path.write_text("\n".join(lines) + "\n")
+
+    assert main.read_hex_segments(str(path)) == [(0x10000000, low), (0x10010100, high)]
+    image = main.convert_to_uf2(str(path))
+    contents = flash_contents(image)
+    assert bytes(contents[0x10000000 + i] for i in range(16)) == low
+    assert bytes(contents[0x10010100 + i] for i in range(32)) == high
+    decoded = blocks(image)
+    assert [header[3] for header, _ in decoded] == [0x10000000, 0x10010100]
+    assert [(header[5], header[6]) for header, _ in decoded] == [(0, 2), (1, 2)]
+
+
+def test_intel_hex_bad_checksum(tmp_path):
+    path = tmp_path / "app.hex"
+    path.write_text(hex_record(0x00, 0, b"\x01\x02")[:-2] + "00\n")
+    with pytest.raises(ValueError, match="checksum"):
+        main.read_hex_segments(str(path))
+
+
+def test_elf_uses_load_addresses(tmp_path):
+    text = os.urandom(512)
+    data = os.urandom(100)
+    path = tmp_path / "app.elf"
+    # .data runs from RAM (VMA 0x20000000) but is loaded from flash right after .text (LMA)
+    path.write_bytes(elf([(0x10000000, 0x10000000, text), (0x20000000, 0x10000200, data)]))
+
+    assert main.read_elf_segments(str(path)) == [(0x10000000, text), (0x10000200, data)]
+    image = main.convert_to_uf2(str(path))
+    contents = flash_contents(image)
+    assert bytes(contents[0x10000000 + i] for i in range(612)) == text + data
+    assert min(contents) == 0x10000000 and not any(address >= 0x20000000 for address in contents)
+    decoded = blocks(image)
+    assert [header[5] for header, _ in decoded] == list(range(3))
+    assert {header[6] for header, _ in decoded} == {3}
+
+
+def test_unsupported_and_empty_files(tmp_path):
+    (tmp_path / "app.txt").write_text("x")
+    with pytest.raises(ValueError, match="Unsupported"):
+        main.convert_to_uf2(str(tmp_path / "app.txt"))
+    (tmp_path / "empty.hex").write_text(hex_record(0x01, 0, b"") + "\n")
+    with pytest.raises(ValueError, match="no data"):
+        main.convert_to_uf2(str(tmp_path / "empty.hex"))
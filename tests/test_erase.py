@@ -0,0 +1,33 @@
+import pytest
+
+import main
+
+SECTOR = main.FLASH_SECTOR_SIZE
+BASE = main.RP2_FLASH_BASE
+
+
+@pytest.fixture
+def layout():
+    """Firmware in the first three sectors, a 16-sector filesystem at 1 MB with two used data sectors."""
+    start = BASE + 0x100000
+    used = [BASE, BASE + SECTOR, BASE + 2 * SECTOR, start, start + 5 * SECTOR, start + 9 * SECTOR]
+    return {"flash_size": 2 * 1024 * 1024, "used": used, "filesystem": (start, start + 16 * SECTOR)}
+
+
+def test_filesystem_preset_keeps_firmware_but_blanks_boot_sector(layout):
+    start = layout["filesystem"][0]
+    sectors = main.erase_sectors(layout, "filesystem")
+    assert sectors == [BASE, start, start + SECTOR, start + 5 * SECTOR, start + 9 * SECTOR]
+    assert BASE + SECTOR not in sectors
+    assert "boot sector" in main.ERASE_PRESETS["filesystem"]
+
+
+def test_firmware_preset_adds_used_sectors_before_filesystem(layout):
+    sectors = main.erase_sectors(layout, "firmware")
+    assert sectors == sorted(set(main.erase_sectors(layout, "filesystem")) | {BASE + SECTOR, BASE + 2 * SECTOR})
+
+
+def test_without_filesystem_only_boot_sector_or_firmware(layout):
+    layout["filesystem"] = None
+    assert main.erase_sectors(layout, "filesystem") == [BASE]
+    assert main.erase_sectors(layout, "firmware") == layout["used"]
@@ -0,0 +1,141 @@
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import pytest
+import requests
+
+import main
+
+
+class Origin(http.server.ThreadingHTTPServer):
+    """Local stand-in for the download server, serving a directory and logging GETs."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.gets = []
+        super().__init__(("127.0.0.1", 0), OriginHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+
+class OriginHandler(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, request, address, server):
+        super().__init__(request, address, server, directory=server.directory)
+
+    def do_GET(self):
+        self.server.gets.append(self.path)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def lan(tmp_path):
+    """An origin with a bundle and a manifest, and a factory for stations on 127.0.0.1."""
+    origin_dir = tmp_path / "origin"
+    origin_dir.mkdir()
+    bundle = os.urandom(512 * 1024)
+    firmware = os.urandom(100 * 1024)
+    (origin_dir / "bundle.rar").write_bytes(bundle)
+    (origin_dir / "fw.uf2").write_bytes(firmware)
+    (origin_dir / "manifest.json").write_text(json.dumps(
+        {"artifacts": [{"name": "fw.uf2", "url": "fw.uf2", "sha256": hashlib.sha256(firmware).hexdigest()}]}))
+    origin = Origin(str(origin_dir))
+    servers = []
+
+    def station(name, peers=()):
+        folder = tmp_path / name
+        folder.mkdir()
+        store = main.PeerStore(str(folder / "store"))
+        client = main.PeerClient(list(peers), timeout=1) if peers else None
+        checker = main.UpdateChecker(str(folder / "state.json"), bandwidth_limit=0, peers=client, store=store)
+        server = main.PeerCacheServer(store, host="127.0.0.1", port=0)
+        server.start()
+        servers.append(server)
+        return {"dir": folder, "checker": checker, "server": server, "store": store,
+                "address": f"127.0.0.1:{server.port}"}
+
+    yield {"origin": origin, "station": station, "bundle": bundle, "firmware": firmware}
+    for server in servers:
+        server.stop()
+    origin.shutdown()
+    origin.server_close()
+
+
+def test_second_station_fetches_bundle_from_first(lan):
+    origin, bundle = lan["origin"], lan["bundle"]
+    a = lan["station"]("a")
+    assert a["checker"].fetch(origin.url("bundle.rar"), str(a["dir"] / "bundle.rar"))
+    origin.gets.clear()
+
+    b = lan["station"]("b", ["127.0.0.1:1", a["address"]])
+    assert b["checker"].fetch(origin.url("bundle.rar"), str(b["dir"] / "bundle.rar"))
+
+    assert (b["dir"] / "bundle.rar").read_bytes() == bundle
+    assert origin.gets == []  # Only a HEAD went to the origin
+    assert a["server"].served == len(bundle)
+    assert b["checker"].state["urls"][origin.url("bundle.rar")]["peer"] == f"http://{a['address']}"
+
+
+def test_manifest_artifact_with_hash_needs_no_origin_transfer(lan):
+    origin, firmware = lan["origin"], lan["firmware"]
+    a = lan["station"]("a")
+    a["checker"].update_manifest(origin.url("manifest.json"), str(a["dir"]))
+    origin.gets.clear()
+
+    b = lan["station"]("b", [a["address"]])
+    updated = b["checker"].update_manifest(origin.url("manifest.json"), str(b["dir"]))
+
+    assert [os.path.basename(path) for path in updated] == ["fw.uf2"]
+    assert (b["dir"] / "fw.uf2").read_bytes() == firmware
+    assert origin.gets == []  # The manifest came from the peer as well
+
+
+def test_corrupted_peer_copy_rejected(lan):
+    origin, bundle = lan["origin"], lan["bundle"]
+    a = lan["station"]("a")
+    a["checker"].fetch(origin.url("bundle.rar"), str(a["dir"] / "bundle.rar"))
+    b = lan["station"]("b", [a["address"]])
+    b["checker"].fetch(origin.url("bundle.rar"), str(b["dir"] / "bundle.rar"))
+    stored = os.path.join(a["store"].directory, hashlib.sha256(bundle).hexdigest())
+    os.remove(stored)
+    with open(stored, "wb") as f:
+        f.write(b"x" * len(bundle))
+    origin.gets.clear()
+
+    c = lan["station"]("c", [a["address"], b["address"]])
+    c["checker"].peers.speeds[f"http://{a['address']}"] = 1e12  # The lying peer looks fastest
+    assert c["checker"].fetch(origin.url("bundle.rar"), str(c["dir"] / "bundle.rar"))
+
+    assert (c["dir"] / "bundle.rar").read_bytes() == bundle
+    assert c["checker"].state["urls"][origin.url("bundle.rar")]["peer"] == f"http://{b['address']}"
+    assert origin.gets == []
+
+
+def test_origin_used_when_every_peer_copy_is_bad(lan):
+    origin, bundle = lan["origin"], lan["bundle"]
+    a = lan["station"]("a")
+    a["checker"].fetch(origin.url("bundle.rar"), str(a["dir"] / "bundle.rar"))
+    with open(os.path.join(a["store"].directory, hashlib.sha256(bundle).hexdigest()), "r+b") as f:
+        f.write(b"corrupt")
+    origin.gets.clear()
+
+    b = lan["station"]("b", [a["address"]])
+    assert b["checker"].fetch(origin.url("bundle.rar"), str(b["dir"] / "bundle.rar"))
+
+    assert (b["dir"] / "bundle.rar").read_bytes() == bundle
+    assert origin.gets == ["/bundle.rar"]
+    assert not os.path.exists(str(b["dir"] / "bundle.rar.part"))
+
+
+def test_peer_server_is_read_only(lan):
+    a = lan["station"]("a")
+    base = f"http://{a['address']}/peer/v1"
+    assert requests.get(f"{base}/index").json() == {"objects": []}
+    assert requests.get(f"{base}/objects/{'0' * 64}").status_code == 404
+    assert requests.post(f"{base}/index").status_code == 405
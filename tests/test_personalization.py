@@ -0,0 +1,54 @@
+import json
+
+import main
+
+
+def write_records(tmp_path, count):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps([{"id": f"SN{i}", "address": "0x10001000", "text": f"SN{i}"} for i in range(count)]))
+    return str(path)
+
+
+def flash_args(tmp_path, *extra):
+    firmware = tmp_path / "fw.uf2"
+    firmware.write_bytes(main.uf2_block(0x10000000, b"\0" * 256, 0, 1))
+    drive = tmp_path / "drive"
+    drive.mkdir()
+    return main.build_arg_parser().parse_args(["flash", str(firmware), "--drive", str(drive), *extra])
+
+
+def test_assign_burns_records_only_when_called(tmp_path):
+    records = main.PersonalizationRecords(write_records(tmp_path, 3))
+    jobs = [main.FlashJob("flash", drive, drive) for drive in ("E:", "F:")]
+
+    records.assign(jobs)
+
+    assert [job.personalization_id for job in jobs] == ["SN0", "SN1"]
+    assert jobs[0].personalization == [(0x10001000, b"SN0")]
+    assert main.PersonalizationRecords(records.path).remaining == 1
+
+
+def test_cli_keeps_records_when_library_check_fails(tmp_path, capsys):
+    path = write_records(tmp_path, 1)
+    args = flash_args(tmp_path, "--personalize", path, "--recipe", "flash+sync")
+
+    assert main.cli_flash(args) == 1
+    assert "--library" in capsys.readouterr().out
+    assert main.PersonalizationRecords(path).remaining == 1
+
+
+def test_cli_keeps_records_when_erase_image_missing(tmp_path, capsys):
+    path = write_records(tmp_path, 1)
+    args = flash_args(tmp_path, "--personalize", path, "--erase", "firmware")
+
+    assert main.cli_flash(args) == 1
+    assert "No erase image" in capsys.readouterr().out
+    assert main.PersonalizationRecords(path).remaining == 1
+
+
+def test_cli_rejects_short_record_file_up_front(tmp_path, capsys):
+    path = write_records(tmp_path, 0)
+    args = flash_args(tmp_path, "--personalize", path)
+
+    assert main.cli_flash(args) == 1
+    assert "Not enough personalization records" in capsys.readouterr().out
@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+import main
+
+MB = 1024 * 1024
+
+
+def make_image(pages, family=main.FAMILY_IDS["RP2040"]):
+    """UF2 image with one block per (address, payload) page."""
+    return b"".join(main.uf2_block(address, payload, i, len(pages), family) for i, (address, payload) in enumerate(pages))
+
+
+def test_personalized_image_over_picoboot():
+    base = b"".join(main.uf2_block(0x10000000 + i * 256, bytes([i]) * 256, i, 8) for i in range(8))
+    image = main.personalize_uf2(base, [(0x10000010, b"ABCD"), (0x10001000, b"SERIAL")])
+    transport = main.FakePicobootTransport()
+    device = main.PicobootDevice(transport, "RP2040")
+
+    written = main.picoboot_flash(device, image)
+
+    assert written > 0
+    assert transport.rebooted
+    flash = transport.flash
+    assert flash[0x10:0x14] == b"ABCD"
+    assert flash[0x100:0x200] == bytes([1]) * 256
+    assert flash[0x1000:0x1006] == b"SERIAL"
+
+
+def test_sector_ranges_merge_adjacent_and_overlapping_sectors():
+    runs = [(0x10000000, b"\0" * 256), (0x10000f00, b"\0" * 512), (0x10003000, b"\0" * 256)]
+    assert main.sector_ranges(runs) == [(0x10000000, 0x2000), (0x10003000, 0x1000)]
+
+
+def test_full_erase_covers_probed_flash_size():
+    transport = main.FakePicobootTransport(flash_size=8 * MB)
+    transport.flash[:main.FLASH_SECTOR_SIZE] = bytes(range(256)) * 16
+    transport.flash[7 * MB:7 * MB + 16] = b"old filesystem.."
+    device = main.PicobootDevice(transport, "RP2040")
+
+    main.picoboot_flash(device, None, full_erase=True)
+
+    assert transport.flash == b"\xff" * (8 * MB)
+
+
+def test_full_erase_refused_when_flash_size_unknown():
+    transport = main.FakePicobootTransport(flash_size=8 * MB)
+    transport.flash[7 * MB:7 * MB + 16] = b"old filesystem.."
+    device = main.PicobootDevice(transport, "RP2040")
+
+    with pytest.raises(RuntimeError, match="flash size"):
+        main.picoboot_flash(device, None, full_erase=True)
+    assert main.PICOBOOT_FLASH_ERASE not in transport.commands
+
+    main.picoboot_flash(device, None, full_erase=True, flash_size=8 * MB)
+    assert transport.flash[7 * MB:7 * MB + 16] == b"\xff" * 16
+
+
+def test_verify_failure_reports_address():
+    transport = main.FakePicobootTransport()
+    transport.flash[:] = bytes(len(transport.flash))
+    device = main.PicobootDevice(transport, "RP2040")
+    device.erase = lambda address, size: None  # Programming can then only clear bits that are already clear
+
+    with pytest.raises(RuntimeError, match="Read-back mismatch at 0x10000000"):
+        main.picoboot_flash(device, make_image([(0x10000000, b"\x55" * 256)]))
+    assert not transport.rebooted
+
+
+def test_cancel_stops_between_transfers():
+    transport = main.FakePicobootTransport()
+    device = main.PicobootDevice(transport, "RP2040")
+    cancel = threading.Event()
+    cancel.set()
+
+    with pytest.raises(RuntimeError, match="cancelled"):
+        main.picoboot_flash(device, make_image([(0x10000000, b"\x55" * 256)]), cancel=cancel)
+    assert main.PICOBOOT_WRITE not in transport.commands
+    assert not transport.rebooted
+
+
+def test_blocks_outside_flash_are_rejected():
+    image = make_image([(0x10000000, bytes(range(256))), (0x10200000, b"\x55" * 256)])
+    device = main.PicobootDevice(main.FakePicobootTransport(), "RP2040")
+
+    with pytest.raises(ValueError, match="0x10200000"):
+        main.picoboot_flash(device, image, flash_size=2 * MB)
+    with pytest.raises(ValueError, match="0x20000000"):
+        main.uf2_flash_runs(make_image([(0x20000000, b"\x55" * 256)]))
+
+
+def test_blocks_filtered_by_chip_family():
+    absolute = main.FAMILY_IDS["ABSOLUTE"]
+    image = (make_image([(0x10000000, b"\x11" * 256)], main.FAMILY_IDS["RP2040"])
+             + make_image([(0x10000000, b"\x22" * 256)], main.FAMILY_IDS["RP2350-ARM-S"])
+             + make_image([(0x10001000, b"\x33" * 256), (main.RP2350_E10_BLOCK, b"\x44" * 256)], absolute))
+
+    assert main.uf2_flash_runs(image, "RP2040") == [(0x10000000, b"\x11" * 256), (0x10001000, b"\x33" * 256)]
+    assert main.uf2_flash_runs(image, "RP2350", 4 * MB) == [(0x10000000, b"\x22" * 256),
+                                                             (0x10001000, b"\x33" * 256)]
+    with pytest.raises(ValueError, match="no blocks for RP2350"):
+        main.uf2_flash_runs(make_image([(0x10000000, b"\x11" * 256)]), "RP2350")
+
+
+def test_e10_block_not_written_at_alias():
+    transport = main.FakePicobootTransport("RP2350", flash_size=4 * MB)
+    device = main.PicobootDevice(transport, "RP2350")
+    image = (make_image([(0x10000000, bytes(range(256)))], main.FAMILY_IDS["RP2350-ARM-S"])
+             + make_image([(main.RP2350_E10_BLOCK, b"\x44" * 256)], main.FAMILY_IDS["ABSOLUTE"]))
+
+    main.picoboot_flash(device, image)
+
+    assert transport.flash[-256:] == b"\xff" * 256
@@ -0,0 +1,64 @@
+import json
+import os
+
+import pytest
+
+import main
+
+TRACES = os.path.join(os.path.dirname(__file__), "data", "device_traces.jsonl")
+
+
+def test_load_skips_jobs_that_never_wrote():
+    timelines = main.load_device_traces(TRACES)
+    assert [timeline["device"] for timeline in timelines] == ["1-1.1", "1-1.2", "1-1.3"]
+
+
+def test_load_rejects_trace_without_writes(tmp_path):
+    path = tmp_path / "empty.jsonl"
+    path.write_text(json.dumps({"device": "1-1.4", "events": [{"event": "timeout", "t": 20.0}]}) + "\n")
+    with pytest.raises(ValueError, match="no recorded device writes"):
+        main.load_device_traces(str(path))
+
+
+def test_replay_device_reproduces_write_latency_and_reconnect():
+    device = main.ReplayDeviceIO(main.load_device_traces(TRACES)[0], "replay0", speed=10)
+    image = memoryview(bytes(4096))
+
+    assert device.write_image(image, os.path.join("replay0", "flash_nuke.uf2")) == 4096
+    assert device.wait_for_detach("replay0", 5)
+    assert device.wait_for_volume("replay0", "RPI-RP2", 5)
+    assert device.exists("replay0")
+
+
+def test_cli_replay_on_recorded_traces(tmp_path, capsys):
+    firmware = tmp_path / "fw.uf2"
+    firmware.write_bytes(b"".join(main.uf2_block(0x10000000 + i * 256, bytes(256), i, 2048) for i in range(2048)))
+    nuke = tmp_path / "flash_nuke.uf2"
+    nuke.write_bytes(main.uf2_block(0x20000000, bytes(256), 0, 1))
+    result_path = tmp_path / "replay.json"
+    args = main.build_arg_parser().parse_args(["replay", TRACES, "--firmware", str(firmware), "--nuke", str(nuke),
+                                               "--expect-volume", "CIRCUITPY", "--speed", "20",
+                                               "--json", str(result_path)])
+
+    assert main.cli_replay(args) == 0
+
+    result = json.loads(result_path.read_text())
+    assert result["boards"] == 3
+    assert result["states"] == {"failed": 1, "succeeded": 2}
+    assert {"write_nuke", "erase", "write_firmware", "reconnect"} <= set(result["phases"])
+    assert "Input/output error" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("verify_images", [False, True])
+def test_firmware_rehashed_only_when_it_crossed_a_process(verify_images):
+    job = main.FlashJob("flash", "replay0", "fw", firmware_path="fw.uf2", recipe=["firmware"])
+    job.firmware_sha256 = "0" * 64  # Not the hash of the buffer below
+    job.firmware_settle = 0
+    events = []
+    device = main.ReplayDeviceIO(main.load_device_traces(TRACES)[0], "replay0", speed=50)
+
+    main.run_flash_job(job, {"firmware": bytes(512)}, lambda *event: events.append(event), device=device,
+                       verify_images=verify_images)
+
+    assert job.state == ("failed" if verify_images else "succeeded")
+    assert ("does not match" in (job.error or "")) == verify_images
@@ -0,0 +1,160 @@
+import pytest
+
+import main
+
+BANNER = (b"MicroPython v1.24.1 on 2024-11-29; Raspberry Pi Pico with RP2040\r\n"
+          b"Type \"help()\" for more information.\r\n>>> ")
+OUTPUT = b"(name='micropython', version=(1, 24, 1, ''))\r\nv1.24.1 on 2024-11-29\r\n"
+
+
+class FakeTester:
+    def __init__(self):
+        self.ports = []
+
+    def run(self, ports):
+        self.ports.extend(ports)
+        return [{"port": port, "passed": True, "firmware": "CircuitPython", "version": "9.0.0", "error": None}
+                for port in ports]
+
+
+def make_job(drive, usb_port):
+    return main.FlashJob("flash", drive, drive, usb_port=usb_port)
+
+
+def test_windows_location_path_matches_serial_location():
+    port = main.windows_usb_port("PCIROOT(0)#PCI(1400)#USBROOT(0)#USB(1)#USB(2)")
+    assert port == "1-1.2"
+    assert main.usb_port_key(port) == main.usb_port_key("1-1.2:x.0")
+    assert main.windows_usb_port("PCIROOT(0)#PCI(1400)") is None
+
+
+def test_boards_matched_by_port_and_unknown_port_skipped():
+    jobs = [make_job("E:", "1-1.2"), make_job("F:", "1-1.3"), make_job("G:", None)]
+    ports = [{"port": "COM5", "location": "1-1.3:x.0"}, {"port": "COM4", "location": "1-1.2:x.0"}]
+    tester = FakeTester()
+    main.run_smoke_tests(jobs, tester, log=lambda message: None, enumerate_timeout=0,
+                         list_serial_ports=lambda: ports)
+    assert [job.smoke_test["port"] for job in jobs[:2]] == ["COM4", "COM5"]
+    assert jobs[2].smoke_test["skipped"]
+    assert tester.ports == ["COM4", "COM5"]
+    assert all(job.state != "failed" for job in jobs)
+
+
+def test_single_job_needs_port_match_when_other_boards_attached():
+    job = make_job("E:", "1-1.2")
+    tester = FakeTester()
+    main.run_smoke_tests([job], tester, log=lambda message: None, enumerate_timeout=0,
+                         list_serial_ports=lambda: [{"port": "COM5", "location": "1-1.3:x.0"}],
+                         pair_leftover=False)
+    assert tester.ports == []
+    assert job.smoke_test["port"] is None
+    assert job.state == "failed"
+
+
+def test_reconnected_drive_falls_back_to_only_new_drive(monkeypatch):
+    monkeypatch.setattr(main, "get_volume_name", lambda drive: "CIRCUITPY" if drive != "E:" else None)
+    monkeypatch.setattr(main, "find_drives", lambda name: ["F:\\", "G:\\"])
+    job = make_job("E:", None)
+    assert main.reconnected_drive(job, "CIRCUITPY", known=["F:\\"]) == "G:\\"
+    assert main.reconnected_drive(job, "CIRCUITPY") is None
+
+
+class FakeRepl:
+    """pty stand-in for a board's REPL: prints the banner on Ctrl-B and answers raw REPL runs."""
+    def __init__(self, output=OUTPUT, error=b"", silent=False):
+        import pty
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = main.os.ttyname(self.slave)
+        self.output = output
+        self.error = error
+        self.silent = silent
+        self.code = None
+        main.threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        raw = False
+        code = b""
+        while True:
+            try:
+                data = main.os.read(self.master, 1024)
+            except OSError:
+                return
+            if self.silent:
+                continue
+            for byte in data:
+                char = bytes([byte])
+                if raw and char == b"\x04":
+                    self.code = code
+                    code = b""
+                    main.os.write(self.master, b"OK" + self.output + b"\x04" + self.error + b"\x04>")
+                elif raw and char == b"\x02":
+                    raw = False
+                    main.os.write(self.master, b"\r\n>>> ")
+                elif raw:
+                    code += char
+                elif char == b"\x02":
+                    main.os.write(self.master, BANNER)
+                elif char == b"\x01":
+                    raw = True
+                    main.os.write(self.master, b"raw REPL; CTRL-B to exit\r\n>")
+
+    def close(self):
+        main.os.close(self.master)
+        main.os.close(self.slave)
+
+
+@pytest.fixture
+def repls():
+    pytest.importorskip("pty")
+    if not main.serial:
+        pytest.skip("pyserial is not installed")
+    created = []
+
+    def make(**kwargs):
+        created.append(FakeRepl(**kwargs))
+        return created[-1]
+    yield make
+    for repl in created:
+        repl.close()
+
+
+def test_smoke_test_passes_on_fake_repl(repls):
+    repl = repls()
+    result = main.ReplSmokeTest().run([repl.port])[0]
+
+    assert result["passed"], result
+    assert (result["firmware"], result["version"]) == ("MicroPython", "v1.24.1")
+    assert "name='micropython'" in result["output"]
+    assert repl.code == main.DEFAULT_SMOKE_SNIPPET.encode()
+
+
+def test_smoke_test_reports_traceback_and_mismatch(repls):
+    failing = repls(error=b"Traceback (most recent call last):\r\nImportError: no module named 'os'\r\n")
+    other = repls(output=b"hello\r\n")
+    results = main.ReplSmokeTest().run([failing.port, other.port])
+
+    assert not results[0]["passed"] and "ImportError" in results[0]["error"]
+    assert not results[1]["passed"] and "did not match" in results[1]["error"]
+
+
+def test_smoke_test_times_out_on_silent_port(repls):
+    repl = repls(silent=True)
+    result = main.ReplSmokeTest(banner_timeout=0.3).run([repl.port])[0]
+
+    assert not result["passed"]
+    assert "Timed out" in result["error"]
+
+
+def test_run_smoke_tests_against_fake_repls(repls):
+    boards = [repls(), repls(output=b"nope\r\n")]
+    jobs = [make_job("E:", "1-1.2"), make_job("F:", "1-1.3")]
+    ports = [{"port": boards[1].port, "location": "1-1.3:1.0"}, {"port": boards[0].port, "location": "1-1.2:1.0"}]
+
+    main.run_smoke_tests(jobs, main.ReplSmokeTest(), log=lambda message: None, enumerate_timeout=0,
+                         list_serial_ports=lambda: ports)
+
+    assert jobs[0].smoke_test["passed"] and jobs[0].state != "failed"
+    assert jobs[1].state == "failed" and "did not match" in jobs[1].error
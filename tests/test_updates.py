@@ -0,0 +1,136 @@
+import hashlib
+import http.server
+import json
+import threading
+
+import pytest
+import requests
+
+import main
+
+
+class Origin(http.server.ThreadingHTTPServer):
+    """Local stand-in for the download server, answering conditional requests by ETag."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), OriginHandler)
+        self.files = {}  # path -> bytes
+        self.requests = []  # (method, path, If-None-Match, status)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+    def etag(self, path):
+        return '"' + hashlib.sha256(self.files[path]).hexdigest()[:16] + '"'
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        origin = self.server
+        if_none_match = self.headers.get("If-None-Match")
+        if self.path not in origin.files:
+            status = 404
+        elif if_none_match == origin.etag(self.path):
+            status = 304
+        else:
+            status = 200
+        origin.requests.append(("GET", self.path, if_none_match, status))
+        self.send_response(status)
+        if status == 200:
+            body = origin.files[self.path]
+            self.send_header("ETag", origin.etag(self.path))
+            self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+@pytest.fixture
+def origin():
+    server = Origin()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_checker(tmp_path):
+    return main.UpdateChecker(str(tmp_path / "state.json"), bandwidth_limit=0, timeout=5)
+
+
+def test_etag_turns_repeat_download_into_304(origin, tmp_path):
+    origin.files["/fw.uf2"] = b"v1" * 1000
+    dest = str(tmp_path / "fw.uf2")
+    checker = make_checker(tmp_path)
+
+    assert checker.fetch(origin.url("/fw.uf2"), dest)
+    assert not checker.fetch(origin.url("/fw.uf2"), dest)
+
+    assert [status for *_, status in origin.requests] == [200, 304]
+    assert origin.requests[1][2] == origin.etag("/fw.uf2")
+    with open(dest, "rb") as f:
+        assert f.read() == b"v1" * 1000
+
+
+def test_changed_file_downloaded_again_and_state_persisted(origin, tmp_path):
+    origin.files["/fw.uf2"] = b"v1"
+    dest = str(tmp_path / "fw.uf2")
+    checker = make_checker(tmp_path)
+    checker.fetch(origin.url("/fw.uf2"), dest)
+    checker.save()
+
+    origin.files["/fw.uf2"] = b"v2"
+    reloaded = make_checker(tmp_path)
+    assert reloaded.fetch(origin.url("/fw.uf2"), dest)
+    assert origin.requests[-1][3] == 200
+    with open(dest, "rb") as f:
+        assert f.read() == b"v2"
+    assert reloaded.state["urls"][origin.url("/fw.uf2")]["etag"] == origin.etag("/fw.uf2")
+
+
+def test_missing_file_requested_unconditionally(origin, tmp_path):
+    origin.files["/fw.uf2"] = b"v1"
+    dest = tmp_path / "fw.uf2"
+    checker = make_checker(tmp_path)
+    checker.fetch(origin.url("/fw.uf2"), str(dest))
+    dest.unlink()
+
+    assert checker.fetch(origin.url("/fw.uf2"), str(dest))
+    assert origin.requests[-1][2:] == (None, 200)
+
+
+def test_server_error_keeps_previous_copy(origin, tmp_path):
+    dest = tmp_path / "fw.uf2"
+    dest.write_bytes(b"old")
+
+    with pytest.raises(requests.HTTPError):
+        make_checker(tmp_path).fetch(origin.url("/gone.uf2"), str(dest))
+    assert dest.read_bytes() == b"old"
+
+
+def test_manifest_downloads_only_changed_artifacts(origin, tmp_path):
+    origin.files["/a.uf2"] = b"A"
+    origin.files["/b.uf2"] = b"B"
+    origin.files["/manifest.json"] = json.dumps({"artifacts": [
+        {"name": "a.uf2", "url": "a.uf2"},
+        {"name": "b.uf2", "url": "b.uf2", "sha256": hashlib.sha256(b"B").hexdigest()},
+    ]}).encode()
+    folder = str(tmp_path / "fw")
+    main.os.makedirs(folder)
+    checker = make_checker(tmp_path)
+
+    assert sorted(main.os.path.basename(p) for p in checker.update_manifest(origin.url("/manifest.json"), folder)) \
+        == ["a.uf2", "b.uf2"]
+    origin.requests.clear()
+    origin.files["/a.uf2"] = b"A2"
+
+    updated = checker.update_manifest(origin.url("/manifest.json"), folder)
+
+    assert [main.os.path.basename(p) for p in updated] == ["a.uf2"]
+    # b.uf2 still matches its manifest hash, so it is not even asked for
+    assert [(path, status) for _, path, _, status in origin.requests] == [("/manifest.json", 304), ("/a.uf2", 200)]